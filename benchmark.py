@@ -0,0 +1,361 @@
+'''
+    Benchmark del nivelado
+
+    Genera un archivo de codigo G sintetico (trazos de segmentos rectos y arcos)
+    y un mapa de alturas sintetico con la densidad de cuadricula indicada, y mide
+    cada etapa del nivelado:
+        lectura      -> interpretar todas las lineas (interpretarLineas)
+        interpolador -> construir la funcion de interpolacion con cada metodo
+                        (interporlarMapa2, interpolarMapa, interpolarMalla y los
+                        modelos de superficie de probing.MODELOS)
+        evaluacion   -> evaluar las alturas de los puntos de corte con cada metodo
+        escritura    -> formatear las alturas y escribir el archivo nivelado
+                        (formatearAlturas, escribirZ)
+        nivelado     -> modificarArchivo completo con interpolarMalla
+    Imprime en JSON los parametros y, por etapa, el tiempo de CPU y de reloj, la
+    cantidad procesada por segundo y el pico de memoria del proceso hasta el final
+    de la etapa, para poder comparar los resultados entre versiones.
+
+    Con --verificar, en lugar de medir comprueba resultados que una optimizacion
+    no debe cambiar (ver verificar) y termina con error si alguno falla.
+
+    Uso:
+        python benchmark.py [opciones]
+    Ver python benchmark.py -h. Con --base <archivo> --copias <n> se usan n copias
+    de un archivo real (e.g. cubo4x4.bot.etch.OPT.nc) en lugar del codigo sintetico.
+'''
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+import probing
+
+try:
+    import resource
+except ImportError:
+    # Windows: no se reporta la memoria
+    resource = None
+
+# Metodos de interpolacion que se miden: nombre -> funcion(probemap, l, h, dx, dy)
+METODOS = {
+    'interporlarMapa2': lambda p, l, h, dx, dy: probing.BilinearMatrix(probing.interporlarMapa2(p, l, h, dx, dy), dx, dy),
+    'interpolarMapa': lambda p, l, h, dx, dy: probing.interpolarMapa(p),
+    'interpolarMalla': lambda p, l, h, dx, dy: probing.interpolarMalla(p, l, h, dx, dy),
+}
+for _modelo in probing.MODELOS:
+    METODOS['modelo_' + _modelo] = (lambda m: lambda p, l, h, dx, dy: probing.ajustarModelo(p, m, l, h, dx, dy))(_modelo)
+
+# Altura segura y de corte del codigo sintetico, como en los archivos de pcb2gcode
+Z_SEGURA = 3.0
+Z_CORTE = -0.115
+
+# Mapa y archivo real del repositorio, para las comprobaciones (ver verificar)
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+MAPA_REAL = os.path.join(DIRECTORIO, probing.OUTPUT_FILE)
+ARCHIVO_REAL = os.path.join(DIRECTORIO, 'cubo4x4.bot.etch.OPT.nc')
+
+
+'''
+    Escribe en filename un archivo de codigo G sintetico sobre una placa de
+    largo_x * largo_y mm (X negativa, como DELTA_X).
+    trazos -> cantidad de trazos (bajar, cortar, subir)
+    segmentos -> movimientos de corte por trazo
+    largo_seg -> largo (mm) de cada movimiento
+    arcos -> fraccion de los movimientos que son arcos G2/G3 con I, J
+
+    Devuelve la cantidad de lineas y de arcos escritos.
+'''
+def generarCodigo(filename, trazos=2000, segmentos=50, largo_seg=1.0, arcos=0.2,
+                  largo_x=100.0, largo_y=80.0, semilla=0):
+    r = np.random.RandomState(semilla)
+    margen = 0.01
+    def dentro(x, y):
+        return -largo_x + margen < x < -margen and margen < y < largo_y - margen
+
+    wf = open(filename, 'w', probing.WRITE_BUFFER)
+    wf.write('(Codigo G sintetico)\n(Metrico)\nG21\n(Absolute coordinates)\nG90\nG0 Z%.4f\nM3\n' % Z_SEGURA)
+    lineas, n_arcos = 7, 0
+    for t in range(trazos):
+        x, y = -r.uniform(margen, largo_x - margen), r.uniform(margen, largo_y - margen)
+        ang = r.uniform(0, 2 * np.pi)
+        wf.write('G0 X%.4f Y%.4f\nG1 Z%.4f F70.00\n' % (x, y, Z_CORTE))
+        lineas += 2
+        for s in range(segmentos):
+            avance = ' F95.00' if s == 0 else ''
+            ang += r.normal(0, 0.3)
+            if r.random_sample() < arcos:
+                # Arco de radio largo_seg que gira entre 0.3 y 1.5 rad
+                horario = r.random_sample() < 0.5
+                giro = r.uniform(0.3, 1.5) * (-1 if horario else 1)
+                normal = ang - np.pi / 2 if horario else ang + np.pi / 2
+                i, j = largo_seg * np.cos(normal), largo_seg * np.sin(normal)
+                cx, cy = x + i, y + j
+                a = np.arctan2(y - cy, x - cx) + giro
+                x1, y1 = cx + largo_seg * np.cos(a), cy + largo_seg * np.sin(a)
+                if dentro(x1, y1) and dentro(cx, cy):
+                    wf.write('G%d X%.4f Y%.4f I%.4f J%.4f%s\n' % (2 if horario else 3, x1, y1, i, j, avance))
+                    x, y, ang = x1, y1, ang + giro
+                    lineas += 1
+                    n_arcos += 1
+                    continue
+            x1, y1 = x + largo_seg * np.cos(ang), y + largo_seg * np.sin(ang)
+            if not dentro(x1, y1):
+                # Rebotar en el borde de la placa
+                ang += np.pi
+                x1, y1 = x + largo_seg * np.cos(ang), y + largo_seg * np.sin(ang)
+                if not dentro(x1, y1):
+                    x1, y1 = x, y
+            wf.write('G1 X%.4f Y%.4f%s\n' % (x1, y1, avance))
+            x, y = x1, y1
+            lineas += 1
+        wf.write('G0 Z%.4f\n' % Z_SEGURA)
+        lineas += 1
+    wf.write('G0 Z5.0000\nM5\nM2\n')
+    wf.close()
+    return lineas + 3, n_arcos
+
+
+'''
+    Escribe en filename el archivo base repetido copias veces y devuelve
+    la cantidad de lineas.
+'''
+def escalarArchivo(filename, copias, base):
+    datos = open(base, 'r').read()
+    if not datos.endswith('\n'):
+        datos += '\n'
+    wf = open(filename, 'w', probing.WRITE_BUFFER)
+    for k in range(copias):
+        wf.write(datos)
+    wf.close()
+    return datos.count('\n') * copias
+
+
+'''
+    Genera un mapa de alturas sintetico de la placa de largo_x * largo_y mm con
+    nodos cada dx, dy mm (dx < 0 como DELTA_X): una inclinacion, una ondulacion
+    suave y ruido de medicion, redondeado a milesimas como las lecturas de GRBL.
+    Devuelve el diccionario del mapa y la cantidad de celdas l, h.
+'''
+def generarMapa(largo_x=100.0, largo_y=80.0, dx=-5.0, dy=5.0, semilla=0):
+    r = np.random.RandomState(semilla)
+    l = int(np.ceil(largo_x / abs(dx)))
+    h = int(np.ceil(largo_y / abs(dy)))
+    probemap = {}
+    for i in range(l + 1):
+        for j in range(h + 1):
+            x, y = i * dx, j * dy
+            z = 0.002 * x - 0.001 * y + 0.05 * np.sin(x / 15.0) * np.cos(y / 20.0) + r.normal(0, 0.002)
+            probemap[(x, y)] = round(z, 3)
+    return probemap, l, h
+
+
+'''
+    Pico de memoria residente del proceso (KB), None si no se puede obtener.
+'''
+def memoriaMaxima():
+    if resource == None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS lo reporta en bytes, Linux en KB
+    return pico // 1024 if sys.platform == 'darwin' else pico
+
+
+'''
+    Ejecuta funcion(*args) repeticiones veces y devuelve el resultado de la
+    ultima y los menores tiempos de CPU y de reloj (s).
+'''
+def medir(repeticiones, funcion, *args):
+    cpu = reloj = None
+    for k in range(repeticiones):
+        inicio_cpu, inicio = time.clock(), time.time()
+        valor = funcion(*args)
+        t_cpu, t = time.clock() - inicio_cpu, time.time() - inicio
+        cpu = t_cpu if cpu == None else min(cpu, t_cpu)
+        reloj = t if reloj == None else min(reloj, t)
+    return valor, cpu, reloj
+
+
+'''
+    Agrega a resultados la medicion de una etapa.
+'''
+def registrar(resultados, etapa, metodo, cantidad, unidad, cpu, reloj):
+    resultados.append({'etapa': etapa, 'metodo': metodo, 'cantidad': cantidad, 'unidad': unidad,
+                       'cpu_s': round(cpu, 6), 'reloj_s': round(reloj, 6),
+                       'por_segundo': round(cantidad / cpu, 1) if cpu > 0 else None,
+                       'memoria_max_kb': memoriaMaxima()})
+
+
+'''
+    Etapa de lectura: interpreta el archivo y devuelve la cantidad de lineas y
+    los indices de linea y las coordenadas X, Y de los puntos que se nivelan.
+'''
+def leerPuntos(filename):
+    estado = probing.estadoInicial()
+    indices, xs, ys = [], [], []
+    base = 0
+    for bloque in probing.bloquesLineas(probing.leerLineas(filename)):
+        for m in probing.interpretarLineas(bloque, estado):
+            if probing.clasificarMovimiento(m) != None:
+                indices.append(base + m.linea)
+                xs.append(m.x1)
+                ys.append(m.y1)
+        base += len(bloque)
+    return base, indices, np.array(xs), np.array(ys)
+
+
+'''
+    Etapa de escritura: escribe en salida el archivo con las alturas zs en las
+    lineas indicadas, por bloques como modificarArchivo.
+'''
+def escribirAlturas(filename, salida, indices, zs):
+    textos = probing.formatearAlturas(zs)
+    wf = open(salida, 'w', probing.WRITE_BUFFER)
+    n, base = 0, 0
+    for bloque in probing.bloquesLineas(probing.leerLineas(filename)):
+        while n < len(indices) and indices[n] < base + len(bloque):
+            k = indices[n] - base
+            bloque[k] = probing.escribirZ(bloque[k], textos[n])
+            n += 1
+        base += len(bloque)
+        wf.write(''.join(bloque))
+    wf.close()
+
+
+'''
+    Realiza todas las mediciones y devuelve el diccionario de resultados.
+'''
+def benchmark(opciones):
+    directorio = tempfile.mkdtemp()
+    filename = os.path.join(directorio, 'benchmark.nc')
+    try:
+        parametros = dict(vars(opciones))
+        if opciones.base != None:
+            parametros['lineas'] = escalarArchivo(filename, opciones.copias, opciones.base)
+        else:
+            parametros['lineas'], parametros['arcos_escritos'] = generarCodigo(
+                filename, opciones.trazos, opciones.segmentos, opciones.largo_seg, opciones.arcos,
+                opciones.largo_x, opciones.largo_y, opciones.semilla)
+        parametros['bytes'] = os.path.getsize(filename)
+        dx, dy = -abs(opciones.dx), abs(opciones.dy)
+        probemap, l, h = generarMapa(opciones.largo_x, opciones.largo_y, dx, dy, opciones.semilla)
+        parametros['nodos'] = len(probemap)
+        resultados = []
+        rep = opciones.repeticiones
+
+        (lineas, indices, xs, ys), cpu, reloj = medir(rep, leerPuntos, filename)
+        registrar(resultados, 'lectura', None, lineas, 'lineas', cpu, reloj)
+        parametros['puntos'] = len(xs)
+
+        zs = None
+        for metodo in opciones.metodos.split(','):
+            f, cpu, reloj = medir(rep, METODOS[metodo], probemap, l, h, dx, dy)
+            registrar(resultados, 'interpolador', metodo, len(probemap), 'nodos', cpu, reloj)
+            # Los metodos punto a punto se evaluan en una muestra de los puntos
+            n = len(xs) if getattr(f, 'vectorizada', False) else min(len(xs), opciones.muestra)
+            z, cpu, reloj = medir(rep, probing.evaluarPuntos, f, xs[:n], ys[:n])
+            registrar(resultados, 'evaluacion', metodo, n, 'puntos', cpu, reloj)
+            if metodo == 'interpolarMalla':
+                zs = z - probing.MILL_DEPTH
+
+        if zs is None:
+            malla = probing.interpolarMalla(probemap, l, h, dx, dy)
+            zs = probing.evaluarPuntos(malla, xs, ys) - probing.MILL_DEPTH
+        salida = os.path.join(directorio, 'benchmark.ESC.nc')
+        _, cpu, reloj = medir(rep, escribirAlturas, filename, salida, indices, zs)
+        registrar(resultados, 'escritura', None, lineas, 'lineas', cpu, reloj)
+
+        malla = probing.interpolarMalla(probemap, l, h, dx, dy)
+        salida, cpu, reloj = medir(rep, probing.modificarArchivo, filename, malla, probing.MILL_DEPTH,
+                                   opciones.max_seg != None, opciones.max_seg)
+        registrar(resultados, 'nivelado', 'interpolarMalla', lineas, 'lineas', cpu, reloj)
+        parametros['bytes_nivelado'] = os.path.getsize(salida)
+    finally:
+        shutil.rmtree(directorio)
+
+    return {'parametros': parametros, 'etapas': resultados,
+            'entorno': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'plataforma': platform.platform(), 'fecha': time.strftime('%Y-%m-%d %H:%M:%S')}}
+
+
+'''
+    Comprobaciones de resultados que las optimizaciones no deben cambiar. Devuelve
+    la lista de (descripcion, correcto).
+        - Un mapa limpio (mapa_alturas.txt y el mapa sintetico) no tiene lecturas
+          sospechosas para la revision de lecturas (probing.lecturasSospechosas)
+        - Nivelar cubo4x4 con la tabla de alturas de mapa_alturas.txt (opcion -L)
+          da las mismas lineas que con el mapa, subdividiendo los cortes en la
+          cuadricula del probing y no en la de la tabla
+'''
+def verificar():
+    comprobaciones = []
+    mapas = [('mapa_alturas.txt', probing.leerMapa(MAPA_REAL)), ('mapa sintetico', generarMapa()[0])]
+    for nombre, probemap in mapas:
+        sospechosas = probing.lecturasSospechosas(probemap)
+        comprobaciones.append(('%s sin lecturas sospechosas (%d de %d)' % (nombre, len(sospechosas), len(probemap)),
+                               not sospechosas))
+
+    directorio = tempfile.mkdtemp()
+    filename = os.path.join(directorio, os.path.basename(ARCHIVO_REAL))
+    try:
+        shutil.copy(ARCHIVO_REAL, filename)
+        lineas = []
+        for resolucion in (None, 0.1):
+            f, cuadricula = probing.cargarMalla(MAPA_REAL), None
+            if resolucion != None:
+                tabla = probing.tablaAlturas(MAPA_REAL, 'bilineal', resolucion, directorio)
+                f, cuadricula = probing.cargarMalla(tabla, mmap=False), probing.cuadriculaMapa(MAPA_REAL)
+            salida = probing.modificarArchivo(filename, f, probing.MILL_DEPTH, True, 0, cuadricula=cuadricula)
+            lineas.append(sum(1 for linea in open(salida)))
+    finally:
+        shutil.rmtree(directorio)
+    comprobaciones.append(('lineas niveladas con y sin tabla de alturas (%d y %d)' % (lineas[0], lineas[1]),
+                           lineas[0] == lineas[1]))
+    return comprobaciones
+
+
+'''
+    Programa principal
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark del nivelado de codigo G')
+    parser.add_argument('--trazos', type=int, default=2000, help='trazos del codigo sintetico')
+    parser.add_argument('--segmentos', type=int, default=50, help='movimientos de corte por trazo')
+    parser.add_argument('--largo-seg', type=float, default=1.0, help='largo de cada movimiento (mm)')
+    parser.add_argument('--arcos', type=float, default=0.2, help='fraccion de movimientos G2/G3')
+    parser.add_argument('--largo-x', type=float, default=100.0, help='largo de la placa en X (mm)')
+    parser.add_argument('--largo-y', type=float, default=80.0, help='largo de la placa en Y (mm)')
+    parser.add_argument('--dx', type=float, default=5.0, help='separacion de los nodos del mapa en X (mm)')
+    parser.add_argument('--dy', type=float, default=5.0, help='separacion de los nodos del mapa en Y (mm)')
+    parser.add_argument('--semilla', type=int, default=0, help='semilla del generador')
+    parser.add_argument('--metodos', default=','.join(sorted(METODOS)),
+                        help='metodos de interpolacion separados por comas')
+    parser.add_argument('--muestra', type=int, default=20000,
+                        help='puntos evaluados con los metodos punto a punto')
+    parser.add_argument('--max-seg', type=float, default=None,
+                        help='segmentar el nivelado con este largo maximo (mm)')
+    parser.add_argument('--repeticiones', type=int, default=1, help='se reporta el menor tiempo')
+    parser.add_argument('--base', default=None, help='usar copias de este archivo en lugar del sintetico')
+    parser.add_argument('--copias', type=int, default=150, help='copias del archivo base')
+    parser.add_argument('--salida', default=None, help='archivo JSON de resultados (por defecto la consola)')
+    parser.add_argument('--verificar', action='store_true', help='solo comprobar resultados (ver verificar)')
+    opciones = parser.parse_args()
+    if opciones.verificar:
+        comprobaciones = verificar()
+        for descripcion, correcto in comprobaciones:
+            print '%s\t%s' % ('ok' if correcto else 'FALLA', descripcion)
+        sys.exit(0 if all(c for d, c in comprobaciones) else 1)
+    for metodo in opciones.metodos.split(','):
+        if metodo not in METODOS:
+            parser.error('metodo desconocido: %s' % metodo)
+
+    resultado = json.dumps(benchmark(opciones), indent=2, sort_keys=True)
+    if opciones.salida != None:
+        open(opciones.salida, 'w').write(resultado + '\n')
+    else:
+        print resultado
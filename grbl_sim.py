@@ -0,0 +1,268 @@
+﻿'''
+    Simulador de GRBL
+
+    Dispositivo virtual que se comporta como el puerto serial de GRBL
+    (write, readline, readlines, close) para probar y medir el probing sin
+    la maquina. Entiende $X, G90, G91, G20, G21, G0, G1, G4 y G38.2, responde
+    'ok'/'error' a cada linea y reporta [PRB:x,y,z:1] sobre una superficie
+    sintetica. Lleva un reloj simulado con el tiempo de cada movimiento segun
+    el avance (G1, G38.2) o las velocidades maximas de cada eje (G0).
+
+    Uso:
+        python grbl_sim.py [-r] <x> <y> [<dx> <dy>] [<mapa>]
+    Realiza el probing de la placa de x*y mm sobre el simulador, utilizando la
+    superficie de <mapa> (por defecto mapa_alturas.txt), e imprime el tiempo de
+    maquina, los bytes transmitidos y los timeouts del puerto. Con -r el probing
+    se hace en dos fases (ver probing.PROBE_TWO_PHASE). Para usar el simulador
+    con todas las opciones de probing.py, ver su opcion -S (e.g. -S sim:<mapa>).
+'''
+
+import re
+import sys
+import time
+from collections import deque
+import numpy as np
+from scipy import interpolate
+
+# Velocidades maximas de cada eje para G0 (mm/min)
+RAPID_XY = 500.0
+RAPID_Z = 300.0
+
+# Altura de la superficie en (0,0) en coordenadas de la maquina
+Z_SUPERFICIE = -3.0
+
+# Tamaño del buffer de recepcion serial de GRBL
+RX_BUFFER_SIZE = 127
+
+# Palabras de una linea de codigo G (letra y numero)
+WORD_PATTERN = '([A-Z$])([-+]?[0-9.]*)'
+
+
+'''
+    Devuelve una funcion superficie(x, y) a partir de un archivo de puntos
+    (x, y, z) separados por tabuladores, como el que escribe realizarProbing.
+    Interpola linealmente entre los puntos y fuera de ellos usa el mas cercano.
+'''
+def superficieDesdeMapa(filename):
+    puntos = np.loadtxt(filename, ndmin=2)
+    xy = puntos[:, :2]
+    lineal = interpolate.LinearNDInterpolator(xy, puntos[:, 2])
+    cercano = interpolate.NearestNDInterpolator(xy, puntos[:, 2])
+    def superficie(x, y):
+        z = lineal(x, y)
+        return float(z) if not np.isnan(z) else float(cercano(x, y))
+    return superficie
+
+
+'''
+    Define el dispositivo GRBL virtual.
+    superficie -> funcion (x, y) -> altura relativa de la placa, None para una placa plana
+    z0 -> altura de la superficie en (0,0) en coordenadas de la maquina
+    ruido -> desviacion estandar del ruido de cada lectura de G38.2 (mm)
+    semilla -> semilla del generador de ruido, para resultados repetibles
+    timeout -> tiempo de espera de readline (s), se suma al reloj si no hay respuesta
+    escala_real -> si es mayor que 0, espera escala_real * tiempo simulado en cada movimiento
+'''
+class GrblSimulator(object):
+    def __init__(self, superficie=None, z0=Z_SUPERFICIE, ruido=0.0, semilla=0, timeout=2,
+                 rx_size=RX_BUFFER_SIZE, escala_real=0.0):
+        self.superficie = superficie if superficie != None else (lambda x, y: 0.0)
+        self.z0 = z0
+        self.ruido = ruido
+        self.aleatorio = np.random.RandomState(semilla)
+        self.timeout = timeout
+        self.rx_size = rx_size
+        self.escala_real = escala_real
+        self.is_open = True
+
+        # Estado de la maquina
+        self.pos = [0.0, 0.0, 0.0]
+        self.modo = 'G0'
+        self.avance = 0.0
+        self.absoluto = True
+        self.escala = 1.0 # 25.4 en pulgadas (G20)
+        self.bloqueado = False
+
+        # Comunicacion
+        self.rx = deque() # lineas recibidas aun sin ejecutar
+        self.salida = deque(['\r\n', "Grbl 0.9j ['$' for help]\r\n"])
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.desbordes = 0 # veces que se excedio el buffer de recepcion
+        self.timeouts = 0
+
+        # Reloj simulado (s) y cantidad de lecturas de G38.2
+        self.tiempo = 0.0
+        self.sondeos = 0
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        for linea in data.splitlines(True):
+            self.rx.append(linea)
+        if sum(len(l) for l in self.rx) > self.rx_size:
+            self.desbordes += 1
+        return len(data)
+
+    def readline(self):
+        # Ejecutar comandos hasta tener una respuesta
+        while not self.salida and self.rx:
+            self.ejecutar(self.rx.popleft())
+        if not self.salida:
+            self.timeouts += 1
+            self.tiempo += self.timeout
+            return ''
+        l = self.salida.popleft()
+        self.bytes_out += len(l)
+        return l
+
+    def readlines(self):
+        lineas = []
+        while True:
+            l = self.readline()
+            if l == '':
+                return lineas
+            lineas.append(l)
+
+    def inWaiting(self):
+        return sum(len(l) for l in self.salida)
+
+    def close(self):
+        self.is_open = False
+
+    '''
+        Avanza el reloj simulado (y el real si se pidio)
+    '''
+    def esperar(self, t):
+        self.tiempo += t
+        if self.escala_real > 0:
+            time.sleep(t * self.escala_real)
+
+    '''
+        Ejecuta una linea de codigo G y agrega las respuestas a la salida
+    '''
+    def ejecutar(self, linea):
+        linea = re.sub('\(.*?\)', '', linea).strip().upper()
+        if linea == '':
+            self.salida.append('ok\r\n')
+            return
+        if linea == '$X':
+            self.bloqueado = False
+            self.salida.append('[Caution: Unlocked]\r\n')
+            self.salida.append('ok\r\n')
+            return
+        if self.bloqueado:
+            self.salida.append('error: Alarm lock\r\n')
+            return
+
+        palabras = re.findall(WORD_PATTERN, linea.replace(' ', ''))
+        destino = list(self.pos)
+        sondeo = False
+        pausa = None
+        for letra, valor in palabras:
+            if letra == '$':
+                continue
+            try:
+                v = float(valor)
+            except ValueError:
+                self.salida.append('error: Bad number format\r\n')
+                return
+            if letra == 'G':
+                if v in (0, 1, 2, 3):
+                    self.modo = 'G%d' % v
+                elif v == 38.2:
+                    sondeo = True
+                elif v == 90:
+                    self.absoluto = True
+                elif v == 91:
+                    self.absoluto = False
+                elif v == 20:
+                    self.escala = 25.4
+                elif v == 21:
+                    self.escala = 1.0
+                elif v == 4:
+                    pausa = 0.0
+            elif letra in 'XYZ':
+                i = 'XYZ'.index(letra)
+                v = v * self.escala
+                destino[i] = v if self.absoluto else self.pos[i] + v
+            elif letra == 'F':
+                self.avance = v * self.escala
+            elif letra == 'P' and pausa != None:
+                pausa = v
+
+        if pausa != None:
+            self.esperar(pausa)
+        elif sondeo:
+            if not self.sondear(destino):
+                return
+        elif destino != self.pos:
+            self.mover(destino, self.modo == 'G0')
+        self.salida.append('ok\r\n')
+
+    '''
+        Mueve la maquina al destino y avanza el reloj. Los movimientos rapidos
+        limitan cada eje a su velocidad maxima, los demas usan el avance F.
+    '''
+    def mover(self, destino, rapido):
+        d = [abs(destino[i] - self.pos[i]) for i in range(3)]
+        if rapido:
+            t = max(d[0] / RAPID_XY, d[1] / RAPID_XY, d[2] / RAPID_Z)
+        else:
+            t = np.sqrt(d[0]**2 + d[1]**2 + d[2]**2) / max(self.avance, 1e-6)
+        self.pos = list(destino)
+        self.esperar(t * 60)
+
+    '''
+        Baja la herramienta hacia destino[2] hasta tocar la superficie en la
+        posicion actual. Devuelve False si no hubo contacto (alarma).
+    '''
+    def sondear(self, destino):
+        x, y, z = self.pos
+        contacto = self.z0 + self.superficie(x, y)
+        if self.ruido > 0:
+            contacto += self.aleatorio.normal(0, self.ruido)
+        self.sondeos += 1
+        if destino[2] > contacto:
+            # No hubo contacto: recorre todo el movimiento y queda en alarma
+            self.mover([x, y, destino[2]], False)
+            self.bloqueado = True
+            self.salida.append('ALARM: Probe fail\r\n')
+            self.salida.append('error: Alarm lock\r\n')
+            return False
+        self.mover([x, y, min(z, contacto)], False)
+        self.salida.append('[PRB:%.3f,%.3f,%.3f:1]\r\n' % (x, y, self.pos[2]))
+        return True
+
+
+'''
+    Programa principal: probing sobre el simulador con la rutina de probing.py
+'''
+if __name__ == '__main__':
+    import probing
+
+    args = sys.argv[1:]
+    if args and args[0] == '-r':
+        probing.PROBE_TWO_PHASE = True
+        args.pop(0)
+    mapa = probing.OUTPUT_FILE
+    if len(args) in [3, 5]:
+        mapa = args.pop()
+    if len(args) not in [2, 4]:
+        print 'Utilizacion correcta:'
+        print '\tpython grbl_sim.py [-r] <x> <y> [<dx> <dy>] [<mapa>]'
+        sys.exit(1)
+    length_x, length_y = int(args[0]), int(args[1])
+    dx, dy = (int(args[2]), int(args[3])) if len(args) == 4 else (probing.DELTA_X, probing.DELTA_Y)
+
+    sim = GrblSimulator(superficieDesdeMapa(mapa))
+    puntos = probing.listaPuntos(abs(length_x / dx), abs(length_y / dy), dx, dy)
+    inicio = time.time()
+    # Sin archivo de sesion, para no dejar mapa_alturas.ses en el directorio actual
+    probing.realizarProbing(puntos, port=sim, filename='mapa_simulado.txt', sesion=None,
+                            cuadricula=(dx, dy))
+    print
+    print 'Puntos: %d' % len(puntos)
+    print 'Tiempo de maquina: %.1f s (%.2f s por punto)' % (sim.tiempo, sim.tiempo / len(puntos))
+    print 'Tiempo de ejecucion: %.3f s' % (time.time() - inicio)
+    print 'Bytes enviados: %d, recibidos: %d' % (sim.bytes_in, sim.bytes_out)
+    print 'Timeouts: %d, desbordes del buffer: %d' % (sim.timeouts, sim.desbordes)
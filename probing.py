@@ -11,34 +11,147 @@
 
 import serial
 import re
+from collections import deque, namedtuple
 import sys
 import os
+import time
+import json
+import csv
+import hashlib
+import cPickle
+import tempfile
+import glob
+import multiprocessing
+import threading
+import Queue
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import cm
 from scipy import interpolate
+from scipy import ndimage
+from scipy import spatial
 
 # Datos por defecto para la cuadricula
 DELTA_X = -10 # 1cm
 DELTA_Y = 10
 MILL_DEPTH = 0.100
 
-# Patrón de captura de alturas devuelto por GRBL
-PROBE_PATTERN = '\[PRB:[-\d.]+,[-\d.]+,([-\d.]+)\]'
+# Altura de retracción, profundidad máxima y avances (mm/min) de cada punto de probing
+PROBE_Z_SAFE = 1.000
+PROBE_Z_MIN = -20.000
+RETRACT_FEED = 95.00
+PROBE_FEED = 30.00
+# Probing en dos fases (ver sondearPuntos): búsqueda rápida a PROBE_SEEK_FEED, retroceso
+# de PROBE_BACKOFF y lectura lenta a PROBE_FEED. Entre nodos vecinos sube PROBE_RETRACT sobre
+# la lectura anterior y busca hasta PROBE_SEEK_MARGIN por debajo de ella.
+PROBE_TWO_PHASE = False
+PROBE_SEEK_FEED = 200.00
+PROBE_BACKOFF = 0.200
+PROBE_RETRACT = 0.500
+PROBE_SEEK_MARGIN = 2.000
+# Probing concurrente con la preparación del archivo a nivelar (ver probingConcurrente)
+PROBE_CONCURRENT = False
+# Revisión de lecturas (ver revisarLecturas): los puntos que difieren más de
+# PROBE_OUTLIER_TOLERANCE (mm) de la superficie de sus vecinos se sondean hasta tener
+# PROBE_SAMPLES lecturas y se usa la mediana, durante PROBE_RECHECK_BUDGET s como máximo
+PROBE_RECHECK = False
+PROBE_SAMPLES = 3
+PROBE_OUTLIER_TOLERANCE = 0.030
+PROBE_RECHECK_BUDGET = 60.0
+# Puntos ya medidos que se vuelven a sondear al reanudar una sesión y diferencia
+# máxima (mm) aceptada con su lectura anterior (ver verificarSesion)
+RESUME_CHECKS = 2
+RESUME_TOLERANCE = 0.020
+# Tolerancia (mm) y número máximo de divisiones por celda del probing adaptativo (las
+# celdas que siguen sobre la tolerancia al llegar al máximo se informan al terminar)
+ADAPTIVE_TOLERANCE = 0.010
+ADAPTIVE_LEVELS = 3
+# Modelo de la superficie para nivelar (ver MODELOS), grado del modelo polinomial y
+# número máximo de centros y de puntos evaluados por vez del modelo RBF
+SURFACE_MODEL = 'bilineal'
+POLY_DEGREE = 2
+RBF_MAX_CENTERS = 144
+RBF_CHUNK = 4096
+# Tablas de alturas (ver tablaAlturas): resolución (mm) al nivelar con un mapa guardado,
+# None para no usarlas, resoluciones del reporte de precisión y directorio donde se guardan
+LUT_RESOLUTION = None
+LUT_RESOLUTIONS = (1.0, 0.5, 0.2, 0.1, 0.05)
+LUT_DIR = 'tablas_alturas'
+# Error máximo (mm) entre cada cuerda y el arco G2/G3 que reemplaza al nivelar
+ARC_TOLERANCE = 0.005
+# Diferencia de ángulo (rad) bajo la cual un arco es un círculo completo (igual que GRBL)
+ARC_EPSILON = 5e-7
+# Error máximo (mm) al unir movimientos colineales del archivo nivelado (ver compactarArchivo)
+MERGE_TOLERANCE = 0.002
+# Velocidades máximas de los ejes X, Y en G0 (mm/min), para estimar el tiempo de las rutas
+RAPID_X = 500.0
+RAPID_Y = 500.0
 
-# Patrón de reemplazo para archivos de código G
-# Encuentra los códigos G1 que van hacia un punto X, Y
-G1_PATTERN = 'G1 X([-0-9.]+) Y([-0-9.]+)'
-# Encuentra los códigos G0 X# Y# y luego G1 Z# (rápido hacia coord. (X,Y) y baja la herramienta)
-G0Z_PATTERN = 'G0 X([-0-9.]+) Y([-0-9.]+)\nG1 Z([-0-9.]+)'
+# Patrón de captura de las coordenadas devueltas por GRBL
+# (con la bandera de contacto ':1' opcional de GRBL 0.9j)
+PROBE_PATTERN = '\[PRB:([-\d.]+),([-\d.]+),([-\d.]+)(?::(\d))?\]'
+
+# Palabras de una línea de código G (letra y número) y comentarios entre paréntesis o tras ';'
+WORD_RE = re.compile('([A-Za-z])\s*([-+]?[0-9]*\.?[0-9]+)')
+COMMENT_RE = re.compile('\(.*?\)|;.*')
+# Palabra Z (altura a reemplazar), hasta la última palabra X o Y (la altura se agrega después) y avance
+Z_RE = re.compile('[Zz]\s*[-+]?[0-9]*\.?[0-9]+')
+XY_RE = re.compile('.*[XxYy]\s*[-+]?[0-9]*\.?[0-9]+')
+F_RE = re.compile('[Ff]\s*([-+]?[0-9]*\.?[0-9]+)')
+# Centro de un arco (I, J o R, se reemplaza al linealizarlo) y modo de movimiento de una línea
+IJR_RE = re.compile('\s*[IiJjRr]\s*[-+]?[0-9]*\.?[0-9]+')
+MODO_RE = re.compile('[Gg]\s*0*[0-3](?![0-9.])')
+# Línea con solo un movimiento G0/G1 y coordenadas X, Y, Z (se puede eliminar al compactar)
+SIMPLE_RE = re.compile('\s*([Gg]\s*0*[01]\s*)?([XxYyZz]\s*[-+]?[0-9]*\.?[0-9]+\s*)+$')
+# Igual, pero con avance (puede terminar un tramo de movimientos unidos)
+MOVIMIENTO_RE = re.compile('\s*([Gg]\s*0*[01]\s*)?([XxYyZzFf]\s*[-+]?[0-9]*\.?[0-9]+\s*)+$')
+# Número con decimales de una palabra, para quitar los ceros sobrantes
+DECIMAL_RE = re.compile('([A-Za-z]\s*)([-+]?[0-9]*\.[0-9]*)')
+# Coordenadas relativas
+G91_RE = re.compile('[Gg]\s*0*91(?![0-9.])')
+# Códigos G que mueven la máquina fuera del programa (home, sondeo, coordenadas
+# de máquina) o cambian el origen: después de ellos la posición es desconocida
+G_ESPECIALES = (28, 30, 38.2, 38.3, 38.4, 38.5, 53, 92)
+# Códigos de los modos de movimiento, para no convertirlos a número en cada línea
+G_MODOS = {'0': 0, '00': 0, '1': 1, '01': 1, '2': 2, '02': 2, '3': 3, '03': 3}
+
+# Movimiento de una línea de código G (ver interpretarLineas)
+Movimiento = namedtuple('Movimiento', 'linea tipo x0 y0 z0 x1 y1 z1 avance i j absoluto')
+# Bloque de líneas con los puntos a nivelar, antes de evaluar el mapa (ver prepararBloque)
+BloquePreparado = namedtuple('BloquePreparado', 'lineas nivelar xs ys intermedios centros')
+
+# Número de líneas de código G que se nivelan por bloque
+BLOCK_LINES = 10000
+# Bloques preparados que se guardan en memoria al nivelar durante el probing, los
+# siguientes esperan sus lecturas en un archivo temporal (ver NiveladoIncremental)
+INCREMENTAL_BLOCKS = 16
+# Tamaño mínimo (bytes) de cada trozo de archivo al nivelar en paralelo
+CHUNK_BYTES = 1 << 20
+# Tamaño (bytes) del buffer de escritura de los archivos nivelados
+WRITE_BUFFER = 1 << 20
 
 # Archivo de salida por defecto para puntos X, Y, Z del mapa de alturas.
 OUTPUT_FILE = 'mapa_alturas.txt'
+# Archivo binario por defecto del mapa de alturas (ver guardarMalla)
+MAP_FILE = 'mapa_alturas.map'
+# Archivo por defecto de la sesión de probing, para reanudarlo (ver abrirSesion)
+SESSION_FILE = 'mapa_alturas.ses'
+# Primera línea de los archivos binarios de mapa de alturas
+MAP_MAGIC = 'HPMAP1\n'
+# Extensión que se agrega al archivo de código G para guardar su índice por celdas
+INDEX_EXT = '.idx.npz'
+# Versión del índice por celdas, los índices guardados con otra versión se rehacen
+INDEX_VERSION = 1
+# Líneas sin cambios entre dos tramos a nivelar de nuevo por debajo de las cuales
+# se nivelan juntos (ver renivelarArchivo)
+RELEVEL_GAP = 64
 
 # Puerto serial para GRBL
 SERIAL_PORT = 'COM3'
 BAUDRATE = 115200
+# Tamaño del buffer de recepción serial de GRBL
+RX_BUFFER_SIZE = 127
 
 
 '''
@@ -61,6 +174,611 @@ def listaPuntos(l, h, dx=DELTA_X, dy=DELTA_Y):
             direccion = 0
     return puntos
 
+'''
+    Devuelve el tiempo (min) del movimiento rápido entre los puntos a y b
+    (arreglos de [x, y] compatibles). Cada eje se mueve de forma independiente,
+    por lo que el tiempo es el del eje que más tarda.
+'''
+def tiempoViaje(a, b, vx=RAPID_X, vy=RAPID_Y):
+    d = np.abs(np.asarray(a, dtype=float) - np.asarray(b, dtype=float))
+    return np.maximum(d[..., 0] / vx, d[..., 1] / vy)
+
+'''
+    Estima el tiempo total (s) de probing de los puntos en el orden dado: en cada
+    punto retrae a PROBE_Z_SAFE, viaja en G0 y baja con G38.2 hasta la superficie (z=0).
+'''
+def tiempoRuta(puntos, vx=RAPID_X, vy=RAPID_Y):
+    p = np.array(puntos, dtype=float).reshape(-1, 2)
+    viaje = tiempoViaje(p[:-1], p[1:], vx, vy).sum()
+    z = PROBE_Z_SAFE / RETRACT_FEED + PROBE_Z_SAFE / PROBE_FEED
+    return 60 * (viaje + len(p) * z)
+
+'''
+    Ordena los puntos de probing para minimizar el tiempo de viaje entre ellos.
+    Construye una ruta por vecino más cercano y la mejora con 2-opt (invirtiendo
+    tramos de la ruta) hasta que no haya mejora o se cumpla max_tiempo (s).
+    El primer punto de la lista se mantiene primero, ya que es la referencia (0,0).
+    El tiempo de retracción y bajada es el mismo en cualquier orden, por lo que
+    solo se minimiza el viaje en G0 (ver tiempoViaje).
+
+    Devuelve la lista de puntos ordenada, o la original si ya era mejor
+    (e.g. el zig-zag de listaPuntos sobre una cuadrícula completa).
+'''
+def planearRuta(puntos, vx=RAPID_X, vy=RAPID_Y, max_tiempo=0.5):
+    p = np.array(puntos, dtype=float).reshape(-1, 2)
+    n = len(p)
+    if n < 4:
+        return list(puntos)
+    inicio = time.time()
+
+    # Ruta inicial por vecino más cercano a partir del primer punto
+    orden = np.zeros(n, dtype=int)
+    libre = np.ones(n, dtype=bool)
+    libre[0] = False
+    for k in range(1, n):
+        t = tiempoViaje(p[orden[k-1]], p, vx, vy)
+        t[~libre] = np.inf
+        orden[k] = np.argmin(t)
+        libre[orden[k]] = False
+
+    # 2-opt: invertir el tramo i+1..j si las aristas (i,j) y (i+1,j+1) son más cortas
+    # que (i,i+1) y (j,j+1). La ruta es abierta, el último punto no tiene arista (j+1).
+    mejora = True
+    while mejora and time.time() - inicio < max_tiempo:
+        mejora = False
+        q = p[orden]
+        for i in range(n - 2):
+            if time.time() - inicio > max_tiempo:
+                break
+            a = q[i]
+            b = q[i+1]
+            c = q[i+2:]
+            d = q[i+3:]
+            delta = (tiempoViaje(a, c, vx, vy) + np.append(tiempoViaje(b, d, vx, vy), 0)
+                     - tiempoViaje(a, b, vx, vy) - np.append(tiempoViaje(c[:-1], d, vx, vy), 0))
+            j = np.argmin(delta)
+            if delta[j] < -1e-12:
+                j += i + 2
+                orden[i+1:j+1] = orden[i+1:j+1][::-1].copy()
+                q = p[orden]
+                mejora = True
+
+    ruta = [puntos[k] for k in orden]
+    if tiempoRuta(ruta, vx, vy) < tiempoRuta(puntos, vx, vy):
+        return ruta
+    return list(puntos)
+
+'''
+    Abre el puerto serial especificado. Si port no es un nombre, se asume que ya
+    es un puerto abierto (serial.Serial o grbl_sim.GrblSimulator) y se devuelve tal cual.
+    Los nombres 'sim' o 'sim:<mapa>' abren el simulador de GRBL, con una placa
+    plana o con la superficie del archivo de puntos <mapa>. Con None se usa
+    SERIAL_PORT (que se puede cambiar con la opción -S).
+'''
+def abrirPuerto(port, baudrate=BAUDRATE):
+    if port == None:
+        port = SERIAL_PORT
+    if not isinstance(port, basestring):
+        return port
+    if port.split(':')[0] == 'sim':
+        import grbl_sim
+        superficie = None
+        if ':' in port:
+            superficie = grbl_sim.superficieDesdeMapa(port.split(':', 1)[1])
+        return grbl_sim.GrblSimulator(superficie, timeout=2)
+    return serial.Serial(port, baudrate, timeout=2)
+
+'''
+    Registra la telemetría de una ejecución: el instante en que se envía cada G38.2,
+    en que llega su lectura [PRB] y su 'ok', los bytes enviados y recibidos por el
+    puerto, el tiempo esperando respuestas en readline, los timeouts y la duración
+    de cada etapa (probing, modelo, nivelado...). Los tiempos son en segundos desde
+    la creación del objeto.
+    Se pasa como parámetro 'telemetria' a GrblSender, realizarProbing, rutinaGeneral,
+    etc. Con None (por defecto) no se registra nada ni se mide ningún tiempo.
+
+    reloj -> función que devuelve el tiempo actual, e.g. el reloj simulado de
+             grbl_sim.GrblSimulator (lambda: sim.tiempo)
+'''
+class Telemetria(object):
+    def __init__(self, reloj=time.time):
+        self.reloj = reloj
+        self.inicio = reloj()
+        self.fecha = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.sondeos = [] # un diccionario por cada G38.2 enviado
+        self.en_curso = deque() # sondeos enviados aún sin confirmar
+        self.etapas = [] # (etapa, inicio, duración)
+        self.etapa = None # (etapa, inicio) de la etapa actual
+        self.bytes_enviados = 0
+        self.bytes_recibidos = 0
+        self.timeouts = 0
+        self.espera = 0.0 # tiempo total dentro de readline
+
+    def tiempo(self):
+        return self.reloj() - self.inicio
+
+    '''
+        Comienza una etapa, terminando la anterior si no se terminó
+    '''
+    def iniciarEtapa(self, nombre):
+        self.terminarEtapa()
+        self.etapa = (nombre, self.tiempo())
+
+    def terminarEtapa(self):
+        if self.etapa != None:
+            nombre, inicio = self.etapa
+            self.etapas.append((nombre, inicio, self.tiempo() - inicio))
+            self.etapa = None
+
+    '''
+        Registra una línea escrita en el puerto
+    '''
+    def enviado(self, linea):
+        self.bytes_enviados += len(linea)
+        if 'G38' in linea.upper():
+            sondeo = {'comando': linea.strip(), 'enviado': self.tiempo(), 'prb': None, 'ok': None,
+                      'x': None, 'y': None, 'z': None, 'contacto': False}
+            self.sondeos.append(sondeo)
+            self.en_curso.append(sondeo)
+
+    '''
+        Lee una línea del puerto midiendo la espera, los bytes y los timeouts
+    '''
+    def leer(self, puerto):
+        inicio = self.reloj()
+        l = puerto.readline()
+        self.espera += self.reloj() - inicio
+        self.bytes_recibidos += len(l)
+        if l == '':
+            self.timeouts += 1
+        return l
+
+    '''
+        Registra una lectura [PRB:x,y,z] del sondeo en curso
+    '''
+    def lecturaPRB(self, x, y, z, contacto):
+        if self.en_curso:
+            sondeo = self.en_curso[0]
+            sondeo.update(prb=self.tiempo(), x=x, y=y, z=z, contacto=contacto)
+
+    '''
+        Registra la confirmación ('ok' o error) del sondeo en curso
+    '''
+    def sondeoConfirmado(self, ok):
+        if self.en_curso:
+            sondeo = self.en_curso.popleft()
+            sondeo['ok'] = self.tiempo()
+            if not ok:
+                sondeo['contacto'] = False
+
+    '''
+        Devuelve un diccionario con toda la telemetría. Cada sondeo incluye además
+        'ciclo', el tiempo desde la confirmación del sondeo anterior (subida,
+        traslado y bajada), y 'respuesta', desde su envío hasta su confirmación.
+    '''
+    def resumen(self):
+        self.terminarEtapa()
+        sondeos = []
+        anterior = None
+        for s in self.sondeos:
+            s = dict(s)
+            s['respuesta'] = s['ok'] - s['enviado'] if s['ok'] != None else None
+            s['ciclo'] = s['ok'] - anterior if s['ok'] != None and anterior != None else None
+            anterior = s['ok'] if s['ok'] != None else anterior
+            sondeos.append(s)
+        ciclos = [s['ciclo'] for s in sondeos if s['ciclo'] != None]
+        return {'fecha': self.fecha, 'duracion': self.tiempo(),
+                'bytes_enviados': self.bytes_enviados, 'bytes_recibidos': self.bytes_recibidos,
+                'timeouts': self.timeouts, 'espera_lectura': self.espera,
+                'ciclo_medio': sum(ciclos) / len(ciclos) if ciclos else None,
+                'etapas': [{'etapa': e, 'inicio': i, 'duracion': d} for e, i, d in self.etapas],
+                'sondeos': sondeos}
+
+    '''
+        Guarda la telemetría en filename. Con extensión .csv escribe una fila por
+        sondeo y las etapas en otro archivo .etapas.csv, si no la guarda en JSON.
+    '''
+    def exportar(self, filename):
+        resumen = self.resumen()
+        if not filename.lower().endswith('.csv'):
+            f = open(filename, 'w')
+            json.dump(resumen, f, indent=2, sort_keys=True)
+            f.close()
+            return
+        columnas = ['comando', 'enviado', 'prb', 'ok', 'respuesta', 'ciclo', 'x', 'y', 'z', 'contacto']
+        f = open(filename, 'wb')
+        w = csv.DictWriter(f, columnas)
+        w.writeheader()
+        w.writerows(resumen['sondeos'])
+        f.close()
+        f = open(opt_name(filename, '.etapas'), 'wb')
+        w = csv.DictWriter(f, ['etapa', 'inicio', 'duracion'])
+        w.writeheader()
+        w.writerows(resumen['etapas'])
+        f.close()
+
+'''
+    Envía comandos a GRBL utilizando el protocolo de conteo de caracteres.
+    Lleva la cuenta de los bytes enviados que aún no han sido confirmados con
+    'ok' o 'error' y no envía un comando hasta que quepa en el buffer de
+    recepción de GRBL (RX_BUFFER_SIZE). Cada respuesta se asocia al comando que
+    la produjo y las lecturas [PRB:x,y,z] se guardan en 'sondeos' en el orden
+    de los comandos con G38.x enviados.
+
+    puerto -> objeto serial.Serial (o equivalente) ya abierto
+    rx_size -> tamaño del buffer de recepción de GRBL
+    pattern -> Patron para detectar la lectura obtenida por GRBL para la funcion G38.2
+    telemetria -> objeto Telemetria donde se registra la comunicación, None para no registrarla
+'''
+class GrblSender(object):
+    def __init__(self, puerto, rx_size=RX_BUFFER_SIZE, pattern=PROBE_PATTERN, telemetria=None):
+        self.puerto = puerto
+        self.telemetria = telemetria
+        self.rx_size = rx_size
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self.pendientes = deque() # comandos enviados sin confirmar
+        self.en_buffer = 0 # bytes enviados sin confirmar
+        self.ultimoPRB = None # última lectura recibida antes del 'ok' del G38.2
+        self.sondeos = deque() # (comando, (x,y,z) o None si falló) de cada G38.2 confirmado
+        self.errores = [] # (comando, respuesta) de cada comando con error
+        self.mensajes = [] # otras líneas recibidas (alarmas, avisos, respuestas sin comando pendiente)
+        self.timeouts = 0 # lecturas del puerto sin respuesta
+
+    '''
+        Envía un comando, esperando las respuestas necesarias para que quepa en el buffer
+    '''
+    def enviar(self, comando):
+        linea = comando.strip() + '\n'
+        while self.pendientes and self.en_buffer + len(linea) > self.rx_size:
+            self.leerRespuesta()
+        self.puerto.write(linea)
+        if self.telemetria != None:
+            self.telemetria.enviado(linea)
+        self.pendientes.append(linea)
+        self.en_buffer += len(linea)
+
+    '''
+        Lee una línea del puerto y la procesa. Devuelve la línea leída o None si
+        se agotó el tiempo de espera del puerto.
+    '''
+    def leerRespuesta(self):
+        l = self.puerto.readline() if self.telemetria == None else self.telemetria.leer(self.puerto)
+        if l == '':
+            self.timeouts += 1
+            return None
+        l = l.strip()
+        if (l == 'ok' or l.startswith('error')) and not self.pendientes:
+            # Respuesta sin comando pendiente, e.g. a un $X o reset enviado fuera de enviar
+            self.mensajes.append(l)
+        elif l == 'ok' or l.startswith('error'):
+            # La respuesta corresponde al comando más antiguo sin confirmar
+            comando = self.pendientes.popleft()
+            self.en_buffer -= len(comando)
+            comando = comando.strip()
+            if l != 'ok':
+                self.errores.append((comando, l))
+            if 'G38' in comando.upper():
+                self.sondeos.append((comando, self.ultimoPRB if l == 'ok' else None))
+                self.ultimoPRB = None
+                if self.telemetria != None:
+                    self.telemetria.sondeoConfirmado(l == 'ok')
+        else:
+            result = self.pattern.match(l)
+            if result != None:
+                # El cuarto valor (GRBL 0.9j) indica si hubo contacto
+                x, y, z, contacto = result.groups()
+                self.ultimoPRB = (float(x), float(y), float(z)) if contacto != '0' else None
+                if self.telemetria != None:
+                    self.telemetria.lecturaPRB(float(x), float(y), float(z), contacto != '0')
+            elif l != '':
+                self.mensajes.append(l)
+        return l
+
+    '''
+        Lee respuestas hasta que todos los comandos enviados estén confirmados
+    '''
+    def esperar(self):
+        while self.pendientes:
+            self.leerRespuesta()
+
+'''
+    Abre el puerto serial, desbloquea GRBL y lo configura en coordenadas absolutas
+    y milímetros. Devuelve el GrblSender conectado al puerto.
+    telemetria -> objeto Telemetria para registrar la comunicación (ver GrblSender)
+'''
+def conectarGrbl(port=None, baudrate=BAUDRATE, pattern=PROBE_PATTERN, telemetria=None):
+    # Abrir el puerto serial
+    print 'Iniciando conexion con puerto serial...'
+    puerto = abrirPuerto(port, baudrate)
+    resp = puerto.readlines()
+    for l in resp:
+        print l,
+    grbl = GrblSender(puerto, pattern=pattern, telemetria=telemetria)
+    # Desbloquear
+    grbl.enviar('$X')
+    grbl.esperar()
+    for l in grbl.mensajes:
+        print l
+    grbl.enviar('G90')
+    grbl.enviar('G21')
+    return grbl
+
+'''
+    Envía los comandos para sondear un punto en dos fases: baja rápido con G38.2 a
+    PROBE_SEEK_FEED hasta tocar, retrocede PROBE_BACKOFF y vuelve a bajar a PROBE_FEED
+    para la lectura precisa (hasta PROBE_SEEK_MARGIN por debajo, por si la primera
+    lectura fue errónea). Si la herramienta está sobre la lectura correcta de un nodo
+    vecino (ver sondearPuntos), solo sube PROBE_RETRACT sobre ella para trasladarse y busca
+    la superficie a partir de esa altura; si no, sube a PROBE_Z_SAFE y busca hasta PROBE_Z_MIN.
+    Los movimientos en Z son relativos (G91), ya que las lecturas [PRB] están en
+    coordenadas de la máquina. Devuelve la cantidad de comandos G38.2 enviados.
+'''
+def enviarSondeoDosFases(grbl, punto, sobre_anterior):
+    if sobre_anterior:
+        grbl.enviar('G91 G0 Z%-4.3f' % PROBE_RETRACT)
+        grbl.enviar('G90 G0 X%-4.3f Y%-4.3f' % (punto[0], punto[1]))
+        grbl.enviar('G91 G38.2 Z%-4.3f F%-4.2f' % (-(PROBE_RETRACT + PROBE_SEEK_MARGIN), PROBE_SEEK_FEED))
+    else:
+        grbl.enviar('G1 Z%-4.3f F%-4.2f' % (PROBE_Z_SAFE, RETRACT_FEED))
+        grbl.enviar('G0 X%-4.3f Y%-4.3f' % (punto[0], punto[1]))
+        grbl.enviar('G38.2 Z%-4.3f F%-4.2f' % (PROBE_Z_MIN, PROBE_SEEK_FEED))
+        grbl.enviar('G91')
+    grbl.enviar('G0 Z%-4.3f' % PROBE_BACKOFF)
+    grbl.enviar('G38.2 Z%-4.3f F%-4.2f' % (-(PROBE_BACKOFF + PROBE_SEEK_MARGIN), PROBE_FEED))
+    grbl.enviar('G90')
+    return 2
+
+'''
+    Hace probing de cada punto de la lista utilizando el GrblSender conectado.
+    Los movimientos del siguiente punto quedan en el buffer de GRBL mientras se
+    espera la lectura del punto actual.
+    Guarda cada altura (relativa a la referencia) en el diccionario probemap y en
+    el archivo abierto f, y devuelve la referencia (la lectura del punto (0,0)).
+
+    grbl -> GrblSender devuelto por conectarGrbl
+    puntos -> lista de tuplas, e.g. [(x0, y0), (x1, y1), ..., (xi, yj)]
+    ref -> lectura del punto (0,0) si ya se obtuvo en una llamada anterior
+    dos_fases -> sondear en dos fases (ver enviarSondeoDosFases), por defecto PROBE_TWO_PHASE
+    lecturas -> si se especifica, diccionario punto -> lista donde se agregan las
+                lecturas sin la referencia (ver revisarLecturas)
+    sesion -> archivo de sesión abierto (ver abrirSesion) donde se guarda cada lectura
+    avisar -> función avisar(punto, z, ref) que se llama con cada lectura sin la referencia
+    cuadricula -> (dx, dy) de la cuadrícula de los puntos. En dos fases solo se sube
+                  PROBE_RETRACT entre puntos si el anterior es un nodo vecino (a no más de
+                  dx en X y dy en Y) y su lectura fue correcta, por lo que se espera su
+                  lectura antes de enviar el siguiente. None para hacerlo solo al repetir
+                  el mismo punto (ver revisarLecturas).
+    f puede ser None para no escribir las alturas.
+'''
+def sondearPuntos(grbl, puntos, probemap, f, ref=None, dos_fases=None, lecturas=None, sesion=None,
+                  avisar=None, cuadricula=None):
+    if dos_fases == None:
+        dos_fases = PROBE_TWO_PHASE
+    dx, dy = cuadricula if cuadricula != None else (0, 0)
+    def vecinos(a, b):
+        return abs(a[0] - b[0]) <= abs(dx) + 1e-6 and abs(a[1] - b[1]) <= abs(dy) + 1e-6
+    enEspera = deque() # (punto, cantidad de lecturas) enviados que esperan su lectura
+    anterior = None # (punto, lectura correcta) del último punto leído
+    i = 0
+    while i < len(puntos) or enEspera:
+        # Antes de acercarse a la lectura del nodo vecino hay que saber si fue correcta
+        esperar = dos_fases and 0 < i < len(puntos) and enEspera and vecinos(puntos[i-1], puntos[i])
+        if i < len(puntos) and not esperar:
+            punto = puntos[i]
+            print 'Probando el punto (%-4.3f,%-4.3f)' % (punto[0], punto[1])
+            if dos_fases:
+                sobre_anterior = i > 0 and anterior == (puntos[i-1], True) and vecinos(puntos[i-1], punto)
+                enEspera.append((punto, enviarSondeoDosFases(grbl, punto, sobre_anterior)))
+            else:
+                grbl.enviar('G1 Z%-4.3f F%-4.2f' % (PROBE_Z_SAFE, RETRACT_FEED))
+                grbl.enviar('G0 X%-4.3f Y%-4.3f' % (punto[0], punto[1]))
+                grbl.enviar('G38.2 Z%-4.3f F%-4.2f' % (PROBE_Z_MIN, PROBE_FEED))
+                enEspera.append((punto, 1))
+            i += 1
+        else:
+            # Ya se enviaron todos los puntos o se espera la lectura del vecino
+            grbl.leerRespuesta()
+
+        # Guardar las lecturas recibidas, en el orden en que se enviaron los puntos.
+        # En dos fases la altura es la de la última lectura (la lenta)
+        while enEspera and len(grbl.sondeos) >= enEspera[0][1]:
+            punto, n = enEspera.popleft()
+            prbs = [grbl.sondeos.popleft()[1] for k in range(n)]
+            prb = prbs[-1] if None not in prbs else None
+            anterior = (punto, prb != None)
+            if prb == None:
+                print 'Error en la lectura del punto (%-4.3f,%-4.3f)' % (punto[0], punto[1])
+                continue
+            # Leer la profundidad recibida
+            depth = prb[2]
+            if lecturas != None:
+                lecturas.setdefault(punto, []).append(depth)
+            # Si el punto es (0,0) utilizarlo como referencia z=0
+            if punto == (0,0):
+                ref = depth
+
+            if sesion != None:
+                registrarLectura(sesion, punto, depth, ref)
+            if avisar != None:
+                avisar(punto, depth, ref)
+
+            # Obtener cada profundidad a partir de la referencia
+            depth = depth - ref
+            # Guardar la altura del punto en el diccionario e imprimirla en pantalla y al archivo
+            probemap[punto] = depth
+            print '(%-4.3f,%-4.3f) ->' % (punto[0], punto[1]), depth
+            if f != None:
+                f.write('%-4.3f\t%-4.3f\t%-4.3f\n' % (punto[0], punto[1], depth))
+    return ref
+
+'''
+    Busca las lecturas sospechosas del mapa de alturas (polvo, óxido...): ajusta por
+    mínimos cuadrados una superficie cuadrática a los k puntos medidos más cercanos a
+    cada punto y calcula la diferencia entre su altura y la de la superficie. Como la
+    curvatura de una placa combada da diferencias parecidas en puntos cercanos, la de
+    cada punto se compara con la mediana de las de sus vecinos. Devuelve los puntos
+    que se apartan de ella más de tolerancia, ordenados de mayor a menor diferencia.
+'''
+def lecturasSospechosas(probeMap, tolerancia=PROBE_OUTLIER_TOLERANCE, k=12):
+    puntos = list(probeMap.keys())
+    if len(puntos) < 4:
+        return []
+    xy = np.array(puntos, dtype=float)
+    z = np.array([probeMap[p] for p in puntos])
+    k = min(k, len(puntos) - 1)
+    vecinos = [v[v != n][:k] for n, v in enumerate(spatial.cKDTree(xy).query(xy, k + 1)[1])]
+    residuos = np.zeros(len(puntos))
+    for n in range(len(puntos)):
+        v = vecinos[n]
+        # Superficie centrada en el punto: el término independiente es la altura esperada
+        # (con pocos vecinos se ajusta un plano)
+        d = xy[v] - xy[n]
+        A = np.column_stack([np.ones(len(v)), d])
+        if len(v) >= 8:
+            A = np.column_stack([A, d**2, d[:, 0] * d[:, 1]])
+        residuos[n] = z[n] - np.linalg.lstsq(A, z[v], rcond=None)[0][0]
+    sospechosas = []
+    for n in range(len(puntos)):
+        e = abs(residuos[n] - np.median(residuos[vecinos[n]]))
+        if e > tolerancia:
+            sospechosas.append((e, puntos[n]))
+    return [p for e, p in sorted(sospechosas, reverse=True)]
+
+'''
+    Revisa las lecturas sospechosas del mapa sin repetir todo el probing: sondea de
+    nuevo el punto más sospechoso hasta tener 'muestras' lecturas y su altura pasa a
+    ser la mediana de ellas, y vuelve a buscar, hasta que no queden puntos
+    sospechosos sin revisar o pasen 'presupuesto' segundos. Si se revisa el punto
+    (0,0) las demás alturas se corrigen con la nueva referencia.
+
+    lecturas -> diccionario punto -> lecturas sin la referencia (ver sondearPuntos)
+    reloj -> función que devuelve el tiempo actual (ver Telemetria)
+
+    Devuelve la referencia y la lista de puntos revisados.
+'''
+def revisarLecturas(grbl, probemap, lecturas, ref, tolerancia=PROBE_OUTLIER_TOLERANCE, muestras=PROBE_SAMPLES,
+                    presupuesto=PROBE_RECHECK_BUDGET, reloj=time.time):
+    inicio = reloj()
+    revisados = []
+    while True:
+        pendientes = [p for p in lecturasSospechosas(probemap, tolerancia) if p not in revisados]
+        if not pendientes:
+            break
+        if reloj() - inicio >= presupuesto:
+            print 'Se agoto el tiempo de revision, quedan %d lecturas sospechosas' % len(pendientes)
+            break
+        punto = pendientes[0]
+        print 'Lectura sospechosa en (%-4.3f,%-4.3f), repitiendo' % (punto[0], punto[1])
+        faltan = muestras - len(lecturas.get(punto, []))
+        if faltan > 0:
+            sondearPuntos(grbl, [punto] * faltan, {}, None, ref, lecturas=lecturas)
+        revisados.append(punto)
+        if not lecturas.get(punto):
+            continue
+        depth = float(np.median(lecturas[punto]))
+        if punto == (0,0) and ref != None:
+            # Nueva referencia: corregir todas las alturas
+            for p in probemap:
+                probemap[p] += ref - depth
+            ref = depth
+        probemap[punto] = depth - ref
+        print '(%-4.3f,%-4.3f) ->' % (punto[0], punto[1]), probemap[punto]
+    return ref, revisados
+
+'''
+    Regresa la máquina al origen, imprime los errores reportados por GRBL
+    y cierra el puerto serial.
+'''
+def desconectarGrbl(grbl):
+    # Regresar al origen
+    grbl.enviar('G1 Z%-4.3f F%-4.2f' % (PROBE_Z_SAFE, RETRACT_FEED))
+    grbl.enviar('G0 X0 Y0')
+    grbl.esperar()
+    for comando, error in grbl.errores:
+        print 'Error en %s: %s' % (comando, error)
+    # Cerrar el puerto serial
+    grbl.puerto.close()
+
+'''
+    Crea el archivo de sesión de un probing, donde se guarda cada lectura apenas se
+    recibe para poder reanudarlo si se interrumpe (ver verificarSesion). Es un archivo
+    de texto con un objeto JSON por línea: el primero con la lista de puntos en el
+    orden de probing y la fecha, y después uno por lectura con el punto, la lectura
+    z (coordenadas de la máquina) y la referencia ref con la que se midió.
+    Devuelve el archivo abierto.
+'''
+def abrirSesion(filename, puntos):
+    f = open(filename, 'w')
+    f.write(json.dumps({'puntos': [list(p) for p in puntos], 'fecha': time.strftime('%Y-%m-%d %H:%M:%S')}) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+    return f
+
+'''
+    Agrega una lectura al archivo de sesión y la escribe en el disco
+'''
+def registrarLectura(sesion, punto, z, ref):
+    sesion.write(json.dumps({'x': punto[0], 'y': punto[1], 'z': z, 'ref': ref}) + '\n')
+    sesion.flush()
+    os.fsync(sesion.fileno())
+
+'''
+    Lee un archivo de sesión. Devuelve la lista de puntos, el diccionario de alturas
+    relativas a la referencia de cada lectura (la última de cada punto), la lista
+    de puntos medidos en orden y la última referencia. Una última línea incompleta
+    (escritura interrumpida) se ignora.
+'''
+def leerSesion(filename):
+    f = open(filename, 'r')
+    cabecera = json.loads(f.readline())
+    puntos = [tuple(p) for p in cabecera['puntos']]
+    alturas = {}
+    orden = []
+    ref = None
+    for linea in f:
+        try:
+            lectura = json.loads(linea)
+        except ValueError:
+            break
+        punto = (lectura['x'], lectura['y'])
+        ref = lectura['ref']
+        alturas[punto] = lectura['z'] - ref
+        if punto in orden:
+            orden.remove(punto)
+        orden.append(punto)
+    f.close()
+    return puntos, alturas, orden, ref
+
+'''
+    Prepara la continuación de una sesión de probing interrumpida: vuelve a sondear
+    el punto (0,0) para obtener la nueva referencia y los últimos 'verificar' puntos
+    medidos, y compara sus alturas con las guardadas. Si alguno difiere más de
+    tolerancia (la placa o el origen se movieron) no se puede continuar.
+
+    Devuelve los puntos que faltan (en el orden original), el mapa de alturas ya
+    medido y la nueva referencia, o None si la verificación falla. Las lecturas
+    nuevas se agregan a la sesión.
+'''
+def verificarSesion(grbl, filename, verificar=RESUME_CHECKS, tolerancia=RESUME_TOLERANCE):
+    puntos, alturas, orden, ref = leerSesion(filename)
+    print 'Sesion %s: %d de %d puntos medidos' % (filename, len(alturas), len(puntos))
+    control = [p for p in orden if p != (0,0)][-verificar:] if verificar > 0 else []
+    nuevas = {}
+    ref = sondearPuntos(grbl, [(0,0)] + control, {}, None, lecturas=nuevas)
+    if (0,0) not in nuevas:
+        print 'No se pudo medir la referencia (0,0)'
+        return None
+    for p in control:
+        if p not in nuevas or abs(nuevas[p][-1] - ref - alturas[p]) > tolerancia:
+            print 'El punto (%-4.3f,%-4.3f) no coincide con la sesion, no se puede reanudar' % (p[0], p[1])
+            return None
+    f = open(filename, 'a')
+    for p in [(0,0)] + control:
+        registrarLectura(f, p, nuevas[p][-1], ref)
+        alturas[p] = nuevas[p][-1] - ref
+    f.close()
+    return [p for p in puntos if p not in alturas], alturas, ref
+
 '''
     Realiza el probing controlando el puerto serial especificado.
     Escribe en el archivo 'file' los puntos y devuelve un
@@ -72,71 +790,534 @@ def listaPuntos(l, h, dx=DELTA_X, dy=DELTA_Y):
     manual al punto que servirá como (0,0) y a cualquier altura.
 
     puntos -> lista de tuplas, e.g. [(x0, y0), (x1, y1), ..., (xi, yj)]
-    port, baudrate -> nombre y velocidad del puerto serial
+    port, baudrate -> nombre y velocidad del puerto serial (ver abrirPuerto)
     filename -> Archivo de salida para escribir los puntos (x,y,z) separados por '\t'
     pattern -> Patron para detectar la lectura obtenida por GRBL para la funcion G38.2
+    info -> Si se especifica, diccionario donde se guardan la referencia 'ref', el
+            avance 'avance' y la fecha 'fecha' del probing (ver guardarMalla)
+    telemetria -> objeto Telemetria para registrar los tiempos de cada sondeo
+    revisar -> volver a sondear las lecturas sospechosas (ver revisarLecturas),
+               por defecto PROBE_RECHECK
+    sesion -> archivo donde se guarda cada lectura para poder reanudar el probing
+              (ver abrirSesion), None para no guardarlas
+    reanudar -> continuar la sesión interrumpida guardada en 'sesion' (ver
+                verificarSesion), con sus puntos en lugar de 'puntos'. Devuelve None
+                si no se puede reanudar.
+    cuadricula -> (dx, dy) de la cuadrícula de los puntos (ver sondearPuntos)
 '''
-def realizarProbing(puntos, port=SERIAL_PORT, baudrate=BAUDRATE, pattern=PROBE_PATTERN, filename=OUTPUT_FILE):
-    # Abrir el puerto serial
-    print 'Iniciando conexion con puerto serial...'
-    puerto = serial.Serial(port, baudrate, timeout=2)
-    resp = puerto.readlines()
-    for l in resp:
-        print l,
-    # Desbloquear
-    puerto.write('$X\n')
-    resp = puerto.readlines()
-    for l in resp:
-        print l,
+def realizarProbing(puntos, port=None, baudrate=BAUDRATE, pattern=PROBE_PATTERN, filename=OUTPUT_FILE,
+                    info=None, telemetria=None, revisar=None, sesion=SESSION_FILE, reanudar=False,
+                    cuadricula=None):
+    if revisar == None:
+        revisar = PROBE_RECHECK
+    grbl = conectarGrbl(port, baudrate, pattern, telemetria)
 
-    # Abrir un archivo y guardar los puntos
+    # Continuar la sesión anterior o comenzar una nueva
     probemap = {}
+    lecturas = {}
+    ref = None
+    checkpoint = None
+    if reanudar:
+        continuacion = verificarSesion(grbl, sesion)
+        if continuacion == None:
+            desconectarGrbl(grbl)
+            return None
+        puntos, probemap, ref = continuacion
+        print 'Reanudando el probing, faltan %d puntos' % len(puntos)
+        checkpoint = open(sesion, 'a')
+    elif sesion != None:
+        checkpoint = abrirSesion(sesion, puntos)
+
+    # Abrir un archivo y guardar los puntos
     f = open(filename, 'w')
+    for p in probemap:
+        f.write('%-4.3f\t%-4.3f\t%-4.3f\n' % (p[0], p[1], probemap[p]))
 
     # Hacer probing para cada punto en la lista
-    puerto.write('G90\n')
-    puerto.write('G21\n')
-    for punto in puntos:
-        print 'Probando el punto (%-4.3f,%-4.3f)' % (punto[0], punto[1])
-        puerto.write('G1 Z1.000 F95.00\n')
-        puerto.write('G0 X%-4.3f Y%-4.3f\n' % (punto[0], punto[1]))
-        puerto.write('G38.2 Z-20.000 F30.00\n')
-        print 'Esperando lectura...',
-        # Leer lineas hasta obtener el patron esperado
-        while True:
-            # Lee la linea recibida por GRBL
-            l = puerto.readline()
-            # Ver si el patron coincide con el formato dado por G38.2
-            result = re.match(pattern, l, re.IGNORECASE)
-            # Si el patron coincide
-            if result != None:
-                # Leer la profundidad recibida
-                depth = float(result.groups()[0])
-                # Si el punto es (0,0) utilizarlo como referencia z=0
-                if punto == (0,0):
-                    ref = depth
-
-                # Obtener cada profundidad a partir de la referencia
-                depth = depth - ref
-                # Guardar la altura del punto en el diccionario e imprimirla en pantalla y al archivo
-                probemap[punto] = depth
-                print depth
-                f.write('%-4.3f\t%-4.3f\t%-4.3f\n' % (punto[0], punto[1], depth))
-                # Sale del ciclo infinito
-                break
+    ref = sondearPuntos(grbl, puntos, probemap, f, ref, lecturas=lecturas, sesion=checkpoint,
+                       cuadricula=cuadricula)
 
     # Fin del probing, cerrar el archivo
     f.close()
+    if revisar:
+        ref, revisados = revisarLecturas(grbl, probemap, lecturas, ref,
+                                         reloj=telemetria.reloj if telemetria != None else time.time)
+        if revisados:
+            escribirMapa(filename, probemap)
+            if checkpoint != None:
+                for p in revisados:
+                    registrarLectura(checkpoint, p, probemap[p] + ref, ref)
+    if checkpoint != None:
+        checkpoint.close()
     print 'Fin del probing...'
-    # Regresar al origen
-    puerto.write('G1 Z1.000 F95.00\n')
-    puerto.write('G0 X0 Y0\n')
-    # Cerrar el puerto serial
-    puerto.close()
+    desconectarGrbl(grbl)
+    if info != None:
+        info.update(ref=ref, avance=PROBE_FEED, fecha=time.strftime('%Y-%m-%d %H:%M:%S'))
 
     # Devolver el mapa de alturas
     return probemap
 
+'''
+    Nivela un archivo de código G por celdas a medida que llegan las lecturas del
+    probing (ver probingConcurrente). Los puntos de cada bloque preparado (prepararBloque)
+    se agrupan por la celda de dx*dy con la que BilinearGrid los evalúa, y se evalúan
+    apenas se midieron las cuatro esquinas de esa celda, ya que su altura solo depende
+    de ellas. Cada bloque se escribe, en el orden del archivo, cuando tiene todas sus
+    alturas. Los puntos de celdas cuyas esquinas no se miden se evalúan en terminar.
+    Para que la memoria no crezca con el archivo, solo se guardan 'memoria' bloques sin
+    escribir; los siguientes se guardan en un archivo temporal con la lista de sus
+    celdas y se evalúan al escribirlos, cuando todas ellas están completas.
+    salida -> archivo abierto donde se escriben las líneas niveladas
+    l, h, dx, dy -> cuadrícula del mapa de alturas
+    memoria -> bloques sin escribir que se guardan en memoria (por defecto INCREMENTAL_BLOCKS)
+    posiciones -> guardar el largo de cada línea escrita en 'largos', para nivelar de
+                  nuevo solo una parte del archivo si cambian lecturas (ver renivelarArchivo)
+'''
+class NiveladoIncremental(object):
+    def __init__(self, salida, l, h, dx=DELTA_X, dy=DELTA_Y, prof_fresado=MILL_DEPTH, memoria=None,
+                 posiciones=False):
+        if memoria == None:
+            memoria = INCREMENTAL_BLOCKS
+        self.salida = salida
+        self.prof_fresado = prof_fresado
+        self.memoria = memoria
+        self.largos = [] if posiciones else None
+        self.en_memoria = 0
+        self.temporal = None # archivo con los bloques que no se guardan en memoria
+        # Alturas medidas hasta ahora, las demás no se usan hasta que se miden
+        self.malla = BilinearGrid(np.zeros((l + 1, h + 1)), dx, dy)
+        self.medidos = np.zeros((l + 1, h + 1), dtype=bool)
+        self.completas = np.zeros((max(l, 1), max(h, 1)), dtype=bool)
+        # [bloque, alturas, cantidad de puntos sin evaluar] en el orden del archivo, o
+        # [None, (posición en el archivo temporal, celdas), cantidad] si no está en memoria
+        self.bloques = deque()
+        self.pendientes = {} # celda -> lista de ([bloque, alturas, cantidad], índices de los puntos)
+
+    '''
+        Agrega el siguiente bloque preparado del archivo y evalúa los puntos
+        que están en celdas completas.
+    '''
+    def agregarBloque(self, bloque):
+        if self.en_memoria >= self.memoria:
+            self.guardarBloque(bloque)
+            self.escribir()
+            return
+        entrada = [bloque, np.empty(len(bloque.xs)), 0]
+        self.bloques.append(entrada)
+        self.en_memoria += 1
+        if len(bloque.xs):
+            u, v, i, j = self.malla.celdas(bloque.xs, bloque.ys)
+            listos = self.completas[i, j]
+            if listos.any():
+                entrada[1][listos] = self.malla(bloque.xs[listos], bloque.ys[listos])
+            # Agrupar los demás puntos por celda
+            falta = np.flatnonzero(~listos)
+            entrada[2] = len(falta)
+            celda = i[falta] * self.completas.shape[1] + j[falta]
+            orden = np.argsort(celda, kind='mergesort')
+            celda, falta = celda[orden], falta[orden]
+            cortes = np.flatnonzero(np.diff(celda)) + 1
+            for c, idx in zip(celda[np.r_[0, cortes]] if len(celda) else [], np.split(falta, cortes)):
+                self.pendientes.setdefault(divmod(int(c), self.completas.shape[1]), []).append((entrada, idx))
+        self.escribir()
+
+    '''
+        Agrega la altura z (relativa a la referencia) del punto medido y evalúa los
+        puntos de las celdas que quedan completas.
+    '''
+    def agregarLectura(self, punto, z):
+        i = int(round(punto[0] / self.malla.dx))
+        j = int(round(punto[1] / self.malla.dy))
+        if not (0 <= i <= self.malla.l and 0 <= j <= self.malla.h):
+            return
+        self.malla.z[i, j] = z
+        self.medidos[i, j] = True
+        for ci in (i - 1, i):
+            for cj in (j - 1, j):
+                if not (0 <= ci < self.completas.shape[0] and 0 <= cj < self.completas.shape[1]):
+                    continue
+                if self.completas[ci, cj] or not self.medidos[ci:ci + 2, cj:cj + 2].all():
+                    continue
+                self.completas[ci, cj] = True
+                for entrada, idx in self.pendientes.pop((ci, cj), []):
+                    entrada[1][idx] = self.malla(entrada[0].xs[idx], entrada[0].ys[idx])
+                    entrada[2] -= len(idx)
+        self.escribir()
+
+    '''
+        Guarda el bloque en el archivo temporal, con la lista de las celdas de sus puntos.
+    '''
+    def guardarBloque(self, bloque):
+        celdas = np.zeros(0, dtype=int)
+        if len(bloque.xs):
+            u, v, i, j = self.malla.celdas(bloque.xs, bloque.ys)
+            celdas = np.unique(i * self.completas.shape[1] + j)
+        if self.temporal == None:
+            self.temporal = tempfile.TemporaryFile()
+        self.temporal.seek(0, os.SEEK_END)
+        posicion = self.temporal.tell()
+        cPickle.dump(bloque, self.temporal, cPickle.HIGHEST_PROTOCOL)
+        self.bloques.append([None, (posicion, celdas), len(bloque.xs)])
+
+    '''
+        Lee el bloque guardado en la posición del archivo temporal y evalúa sus alturas:
+        los puntos de celdas completas con las lecturas y los demás con f.
+    '''
+    def recuperarBloque(self, posicion, f=None):
+        self.temporal.seek(posicion)
+        bloque = cPickle.load(self.temporal)
+        alturas = np.empty(len(bloque.xs))
+        if len(bloque.xs):
+            u, v, i, j = self.malla.celdas(bloque.xs, bloque.ys)
+            listos = self.completas[i, j]
+            if listos.any():
+                alturas[listos] = self.malla(bloque.xs[listos], bloque.ys[listos])
+            if not listos.all():
+                alturas[~listos] = evaluarPuntos(f, bloque.xs[~listos], bloque.ys[~listos])
+        return bloque, alturas
+
+    '''
+        Escribe los bloques que ya tienen todas sus alturas, en orden.
+        f -> función del mapa completo, para escribir todos los bloques (ver terminar)
+    '''
+    def escribir(self, f=None):
+        while self.bloques:
+            bloque, alturas, faltan = self.bloques[0]
+            if bloque == None:
+                posicion, celdas = alturas
+                if f == None and faltan and not self.completas.ravel()[celdas].all():
+                    break
+                bloque, alturas = self.recuperarBloque(posicion, f)
+            elif faltan:
+                break
+            else:
+                self.en_memoria -= 1
+            self.bloques.popleft()
+            nuevas = escribirBloque(bloque, None, self.prof_fresado, alturas)
+            self.salida.write(''.join(nuevas))
+            if self.largos != None:
+                self.largos.extend(len(linea) for linea in nuevas)
+
+    '''
+        Evalúa los puntos que faltan con la función f del mapa completo
+        (e.g. interpolarMalla + completarMapa) y escribe los bloques restantes.
+    '''
+    def terminar(self, f):
+        for pendientes in self.pendientes.values():
+            for entrada, idx in pendientes:
+                entrada[1][idx] = evaluarPuntos(f, entrada[0].xs[idx], entrada[0].ys[idx])
+                entrada[2] -= len(idx)
+        self.pendientes = {}
+        self.escribir(f)
+        if self.temporal != None:
+            self.temporal.close()
+            self.temporal = None
+
+'''
+    Realiza el probing como realizarProbing, pero con el resto del trabajo en paralelo
+    (con hilos, ya que Python 2 no tiene asyncio): un hilo se comunica con GRBL, otro
+    prepara el archivo de código G a nivelar (prepararBloque, no depende del mapa) y el
+    hilo principal guarda cada lectura en el archivo de puntos y en la sesión y, si se
+    pide, grafica un modelo provisional de la superficie. El archivo nivelado
+    (.LEV) se escribe mientras avanza el probing, celda por celda (ver NiveladoIncremental),
+    por lo que al terminar solo quedan los últimos bloques. Con revisar, el hilo de
+    preparación también construye el índice por celdas del archivo (ver cargarIndice) y al
+    terminar se nivelan de nuevo solo las celdas de las lecturas que cambió la revisión
+    (ver renivelarArchivo).
+    Funciona con GRBL o con el simulador (ver abrirPuerto).
+
+    puntos -> lista de puntos en el orden de probing
+    l, h, dx, dy -> cuadrícula del mapa de alturas
+    gcode -> archivo de código G a nivelar, None para solo hacer el probing
+    prof_fresado, segmentar, max_seg, tol_arco -> ver modificarArchivo
+    graficar -> actualizar una gráfica de las alturas con cada lectura
+    Los demás parámetros son los de realizarProbing.
+
+    Devuelve el mapa de alturas (igual que realizarProbing) y la función de interpolación.
+'''
+def probingConcurrente(puntos, l, h, dx=DELTA_X, dy=DELTA_Y, gcode=None, prof_fresado=MILL_DEPTH, segmentar=False,
+                       max_seg=None, tol_arco=ARC_TOLERANCE, port=None, baudrate=BAUDRATE,
+                       pattern=PROBE_PATTERN, filename=OUTPUT_FILE, sesion=SESSION_FILE, info=None,
+                       telemetria=None, revisar=None, graficar=False):
+    if revisar == None:
+        revisar = PROBE_RECHECK
+    # Eventos de los hilos: ('lectura', punto, z, ref), ('mapa', probemap, ref, revisados),
+    # ('bloque', bloque preparado) y ('fin',) al terminar cada hilo
+    cola = Queue.Queue()
+    resultado = {}
+
+    # Comunicación con GRBL
+    def comunicacion():
+        try:
+            grbl = conectarGrbl(port, baudrate, pattern, telemetria)
+            mapa = {}
+            lecturas = {}
+            ref = sondearPuntos(grbl, puntos, mapa, None, lecturas=lecturas, cuadricula=(dx, dy),
+                                avisar=lambda punto, z, ref: cola.put(('lectura', punto, z, ref)))
+            if revisar:
+                ref, revisados = revisarLecturas(grbl, mapa, lecturas, ref,
+                                                 reloj=telemetria.reloj if telemetria != None else time.time)
+                if revisados:
+                    cola.put(('mapa', dict(mapa), ref, revisados))
+            print 'Fin del probing...'
+            desconectarGrbl(grbl)
+            resultado['ref'] = ref
+        except Exception:
+            resultado['error'] = sys.exc_info()
+        cola.put(('fin',))
+
+    # Preparación del archivo a nivelar
+    def preparacion():
+        try:
+            estado = estadoInicial()
+            for bloque in bloquesLineas(leerLineas(gcode)):
+                cola.put(('bloque', prepararBloque(bloque, segmentar, max_seg, estado, tol_arco, dx, dy)))
+            if revisar:
+                resultado['indice'] = cargarIndice(gcode, l, h, dx, dy, tol_arco)
+        except Exception:
+            resultado['error'] = sys.exc_info()
+        cola.put(('fin',))
+
+    hilos = [threading.Thread(target=comunicacion)]
+    if gcode != None:
+        hilos.append(threading.Thread(target=preparacion))
+    for hilo in hilos:
+        hilo.daemon = True
+        hilo.start()
+
+    # Guardar las lecturas a medida que llegan, actualizar el modelo y nivelar el archivo
+    probemap = {}
+    f = open(filename, 'w')
+    checkpoint = abrirSesion(sesion, puntos) if sesion != None else None
+    if gcode != None:
+        salida = opt_name(gcode, '.LEV')
+        wf = open(salida, 'w', WRITE_BUFFER)
+        nivelado = NiveladoIncremental(wf, l, h, dx, dy, prof_fresado, posiciones=revisar)
+    if graficar:
+        plt.ion()
+    activos = len(hilos)
+    while activos:
+        try:
+            evento = cola.get(True, 0.5)
+        except Queue.Empty:
+            continue
+        if evento[0] == 'fin':
+            activos -= 1
+            continue
+        if evento[0] == 'bloque':
+            if 'error' not in resultado:
+                nivelado.agregarBloque(evento[1])
+            continue
+        if evento[0] == 'lectura':
+            punto, z, ref = evento[1:]
+            probemap[punto] = z - ref
+            if gcode != None:
+                nivelado.agregarLectura(punto, z - ref)
+            f.write('%-4.3f\t%-4.3f\t%-4.3f\n' % (punto[0], punto[1], z - ref))
+            f.flush()
+            if checkpoint != None:
+                registrarLectura(checkpoint, punto, z, ref)
+        else:
+            probemap, ref, revisados = evento[1:]
+            f.close()
+            escribirMapa(filename, probemap)
+            f = open(filename, 'a')
+            if checkpoint != None:
+                for p in revisados:
+                    registrarLectura(checkpoint, p, probemap[p] + ref, ref)
+        # Modelo provisional con las lecturas recibidas hasta ahora, solo para la gráfica
+        # (completarMapa recorre todos los nodos)
+        if graficar and cola.empty():
+            graficarProgreso(interpolarMalla(completarMapa(probemap, l, h, dx, dy), l, h, dx, dy), probemap)
+    f.close()
+    if checkpoint != None:
+        checkpoint.close()
+    for hilo in hilos:
+        hilo.join()
+    if 'error' in resultado:
+        if gcode != None:
+            wf.close()
+        tipo, valor, traza = resultado['error']
+        raise tipo, valor, traza
+    if info != None:
+        info.update(ref=resultado['ref'], avance=PROBE_FEED, fecha=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+    # Modelo final y resto del archivo nivelado
+    malla = interpolarMalla(completarMapa(probemap, l, h, dx, dy), l, h, dx, dy)
+    if gcode != None:
+        print 'Terminando el archivo nivelado...'
+        nivelado.terminar(malla)
+        wf.close()
+        # Las celdas completas se nivelaron con las lecturas anteriores a la revisión
+        cambiados = nivelado.medidos & (nivelado.malla.z != malla.z)
+        if cambiados.any():
+            print 'Nivelando de nuevo las celdas de %d lecturas revisadas...' % cambiados.sum()
+            indice = resultado['indice']
+            indice.salida = np.concatenate(([0], np.cumsum(nivelado.largos, dtype=np.int64)))
+            renivelarArchivo(gcode, malla, prof_fresado, cambiados, indice, segmentar, max_seg, tol_arco,
+                             (dx, dy, 0.0, 0.0))
+    return probemap, malla
+
+'''
+    Realiza el probing adaptativo de una placa de l*dx por h*dy.
+    Comienza con la cuadrícula de listaPuntos y divide en 4 (probando los puntos
+    medios de los lados y el centro) solo las celdas cuyo error de interpolación
+    estimado es mayor que tolerancia, hasta 'niveles' divisiones por celda. Si al
+    llegar a ese límite quedan celdas sobre la tolerancia, las informa.
+
+    El error de las celdas iniciales se estima con la curvatura de las alturas
+    vecinas (segundas diferencias d2x, d2y): e = (|d2x| + |d2y|) / 8.
+    Al dividir una celda se mide su error real (diferencia entre las lecturas
+    nuevas y su interpolación bilineal) y el de cada subcelda se estima como la
+    cuarta parte, ya que el error bilineal crece con el cuadrado del tamaño.
+
+    Devuelve el mapa de alturas con los puntos medidos, igual que realizarProbing
+    (incluyendo el diccionario info, la telemetría y la revisión de lecturas, que se
+    hace después de cada nivel para no dividir celdas por una lectura errónea). La
+    función de interpolación se obtiene con interpolarAdaptativo.
+'''
+def probingAdaptativo(l, h, dx=DELTA_X, dy=DELTA_Y, tolerancia=ADAPTIVE_TOLERANCE, niveles=ADAPTIVE_LEVELS,
+                      port=None, baudrate=BAUDRATE, filename=OUTPUT_FILE, info=None, telemetria=None,
+                      revisar=None):
+    # Los nodos (I,J) son índices de la cuadrícula más fina, de dx/esc por dy/esc
+    esc = 2 ** niveles
+    def coord(nodo):
+        return (nodo[0] * dx / float(esc), nodo[1] * dy / float(esc))
+
+    if revisar == None:
+        revisar = PROBE_RECHECK
+    reloj = telemetria.reloj if telemetria != None else time.time
+    revisados = []
+    grbl = conectarGrbl(port, baudrate, telemetria=telemetria)
+    probemap = {}
+    lecturas = {}
+    f = open(filename, 'w')
+    z = {} # nodo -> altura medida
+
+    # Cuadrícula inicial
+    nodos = listaPuntos(l, h, esc, esc)
+    ref = sondearPuntos(grbl, [coord(n) for n in nodos], probemap, f, lecturas=lecturas, cuadricula=(dx, dy))
+    if revisar:
+        ref, r = revisarLecturas(grbl, probemap, lecturas, ref, reloj=reloj)
+        revisados += r
+    for n in nodos:
+        if coord(n) in probemap:
+            z[n] = probemap[coord(n)]
+
+    # Error estimado de las celdas iniciales a partir de la curvatura
+    Z = np.array([[z.get((i*esc, j*esc), np.nan) for j in range(h + 1)] for i in range(l + 1)])
+    d2x = np.zeros(Z.shape)
+    d2y = np.zeros(Z.shape)
+    d2x[1:-1, :] = np.abs(Z[:-2, :] - 2*Z[1:-1, :] + Z[2:, :])
+    d2y[:, 1:-1] = np.abs(Z[:, :-2] - 2*Z[:, 1:-1] + Z[:, 2:])
+    d2x = np.nan_to_num(d2x)
+    d2y = np.nan_to_num(d2y)
+    hojas = {} # celda (I, J, tamaño) -> error estimado
+    for i in range(l):
+        for j in range(h):
+            hojas[(i*esc, j*esc, esc)] = (d2x[i:i+2, j:j+2].max() + d2y[i:i+2, j:j+2].max()) / 8
+
+    ultimo = coord(nodos[-1])
+    nivel = 0
+    while True:
+        # Celdas con error mayor a la tolerancia y con las 4 esquinas medidas
+        dividir = [c for c, e in hojas.items() if e > tolerancia and c[2] > 1 and
+                   all(n in z for n in [(c[0], c[1]), (c[0]+c[2], c[1]), (c[0], c[1]+c[2]), (c[0]+c[2], c[1]+c[2])])]
+        if not dividir:
+            break
+        nivel += 1
+        print 'Nivel %d: dividiendo %d celdas' % (nivel, len(dividir))
+
+        # Puntos medios de los lados y centro de cada celda
+        nuevos = {}
+        for (I, J, t) in dividir:
+            m = t // 2
+            for n in [(I+m, J), (I, J+m), (I+t, J+m), (I+m, J+t), (I+m, J+m)]:
+                if n not in z:
+                    nuevos[coord(n)] = n
+        ruta = planearRuta([ultimo] + nuevos.keys())[1:]
+        # Los nodos nuevos más cercanos están a media celda de las menores divididas
+        m = min(c[2] for c in dividir) // 2
+        ref = sondearPuntos(grbl, ruta, probemap, f, ref, lecturas=lecturas, cuadricula=coord((m, m)))
+        if revisar:
+            ref, r = revisarLecturas(grbl, probemap, lecturas, ref, reloj=reloj)
+            revisados += r
+        # Las alturas revisadas (o corregidas por una nueva referencia) reemplazan a las anteriores
+        for n in z.keys():
+            z[n] = probemap[coord(n)]
+        for p in ruta:
+            if p in probemap:
+                z[nuevos[p]] = probemap[p]
+        ultimo = ruta[-1]
+
+        # Error medido de cada celda dividida y error estimado de sus subceldas
+        for (I, J, t) in dividir:
+            del hojas[(I, J, t)]
+            m = t // 2
+            z00, z10, z01, z11 = z[(I, J)], z[(I+t, J)], z[(I, J+t)], z[(I+t, J+t)]
+            prediccion = {(I+m, J): (z00 + z10) / 2, (I, J+m): (z00 + z01) / 2,
+                          (I+t, J+m): (z10 + z11) / 2, (I+m, J+t): (z01 + z11) / 2,
+                          (I+m, J+m): (z00 + z10 + z01 + z11) / 4}
+            error = max([abs(z[n] - zp) for n, zp in prediccion.items() if n in z] + [0])
+            for a in (0, m):
+                for b in (0, m):
+                    hojas[(I+a, J+b, m)] = error / 4
+
+    # Celdas que quedaron con error mayor a la tolerancia (al llegar a 'niveles' divisiones)
+    pendientes = sorted(c for c, e in hojas.items() if e > tolerancia)
+    if pendientes:
+        print 'No se alcanzo la tolerancia de %.3f mm en %d celdas (error estimado maximo %.3f mm):' % (
+            tolerancia, len(pendientes), max(hojas[c] for c in pendientes))
+        for (I, J, t) in pendientes:
+            x0, y0 = coord((I, J))
+            x1, y1 = coord((I + t, J + t))
+            print '	(%-4.3f,%-4.3f)-(%-4.3f,%-4.3f): %.3f mm' % (x0, y0, x1, y1, hojas[(I, J, t)])
+
+    # Fin del probing, cerrar el archivo
+    f.close()
+    if revisados:
+        escribirMapa(filename, probemap)
+    print 'Fin del probing adaptativo: %d puntos (%d en la cuadricula fina)' % (
+        len(probemap), (l*esc + 1) * (h*esc + 1))
+    desconectarGrbl(grbl)
+    if info != None:
+        info.update(ref=ref, avance=PROBE_FEED, fecha=time.strftime('%Y-%m-%d %H:%M:%S'))
+    return probemap
+
+'''
+    Envía un archivo de código G (por ejemplo el .LEV nivelado) a GRBL
+    utilizando GrblSender. Omite los comentarios entre paréntesis y las líneas vacías.
+    filename -> Archivo de código G a enviar
+    port, baudrate -> nombre y velocidad del puerto serial
+    telemetria -> objeto Telemetria para registrar la comunicación
+'''
+def enviarArchivo(filename, port=None, baudrate=BAUDRATE, telemetria=None):
+    # Abrir el puerto serial
+    print 'Iniciando conexion con puerto serial...'
+    puerto = abrirPuerto(port, baudrate)
+    resp = puerto.readlines()
+    for l in resp:
+        print l,
+    grbl = GrblSender(puerto, telemetria=telemetria)
+    if telemetria != None:
+        telemetria.iniciarEtapa('envio')
+
+    # Enviar el archivo línea por línea
+    n = 0
+    for linea in open(filename, 'r'):
+        linea = re.sub('\(.*?\)', '', linea).strip()
+        if linea:
+            grbl.enviar(linea)
+            n += 1
+    grbl.esperar()
+    if telemetria != None:
+        telemetria.terminarEtapa()
+    print 'Se enviaron %d lineas' % n
+    for comando, error in grbl.errores:
+        print 'Error en %s: %s' % (comando, error)
+    # Cerrar el puerto serial
+    puerto.close()
+
 
 '''
     Recibe el mapa de alturas y devuelve las listas X, Y, Z correspondientes.
@@ -180,20 +1361,32 @@ def graficarMapa(probeMap, function=None):
     plt.show()
     #plt.savefig('mapaAlturas.pdf')
 
+'''
+    Actualiza la gráfica de progreso del probing: las alturas del modelo provisional
+    'malla' y los puntos ya medidos.
+'''
+def graficarProgreso(malla, probeMap):
+    xm, ym, zm = probeMapToList(probeMap)
+    plt.figure(2)
+    plt.clf()
+    x1 = malla.x0 + malla.l * malla.dx
+    y1 = malla.y0 + malla.h * malla.dy
+    plt.imshow(np.asarray(malla.z).T, origin='lower', cmap=cm.coolwarm, aspect='auto',
+               extent=[malla.x0, x1, malla.y0, y1])
+    plt.colorbar()
+    plt.plot(xm, ym, 'ko')
+    plt.title('Probing: %d puntos' % len(zm))
+    plt.pause(0.001)
 
 '''
     Obtiene la funcion de interpolacion utilizando TODOS los puntos de probeMap
-    Utiliza la funcion interpolate.interp2d con 'cubic'
+    Utiliza el modelo bicúbico sobre la cuadrícula del mapa (ver ModeloBicubico),
+    que reemplaza a interpolate.interp2d con 'cubic'
     
     Devuelve la funcion de interpolacion
 '''
 def interpolarMapa(probeMap):
-    # Obtener la lista de valores x,y,z
-    xm, ym, zm = probeMapToList(probeMap)
-    # Interpolar la funcion
-    f = interpolate.interp2d(xm, ym, zm, kind='cubic')
-    # Devuelve el objeto de funcion
-    return f
+    return ajustarModelo(probeMap, 'bicubico')
 
 '''
     Define una clase para almacenar la matriz de funciones de interpolación.
@@ -234,187 +1427,2080 @@ def interporlarMapa2(probeMap, l, h, dx=DELTA_X, dy=DELTA_Y):
             
         listaF.append(rowF)
     return listaF
-            
 
 '''
-    Modifica el archivo de código G con la funcion especificada
-    filename -> str: La ruta hacia el archivo a modificar 
-    f -> Es el objeto de funcion devuelto por interp2d para modificar los puntos X y Y
-    prof_fresado -> profunidad de fresado a partir de z=0 (valor positivo)
+    Define una clase para evaluar el mapa de alturas por interpolación bilineal
+    sobre la cuadrícula completa. Almacena las alturas en un arreglo de NumPy
+    de (l+1)x(h+1), donde z[i][j] es la altura del punto (i*dx, j*dy).
+    El método __call__ acepta escalares o arreglos de coordenadas X, Y y evalúa
+    todos los puntos en una sola pasada. Los puntos fuera de la placa toman el
+    valor del borde más cercano. El punto z[0][0] está en (x0, y0).
 '''
-def modificarArchivo(filename, f, prof_fresado):
-    '''
-        Funcion que recibe el nombre original del archivo y el prefijo a agregar.
-        Devuelve el nuevo nombre del archivo
-    '''
-    def opt_name(s, prefix):
-        assert '.' in s
-        i = -1
-        while s[i] != '.':
-            i = i - 1
-        old_ext = s[i:]
-        return s[-len(s): i] + prefix + old_ext
-
-    '''
-        Reemplaza las ocurrencias utilizando el patrón G1_PATTERN, para cada punto (x,y)
-        obtiene la profundidad z = f(x,y) y la agrega en código G
-    '''
-    def f_repl_g1(f):
-        def repl_g1(match):
-            x = float(match.group(1))
-            y = float(match.group(2))
-            z = f(x, y)[0] - prof_fresado
-            return ('G1 X%-4.4f Y%-4.4f Z%-4.3f' % (x, y, z))
-        return repl_g1
-
-    '''
-        Reemplaza las ocurrencias utilizando el patrón G0Z_PATTERN, para cada punto (x,y)
-        obtiene la profundidad z = f(x,y) y la agrega en código G
-    '''
-    def f_repl_g0z(f):
-        def repl_g0z(match):
-            x = float(match.group(1))
-            y = float(match.group(2))
-            z = f(x, y)[0] - prof_fresado
-            return ('G0 X%-4.4f Y%-4.4f\nG1 Z%-4.3f' % (x, y, z))
-        return repl_g0z
-
-    # Abre el archivo especificado y obtiene el código G
-    gcode = open(filename, 'r').read()
-    # Limpiar el codigo G de espacios dobles o más
-    gcode = re.sub('[ ]{2,}', ' ', gcode)
-    gcode = re.sub(' \n', '\n', gcode)
-
-    # Reemplazar las ocurrencias de G1 X# Y# enviando la funcion de superficie
-    gcode = re.sub(G1_PATTERN, f_repl_g1(f), gcode)
-    # Reemplazar las ocurrencias de G0 X# Y#\nG1 Z# enviando la funcion de superficie
-    gcode = re.sub(G0Z_PATTERN, f_repl_g0z(f), gcode)
-
-    # Guardar el archivo modificado
-    wf = open(opt_name(filename, '.LEV'), 'w')
-    wf.write(gcode)
-    wf.close()
+class BilinearGrid(object):
+    # Indica que la funcion acepta arreglos completos de puntos (x, y)
+    vectorizada = True
+
+    def __init__(self, z, dx=DELTA_X, dy=DELTA_Y, x0=0.0, y0=0.0):
+        # Se conserva el tipo si ya es flotante (e.g. float32 de un mapa en memoria)
+        self.z = np.asarray(z)
+        if not np.issubdtype(self.z.dtype, np.floating):
+            self.z = self.z.astype(float)
+        self.dx = float(dx)
+        self.dy = float(dy)
+        self.x0 = float(x0)
+        self.y0 = float(y0)
+        self.l = self.z.shape[0] - 1
+        self.h = self.z.shape[1] - 1
+
+    '''
+        Devuelve la posición (u, v) de los puntos en unidades de la cuadrícula
+        (positiva aunque DELTA_X < 0), limitada a los bordes de la placa, y la
+        celda (i, j) con la que se evalúa cada uno.
+    '''
+    def celdas(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        u = np.clip((x - self.x0) / self.dx, 0, self.l)
+        v = np.clip((y - self.y0) / self.dy, 0, self.h)
+        # El borde final pertenece a la última celda
+        i = np.minimum(u.astype(int), max(self.l - 1, 0))
+        j = np.minimum(v.astype(int), max(self.h - 1, 0))
+        return u, v, i, j
 
+    def __call__(self, x, y):
+        u, v, i, j = self.celdas(x, y)
+        ii = np.minimum(i + 1, self.l)
+        jj = np.minimum(j + 1, self.h)
+        tx = u - i
+        ty = v - j
+        # Interpolación bilineal con las 4 esquinas de la celda
+        z = self.z
+        zy0 = z[i, j] + (z[ii, j] - z[i, j]) * tx
+        zy1 = z[i, jj] + (z[ii, jj] - z[i, jj]) * tx
+        return np.atleast_1d(zy0 + (zy1 - zy0) * ty)
 
 '''
-    Imprime las instrucciones para iniciar el programa correctamente
-    desde la linea de comandos
+    Obtiene la función de interpolación bilineal por áreas de dx*dy como un
+    único objeto BilinearGrid, equivalente a interporlarMapa2 + BilinearMatrix.
 '''
-def imprimeInstrucciones():
-    #print '=- Programa de Probing -=\n'
-    print 'Utilizacion correcta:'
-    print '\tpython probing.py -f <archivo> <x> <y> <dx> <dy> <prof_z>'
-    print '\tpython probing.py -f <archivo> <x> <y>'
-    print '\tpython probing.py -p <x> <y> <dx> <dy>'
-    print '\tpython probing.py -p <x> <y>\n'
-    print 'x,y\t:\tDimensiones del area a probar'
-    print 'dx, dy\t:\tCambios en ambos ejes, por defecto dx=-10mm, dy=10mm'
-    print 'prof_z\t:\tProfundidad de fresado a partir de la superficie de contacto'
-
+def interpolarMalla(probeMap, l, h, dx=DELTA_X, dy=DELTA_Y):
+    z = np.empty((l + 1, h + 1))
+    for i in range(l + 1):
+        for j in range(h + 1):
+            z[i, j] = probeMap[(i*dx, j*dy)]
+    return BilinearGrid(z, dx, dy)
 
 '''
-    Realiza la rutina general de probing utilizando el tamaño de la placa.
-    Opcionalmente modifica el archivo de código G especificado.
-    length_x -> tamaño de la placa en el eje X (en mm)
-    length_y -> tamaño de la placa en el eje Y (en mm)
-    prof_z -> profundidad de fresado a partir de la superficie de contacto de la placa
-    filename -> Nombre del archivo para modificar el código G
+    Devuelve una copia del mapa de alturas con todos los puntos (i*dx, j*dy) de la
+    cuadrícula de l x h celdas, completando los que no se midieron (por ejemplo con
+    puntosTrayectoria) por interpolación lineal de los medidos, o con el más cercano
+    fuera de ellos.
 '''
-def rutinaGeneral(length_x, length_y, dx = DELTA_X, dy = DELTA_Y, prof_z = MILL_DEPTH, filename=None):
-    # Obtener la lista de puntos
-    print 'Generando la lista de puntos...'
-    l = abs(length_x / dx)
-    h = abs(length_y / dy)
-    puntos = listaPuntos(l, h, dx, dy)
-    print 'La lista de puntos es: ', puntos
+def completarMapa(probeMap, l, h, dx=DELTA_X, dy=DELTA_Y):
+    completo = dict(probeMap)
+    faltan = [(i*dx, j*dy) for i in range(l + 1) for j in range(h + 1) if (i*dx, j*dy) not in probeMap]
+    if not faltan:
+        return completo
+    xm, ym, zm = probeMapToList(probeMap)
+    xy = np.array([xm, ym], dtype=float).T
+    zm = np.array(zm, dtype=float)
+    p = np.array(faltan, dtype=float)
+    z = np.empty(len(p))
+    z.fill(np.nan)
+    if len(zm) >= 3:
+        try:
+            z = interpolate.griddata(xy, zm, p, method='linear')
+        except spatial.qhull.QhullError:
+            # Puntos medidos colineales: solo se puede usar el más cercano
+            pass
+    fuera = np.isnan(z)
+    if fuera.any():
+        z[fuera] = interpolate.griddata(xy, zm, p[fuera], method='nearest')
+    completo.update(zip(faltan, z))
+    return completo
 
-    # Obtener las alturas de los puntos
-    print 'Realizando el mapa de alturas...'
-    #probemap = realizarProbing(puntos)
-    #print 'Mapa de alturas: ', probemap
-    # Probemap de 60x30 mm
-    probemap = {(-60, 10): -0.057, (-20, 20): -0.168, (0, 20): -0.082, (-30,30): -0.276, (-50, 10): -0.079, (0, 10): -0.057, (-20, 10): -0.098, (-50, 20): -0.184, (-60, 20): -0.181, (-40, 20): -0.181, (-10, 10): -0.076, (-50, 30): -0.298, (-30, 20): -0.178, (-30, 10): -0.092, (-10, 30): -0.181, (-60, 30): -0.273, (-40, 30): -0.289, (0, 0): 0.0, (-20, 0): 0.038, (-30, 0): 0.07, (-50, 0): 0.114, (0, 30): -0.105, (-40, 0): 0.099, (-10, 20): -0.13, (-60, 0): 0.111, (-10, 0): 0.022, (-40, 10): -0.086, (-20, 30): -0.244}
-    # Probemap de 30x30 mm
-    #probemap = {(-10, 20): -0.057, (0, 0): 0.0, (-20, 0): 0.003, (0, 20): -0.012, (-30, 20): -0.139, (-10, 30): -0.095, (-30, 10): -0.082, (-30, 0): -0.012, (-20, 20): -0.101, (0, 10): 0.019, (0, 30): -0.031, (-30, 30): -0.178, (-20, 10): -0.063, (-10, 10): -0.025, (-10, 0): 0.026, (-20, 30): -0.146}
-    print 'Se ha terminado el mapa, generando el modelo...'
+'''
+    Obtiene la función de interpolación bilineal del mapa de probingAdaptativo,
+    sobre la cuadrícula más fina de dx/2**niveles por dy/2**niveles.
+    Los nodos no medidos se completan nivel por nivel con la interpolación
+    bilineal del nivel anterior, por lo que cada celda no dividida se interpola
+    con sus 4 esquinas y la superficie es continua entre celdas de distinto tamaño.
+    Con niveles=0 es equivalente a interpolarMalla.
+'''
+def interpolarAdaptativo(probeMap, l, h, dx=DELTA_X, dy=DELTA_Y, niveles=ADAPTIVE_LEVELS):
+    esc = 2 ** niveles
+    dxf = dx / float(esc)
+    dyf = dy / float(esc)
+    # Alturas medidas en los nodos (I,J) de la cuadrícula más fina
+    medidas = {}
+    for p, z in probeMap.items():
+        medidas[(int(round(p[0] / dxf)), int(round(p[1] / dyf)))] = z
 
-    # Obtener la funcion de interpolacion con todos los puntos
-    #f = interpolarMapa(probemap)
+    Z = np.empty((l + 1, h + 1))
+    for i in range(l + 1):
+        for j in range(h + 1):
+            Z[i, j] = medidas[(i*esc, j*esc)]
+    t = esc
+    while t > 1:
+        t //= 2
+        # Subdividir con la interpolación bilineal del nivel anterior
+        N = np.empty((2*Z.shape[0] - 1, 2*Z.shape[1] - 1))
+        N[::2, ::2] = Z
+        N[1::2, ::2] = (Z[:-1, :] + Z[1:, :]) / 2
+        N[:, 1::2] = (N[:, :-1:2] + N[:, 2::2]) / 2
+        # Reemplazar con las alturas medidas en este nivel
+        for (I, J), z in medidas.items():
+            if I % t == 0 and J % t == 0:
+                N[I // t, J // t] = z
+        Z = N
+    return BilinearGrid(Z, dxf, dyf)
 
-    # Obtener la función de interpolación por áreas
-    listaFunciones = interporlarMapa2(probemap, l, h, dx, dy)
-    #print listaFunciones
-    bmatrix = BilinearMatrix(listaFunciones, dx, dy)
+'''
+    Modelo de la superficie de la placa a partir del mapa de alturas. Cada modelo se
+    ajusta con ajustar(probeMap, l, h, dx, dy, x0, y0), que devuelve el mismo modelo, y
+    se evalúa llamándolo con escalares o arreglos completos de coordenadas X, Y, como
+    BilinearGrid, por lo que se puede usar en modificarArchivo. Como BilinearGrid,
+    guarda la cuadrícula del probing (l, h, dx, dy, x0, y0), donde se subdividen los
+    cortes al nivelar. Los puntos fuera de la zona medida toman el valor del borde más
+    cercano. Ver MODELOS y ajustarModelo. Esta clase solo reúne lo común a los modelos,
+    que definen ajustar y __call__.
+'''
+class ModeloSuperficie(object):
+    # Indica que la funcion acepta arreglos completos de puntos (x, y)
+    vectorizada = True
+
+    '''
+        Guarda la cuadrícula de l x h celdas de dx*dy con origen en (x0, y0), por
+        defecto la de los puntos del mapa (ver dimensionesMapa).
+    '''
+    def cuadricula(self, probeMap, l, h, dx, dy, x0, y0):
+        if l == None:
+            l, h, dx, dy = dimensionesMapa(probeMap)
+        self.l, self.h = l, h
+        self.dx, self.dy = float(dx), float(dy)
+        self.x0, self.y0 = float(x0), float(y0)
+
+    '''
+        Devuelve la matriz de alturas de los nodos de la cuadrícula, completando los
+        que no se midieron (ver completarMapa).
+    '''
+    def alturasCuadricula(self, probeMap):
+        if self.x0 or self.y0:
+            # completarMapa e interpolarMalla usan el origen (0,0): se trasladan los
+            # puntos, llevando los nodos exactamente a (i*dx, j*dy)
+            trasladado = {}
+            for (x, y), z in probeMap.items():
+                u = (x - self.x0) / self.dx
+                v = (y - self.y0) / self.dy
+                x = round(u) * self.dx if abs(u - round(u)) < 1e-6 else x - self.x0
+                y = round(v) * self.dy if abs(v - round(v)) < 1e-6 else y - self.y0
+                trasladado[(x, y)] = z
+            probeMap = trasladado
+        l, h, dx, dy = self.l, self.h, self.dx, self.dy
+        return interpolarMalla(completarMapa(probeMap, l, h, dx, dy), l, h, dx, dy).z
+
+    '''
+        Guarda el rectángulo de los puntos medidos y la escala con que se normalizan
+        sus coordenadas. Devuelve los arreglos x, y, z de los puntos.
+    '''
+    def zonaMedida(self, probeMap):
+        xm, ym, zm = [np.asarray(v, dtype=float) for v in probeMapToList(probeMap)]
+        self.xmin, self.xmax = xm.min(), xm.max()
+        self.ymin, self.ymax = ym.min(), ym.max()
+        self.centro = ((self.xmin + self.xmax) / 2, (self.ymin + self.ymax) / 2)
+        self.escala = max(self.xmax - self.xmin, self.ymax - self.ymin, 1e-9) / 2
+        return xm, ym, zm
+
+    '''
+        Coordenadas normalizadas (aproximadamente entre -1 y 1) de los puntos,
+        limitados a la zona medida.
+    '''
+    def normalizar(self, x, y):
+        u = (np.clip(x, self.xmin, self.xmax) - self.centro[0]) / self.escala
+        v = (np.clip(y, self.ymin, self.ymax) - self.centro[1]) / self.escala
+        return u, v
+
+'''
+    Interpolación bilineal por áreas de dx*dy (BilinearGrid), completando los puntos
+    de la cuadrícula que no se midieron (ver completarMapa).
+'''
+class ModeloBilineal(ModeloSuperficie):
+    def ajustar(self, probeMap, l, h, dx=DELTA_X, dy=DELTA_Y, x0=0.0, y0=0.0):
+        self.cuadricula(probeMap, l, h, dx, dy, x0, y0)
+        self.malla = BilinearGrid(self.alturasCuadricula(probeMap), self.dx, self.dy, self.x0, self.y0)
+        return self
+
+    def __call__(self, x, y):
+        return self.malla(x, y)
+
+'''
+    Spline bicúbico que pasa por los puntos de la cuadrícula de l x h celdas de dx*dy,
+    completando los que no se midieron (ver completarMapa). Con menos de 4 puntos
+    en un eje usa el grado que permiten.
+'''
+class ModeloBicubico(ModeloSuperficie):
+    def ajustar(self, probeMap, l, h, dx=DELTA_X, dy=DELTA_Y, x0=0.0, y0=0.0):
+        self.cuadricula(probeMap, l, h, dx, dy, x0, y0)
+        if self.l < 1 or self.h < 1:
+            raise ValueError('El modelo bicúbico necesita al menos 2 x 2 puntos')
+        z = self.alturasCuadricula(probeMap)
+        self.spline = interpolate.RectBivariateSpline(np.arange(self.l + 1), np.arange(self.h + 1), z,
+                                                      kx=min(3, self.l), ky=min(3, self.h), s=0)
+        return self
+
+    def __call__(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        # Posición en unidades de la cuadrícula, limitada a los bordes de la placa
+        u = np.clip((x - self.x0) / self.dx, 0, self.l)
+        v = np.clip((y - self.y0) / self.dy, 0, self.h)
+        return np.atleast_1d(self.spline.ev(u, v))
+
+'''
+    Polinomio de grado 'grado' en x, y (1 = plano) ajustado por mínimos cuadrados a
+    todos los puntos medidos. No pasa por los puntos: suaviza el ruido de las lecturas.
+'''
+class ModeloPolinomio(ModeloSuperficie):
+    def __init__(self, grado=POLY_DEGREE):
+        self.grado = grado
+
+    def ajustar(self, probeMap, l=None, h=None, dx=DELTA_X, dy=DELTA_Y, x0=0.0, y0=0.0):
+        self.cuadricula(probeMap, l, h, dx, dy, x0, y0)
+        xm, ym, zm = self.zonaMedida(probeMap)
+        self.coef = np.linalg.lstsq(self.terminos(*self.normalizar(xm, ym)), zm, rcond=None)[0]
+        return self
+
+    '''
+        Matriz con los monomios u^a * v^b (a + b <= grado) de cada punto.
+    '''
+    def terminos(self, u, v):
+        return np.column_stack([u**a * v**b for a in range(self.grado + 1) for b in range(self.grado + 1 - a)])
+
+    def __call__(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        u, v = self.normalizar(x.ravel(), y.ravel())
+        return np.atleast_1d(self.terminos(u, v).dot(self.coef).reshape(x.shape))
+
+'''
+    Plano ajustado por mínimos cuadrados (polinomio de grado 1).
+'''
+class ModeloPlano(ModeloPolinomio):
+    def __init__(self):
+        ModeloPolinomio.__init__(self, 1)
+
+'''
+    Función de base radial más un plano, para puntos dispersos (e.g. probing adaptativo
+    o solo donde corta el archivo).
+    funcion -> 'thin_plate' (r^2 log r, spline de placa delgada), 'multiquadric' o 'gaussian'
+    suavizado -> 0 para pasar por los puntos, mayor para suavizar el ruido
+    max_centros -> con más puntos medidos que esto, se usan como centros los puntos más
+                   cercanos a una cuadrícula regular y se ajusta por mínimos cuadrados,
+                   para que ajustar y evaluar muchos puntos tome pocos segundos
+'''
+class ModeloRBF(ModeloSuperficie):
+    def __init__(self, funcion='thin_plate', suavizado=0.0, max_centros=RBF_MAX_CENTERS):
+        if funcion not in ('thin_plate', 'multiquadric', 'gaussian'):
+            raise ValueError('Funcion de base radial desconocida: %s' % funcion)
+        self.funcion = funcion
+        self.suavizado = suavizado
+        self.max_centros = max_centros
+
+    def ajustar(self, probeMap, l=None, h=None, dx=DELTA_X, dy=DELTA_Y, x0=0.0, y0=0.0):
+        self.cuadricula(probeMap, l, h, dx, dy, x0, y0)
+        xm, ym, zm = self.zonaMedida(probeMap)
+        p = np.column_stack(self.normalizar(xm, ym))
+        n = len(p)
+        if n > self.max_centros:
+            k = int(np.sqrt(self.max_centros))
+            gu, gv = np.meshgrid(np.linspace(p[:, 0].min(), p[:, 0].max(), k),
+                                 np.linspace(p[:, 1].min(), p[:, 1].max(), k))
+            _, cercanos = spatial.cKDTree(p).query(np.column_stack((gu.ravel(), gv.ravel())))
+            self.centros = p[np.unique(cercanos)]
+        else:
+            self.centros = p
+        m = len(self.centros)
+        # Distancia típica entre centros, para multiquadric y gaussian
+        self.epsilon = max(np.ptp(p[:, 0]) * np.ptp(p[:, 1]) / m, 1e-12) ** 0.5
+
+        A = np.hstack((self.nucleo(p), np.column_stack((np.ones(n), p))))
+        if m == n:
+            # Interpolación: la parte radial no tiene componente plana
+            A = np.vstack((A, np.hstack((np.column_stack((np.ones(n), p)).T, np.zeros((3, 3))))))
+            A[:n, :n] += self.suavizado * np.eye(n)
+            b = np.concatenate((zm, np.zeros(3)))
+        else:
+            # Mínimos cuadrados, con el suavizado como penalización de los pesos
+            A = np.vstack((A, np.hstack((np.sqrt(self.suavizado) * np.eye(m), np.zeros((m, 3))))))
+            b = np.concatenate((zm, np.zeros(m)))
+        solucion = np.linalg.lstsq(A, b, rcond=None)[0]
+        self.pesos, self.plano = solucion[:m], solucion[m:]
+        return self
+
+    '''
+        Matriz con la función de base radial entre cada punto y cada centro.
+    '''
+    def nucleo(self, p):
+        # |p - c|^2 = |p|^2 + |c|^2 - 2 p.c, con el producto en BLAS
+        d2 = p.dot(-2 * self.centros.T)
+        d2 += (p**2).sum(axis=1)[:, np.newaxis]
+        d2 += (self.centros**2).sum(axis=1)
+        np.maximum(d2, 0, out=d2)
+        if self.funcion == 'thin_plate':
+            # r^2 log r = d2 log(d2) / 2, que vale 0 en d2 = 0
+            k = np.maximum(d2, 1e-300)
+            np.log(k, out=k)
+            k *= d2
+            k *= 0.5
+            return k
+        if self.funcion == 'multiquadric':
+            d2 += self.epsilon**2
+            return np.sqrt(d2, out=d2)
+        d2 *= -1 / self.epsilon**2
+        return np.exp(d2, out=d2)
+
+    def __call__(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        u, v = self.normalizar(x.ravel(), y.ravel())
+        z = np.empty(len(u))
+        # Por partes, para no armar la matriz de todos los puntos por todos los centros
+        for k in range(0, len(u), RBF_CHUNK):
+            p = np.column_stack((u[k:k + RBF_CHUNK], v[k:k + RBF_CHUNK]))
+            z[k:k + RBF_CHUNK] = self.nucleo(p).dot(self.pesos) + self.plano[0] + p.dot(self.plano[1:])
+        return np.atleast_1d(z.reshape(x.shape))
+
+# Modelos de la superficie por nombre (ver ajustarModelo)
+MODELOS = {
+    'bilineal': ModeloBilineal,
+    'bicubico': ModeloBicubico,
+    'plano': ModeloPlano,
+    'polinomio': ModeloPolinomio,
+    'rbf': ModeloRBF,
+}
+
+'''
+    Ajusta el modelo de la superficie 'modelo' (ver MODELOS) al mapa de alturas.
+    l, h, dx, dy -> cuadrícula del mapa, por defecto la de sus puntos (ver dimensionesMapa)
+    x0, y0 -> origen de la cuadrícula
+    opciones -> parámetros del modelo, e.g. grado=3 o funcion='gaussian'
+
+    Devuelve el modelo, que se evalúa como BilinearGrid (ver ModeloSuperficie).
+'''
+def ajustarModelo(probeMap, modelo=SURFACE_MODEL, l=None, h=None, dx=None, dy=None, x0=0.0, y0=0.0, **opciones):
+    if modelo not in MODELOS:
+        raise ValueError('Modelo de superficie desconocido: %s' % modelo)
+    if l == None:
+        l, h, dx, dy = dimensionesMapa(probeMap)
+    return MODELOS[modelo](**opciones).ajustar(probeMap, l, h, dx, dy, x0, y0)
+
+'''
+    Devuelve la función f evaluada en los puntos de la cuadrícula de l x h celdas
+    de dx*dy como un BilinearGrid, e.g. para guardar un modelo con guardarMalla.
+    resolucion -> si se especifica, evalúa f en una cuadrícula más fina sobre la
+                  misma placa, con celdas de a lo más resolucion mm de lado, y guarda
+                  las alturas como float32 (tabla de alturas, ver tablaAlturas)
+    x0, y0 -> origen de la cuadrícula
+'''
+def tabularModelo(f, l, h, dx=DELTA_X, dy=DELTA_Y, resolucion=None, x0=0.0, y0=0.0):
+    if resolucion == None:
+        x, y = np.meshgrid(x0 + np.arange(l + 1) * float(dx), y0 + np.arange(h + 1) * float(dy), indexing='ij')
+        return BilinearGrid(evaluarPuntos(f, x.ravel(), y.ravel()).reshape(x.shape), dx, dy, x0, y0)
+
+    # Celdas de la tabla, que terminan justo en el borde de la placa
+    nx = int(np.ceil(abs(l * dx) / float(resolucion) - 1e-9))
+    ny = int(np.ceil(abs(h * dy) / float(resolucion) - 1e-9))
+    dxf = l * float(dx) / nx if nx else float(dx)
+    dyf = h * float(dy) / ny if ny else float(dy)
+    z = np.empty((nx + 1, ny + 1), dtype=np.float32)
+    ys = y0 + np.arange(ny + 1) * dyf
+    # Del orden de un millón de puntos por vez
+    filas = max(1, (1 << 20) // (ny + 1))
+    for i in range(0, nx + 1, filas):
+        x, y = np.meshgrid(x0 + np.arange(i, min(i + filas, nx + 1)) * dxf, ys, indexing='ij')
+        z[i:i + filas] = evaluarPuntos(f, x.ravel(), y.ravel()).reshape(x.shape)
+    return BilinearGrid(z, dxf, dyf, x0, y0)
+
+'''
+    Devuelve el nombre del archivo con la tabla de alturas del mapa guardado 'mapa'
+    (binario o texto, ver cargarMalla): el modelo de la superficie (ver MODELOS)
+    evaluado en una cuadrícula de 'resolucion' mm (ver tabularModelo), en el mismo
+    formato de guardarMalla. Al nivelar con la tabla (cargarMalla, con np.memmap)
+    cada altura solo busca su celda e interpola linealmente, sin importar el modelo.
+    Las tablas se guardan en 'directorio' con el hash del mapa, el modelo y sus
+    parámetros (e.g. POLY_DEGREE o RBF_MAX_CENTERS) y la resolución como nombre, y
+    se reutilizan mientras ninguno de ellos cambie.
+    opciones -> parámetros del modelo (ver ajustarModelo)
+'''
+def tablaAlturas(mapa, modelo=SURFACE_MODEL, resolucion=LUT_RESOLUTION, directorio=LUT_DIR, **opciones):
+    if modelo not in MODELOS:
+        raise ValueError('Modelo de superficie desconocido: %s' % modelo)
+    # Parámetros del modelo sin ajustar, con los valores por defecto de los que no se especifican
+    parametros = sorted(vars(MODELOS[modelo](**opciones)).items())
+    clave = hashlib.sha1()
+    with open(mapa, 'rb') as f:
+        while True:
+            datos = f.read(CHUNK_BYTES)
+            if not datos:
+                break
+            clave.update(datos)
+    clave.update(json.dumps([modelo, parametros, float(resolucion)]))
+    tabla = os.path.join(directorio, clave.hexdigest() + '.map')
+    if os.path.isfile(tabla):
+        return tabla
+
+    malla = cargarMalla(mapa, mmap=False)
+    f = malla
+    if modelo != 'bilineal':
+        f = ajustarModelo(mapaDesdeMalla(malla), modelo, malla.l, malla.h, malla.dx, malla.dy,
+                          malla.x0, malla.y0, **opciones)
+    fina = tabularModelo(f, malla.l, malla.h, malla.dx, malla.dy, resolucion, malla.x0, malla.y0)
+    if not os.path.isdir(directorio):
+        os.makedirs(directorio)
+    # Escribir con otro nombre y renombrar, por si otro proceso la está leyendo
+    info = malla.info
+    guardarMalla(tabla + '.tmp', fina, info.get('ref'), info.get('avance', PROBE_FEED), info.get('fecha'))
+    os.rename(tabla + '.tmp', tabla)
+    return tabla
+
+'''
+    Compara las tablas de alturas de la función f (ver tabularModelo) con f en cada
+    resolución (mm) de 'resoluciones', en 'muestras' puntos al azar de la placa de
+    l x h celdas de dx*dy con origen en (x0, y0).
+
+    Devuelve una lista con un diccionario por resolución: puntos y bytes de la tabla
+    y error máximo y RMS (mm) respecto de f.
+'''
+def precisionTabla(f, l, h, dx=DELTA_X, dy=DELTA_Y, resoluciones=LUT_RESOLUTIONS, muestras=100000, semilla=0,
+                   x0=0.0, y0=0.0):
+    aleatorio = np.random.RandomState(semilla)
+    x = x0 + aleatorio.uniform(0, l * dx, muestras)
+    y = y0 + aleatorio.uniform(0, h * dy, muestras)
+    z = evaluarPuntos(f, x, y)
+    filas = []
+    for resolucion in resoluciones:
+        tabla = tabularModelo(f, l, h, dx, dy, resolucion, x0, y0)
+        error = evaluarPuntos(tabla, x, y) - z
+        filas.append({'resolucion': resolucion, 'puntos': tabla.z.size, 'bytes': tabla.z.nbytes,
+                      'error_max': float(np.abs(error).max()), 'error_rms': float(np.sqrt(np.mean(error**2)))})
+    return filas
+
+'''
+    Evalúa la función f en los arreglos de puntos x, y.
+    Si f es vectorizada (BilinearGrid, ModeloSuperficie) evalúa todos los puntos en
+    una sola llamada, si no (interp2d, BilinearMatrix) evalúa punto por punto.
+'''
+def evaluarPuntos(f, x, y):
+    if getattr(f, 'vectorizada', False):
+        return f(x, y)
+    return np.array([f(xi, yi)[0] for xi, yi in zip(x, y)], dtype=float)
+
+
+'''
+    Guarda la función de interpolación (BilinearGrid) en un archivo binario.
+    El archivo tiene la línea MAP_MAGIC, una línea con los metadatos en JSON
+    (forma de la cuadrícula, origen, dx, dy, referencia, avance de probing y
+    fecha) rellenada con espacios hasta un múltiplo de 64 bytes, y después las
+    alturas z[i][j] como float32, para poder leerlas con np.memmap.
+'''
+def guardarMalla(filename, malla, ref=None, avance=PROBE_FEED, fecha=None):
+    meta = {'forma': list(malla.z.shape), 'origen': [malla.x0, malla.y0],
+            'dx': malla.dx, 'dy': malla.dy, 'ref': ref, 'avance': avance,
+            'fecha': fecha if fecha != None else time.strftime('%Y-%m-%d %H:%M:%S')}
+    cabecera = MAP_MAGIC + json.dumps(meta, sort_keys=True)
+    cabecera += ' ' * (-(len(cabecera) + 1) % 64) + '\n'
+    f = open(filename, 'wb')
+    f.write(cabecera)
+    np.asarray(malla.z, dtype='<f4').tofile(f)
+    f.close()
+
+'''
+    Lee un mapa de alturas guardado con guardarMalla y devuelve la función de
+    interpolación BilinearGrid, con los metadatos en el atributo 'info'.
+    Si mmap es True, las alturas se leen del disco a medida que se usan.
+    También acepta el archivo de texto de realizarProbing (ver leerMapa).
+'''
+def cargarMalla(filename, mmap=True):
+    f = open(filename, 'rb')
+    if f.readline() != MAP_MAGIC:
+        f.close()
+        probemap = leerMapa(filename)
+        l, h, dx, dy = dimensionesMapa(probemap)
+        malla = interpolarMalla(completarMapa(probemap, l, h, dx, dy), l, h, dx, dy)
+        malla.info = {}
+        return malla
+    meta = json.loads(f.readline())
+    forma = tuple(meta['forma'])
+    if mmap:
+        z = np.memmap(filename, dtype='<f4', mode='r', offset=f.tell(), shape=forma)
+    else:
+        z = np.fromfile(f, dtype='<f4', count=forma[0] * forma[1]).reshape(forma)
+    f.close()
+    malla = BilinearGrid(z, meta['dx'], meta['dy'], meta['origen'][0], meta['origen'][1])
+    malla.info = meta
+    return malla
+
+'''
+    Lee el archivo de texto de puntos (x, y, z) separados por '\t' que escribe
+    realizarProbing y devuelve el diccionario del mapa de alturas.
+'''
+def leerMapa(filename):
+    probemap = {}
+    for linea in open(filename, 'r'):
+        valores = linea.split()
+        if len(valores) == 3:
+            x, y, z = [float(v) for v in valores]
+            probemap[(x, y)] = z
+    return probemap
+
+'''
+    Escribe el mapa de alturas en el formato de texto de realizarProbing.
+    probeMap -> diccionario del mapa o función BilinearGrid (se escriben sus nodos)
+'''
+def escribirMapa(filename, probeMap):
+    if isinstance(probeMap, BilinearGrid):
+        probeMap = mapaDesdeMalla(probeMap)
+    f = open(filename, 'w')
+    for p in sorted(probeMap.keys(), key=lambda p: (p[1], p[0])):
+        f.write('%-4.3f\t%-4.3f\t%-4.3f\n' % (p[0], p[1], probeMap[p]))
+    f.close()
+
+'''
+    Devuelve el diccionario del mapa de alturas con los nodos de la función BilinearGrid.
+'''
+def mapaDesdeMalla(malla):
+    probemap = {}
+    for i in range(malla.l + 1):
+        for j in range(malla.h + 1):
+            probemap[(malla.x0 + i*malla.dx, malla.y0 + j*malla.dy)] = float(malla.z[i, j])
+    return probemap
+
+'''
+    Obtiene el tamaño l, h (en celdas) y los avances dx, dy de la cuadrícula de un
+    mapa de alturas con origen en (0,0), e.g. el leído de un archivo de texto.
+    Lanza ValueError si los puntos no están en los nodos de una cuadrícula regular
+    (e.g. puntos dispersos), ya que la cuadrícula obtenida no tendría sentido.
+'''
+def dimensionesMapa(probeMap):
+    xm, ym, zm = probeMapToList(probeMap)
+    xs = np.unique(np.round(xm, 6))
+    ys = np.unique(np.round(ym, 6))
+    dx = np.diff(xs).min() if len(xs) > 1 else abs(DELTA_X)
+    dy = np.diff(ys).min() if len(ys) > 1 else abs(DELTA_Y)
+    for v, d in ((xs, dx), (ys, dy)):
+        u = v / d
+        if np.abs(u - np.round(u)).max() > 1e-3:
+            raise ValueError('Los puntos del mapa no forman una cuadricula regular, especifique l, h, dx, dy')
+    # Los avances tienen el signo de los puntos, e.g. DELTA_X < 0
+    dx = -dx if xs.min() < 0 else dx
+    dy = -dy if ys.min() < 0 else dy
+    l = int(round(np.abs(xs).max() / abs(dx)))
+    h = int(round(np.abs(ys).max() / abs(dy)))
+    return l, h, float(dx), float(dy)
+
+'''
+    Devuelve (dx, dy, x0, y0) de la cuadrícula del probing del mapa guardado (ver
+    cargarMalla), donde se subdividen los cortes aunque se nivele con una tabla de
+    alturas más fina.
+'''
+def cuadriculaMapa(mapa):
+    malla = cargarMalla(mapa)
+    return malla.dx, malla.dy, malla.x0, malla.y0
+
+'''
+    Modifica el archivo de código G con el mapa de alturas guardado en 'mapa'
+    (binario o texto, ver cargarMalla), sin repetir el probing.
+    procesos -> con más de uno nivela el archivo por trozos en paralelo
+                (ver modificarArchivoParalelo)
+    telemetria -> objeto Telemetria para registrar la duración de cada etapa
+    resolucion -> si se especifica, nivela con la tabla de alturas del mapa de esta
+                  resolución (mm) y el modelo SURFACE_MODEL (ver tablaAlturas), por
+                  defecto LUT_RESOLUTION
+'''
+def nivelarConMapa(mapa, filename, prof_fresado=MILL_DEPTH, max_seg=None, procesos=1, telemetria=None,
+                   resolucion=None):
+    if resolucion == None:
+        resolucion = LUT_RESOLUTION
+    cuadricula = None
+    if resolucion != None:
+        cuadricula = cuadriculaMapa(mapa)
+        mapa = tablaAlturas(mapa, SURFACE_MODEL, resolucion)
+        print 'Usando la tabla de alturas %s...' % mapa
+    if procesos > 1:
+        print 'Modificando el archivo original en %d procesos...' % procesos
+        if telemetria != None:
+            telemetria.iniciarEtapa('nivelado')
+        modificarArchivoParalelo(filename, mapa, prof_fresado, max_seg != None, max_seg, procesos,
+                                 cuadricula=cuadricula)
+        if telemetria != None:
+            telemetria.terminarEtapa()
+        return
+    print 'Cargando el mapa de alturas %s...' % mapa
+    if telemetria != None:
+        telemetria.iniciarEtapa('mapa')
+    malla = cargarMalla(mapa)
+    print 'Modificando el archivo original...'
+    if telemetria != None:
+        telemetria.iniciarEtapa('nivelado')
+    modificarArchivo(filename, malla, prof_fresado, max_seg != None, max_seg, cuadricula=cuadricula)
+    if telemetria != None:
+        telemetria.terminarEtapa()
+
+
+'''
+    Limpia una línea de código G de espacios dobles o más y del espacio antes
+    del salto de línea.
+'''
+def limpiarLinea(linea):
+    if '  ' in linea:
+        linea = re.sub('[ ]{2,}', ' ', linea)
+    return linea.replace(' \n', '\n')
+
+'''
+    Lee el archivo de código G como un generador de líneas limpias (ver limpiarLinea).
+    inicio, fin -> posiciones (bytes) de inicio de línea entre las que se lee, para
+                   leer solo un trozo del archivo (ver dividirArchivo)
+'''
+def leerLineas(filename, inicio=0, fin=None):
+    with open(filename, 'r') as f:
+        if inicio == 0 and fin == None:
+            for linea in f:
+                yield limpiarLinea(linea)
+            return
+        f.seek(inicio)
+        while fin == None or f.tell() < fin:
+            linea = f.readline()
+            if linea == '':
+                break
+            yield limpiarLinea(linea)
+
+'''
+    Agrupa las líneas en bloques de hasta n líneas para evaluar la superficie en lote.
+    El estado modal pasa de un bloque al siguiente (ver interpretarLineas), por lo
+    que los bloques se pueden cortar en cualquier línea.
+'''
+def bloquesLineas(lineas, n=BLOCK_LINES):
+    bloque = []
+    for linea in lineas:
+        bloque.append(linea)
+        if len(bloque) >= n:
+            yield bloque
+            bloque = []
+    if bloque:
+        yield bloque
+
+'''
+    Estado modal de GRBL al comenzar un archivo (ver interpretarLineas): movimiento
+    rápido G0, coordenadas absolutas, posición y avance desconocidos.
+'''
+def estadoInicial():
+    return {'modo': 0, 'absoluto': True, 'avance': None, 'x': None, 'y': None, 'z': None}
+
+'''
+    Interpreta las líneas de código G en una sola pasada, siguiendo el modo de
+    movimiento modal (G0, G1, G2, G3), las coordenadas absolutas o relativas
+    (G90, G91), el avance y la posición actual. Acepta minúsculas, palabras en
+    cualquier orden y sin espacios, ceros a la izquierda (G01) y líneas sin letra G
+    (movimiento modal), e ignora los comentarios.
+    estado -> estado modal al comenzar (ver estadoInicial), se actualiza al terminar
+
+    Genera un Movimiento por cada línea que mueve la máquina, con el índice de la
+    línea, el tipo (0, 1, 2 o 3), el inicio (x0, y0, z0), el fin (x1, y1, z1), el
+    avance, el centro del arco relativo al inicio (i, j, también para arcos con R)
+    y si las coordenadas son absolutas. Las coordenadas aún desconocidas son None.
+'''
+def interpretarLineas(lineas, estado):
+    modo, absoluto, avance = estado['modo'], estado['absoluto'], estado['avance']
+    x, y, z = estado['x'], estado['y'], estado['z']
+    for k, linea in enumerate(lineas):
+        if '(' in linea or ';' in linea:
+            linea = COMMENT_RE.sub('', linea)
+        nx = ny = nz = i = j = r = None
+        especial = False
+        for letra, valor in WORD_RE.findall(linea.upper()):
+            if letra == 'X':
+                nx = float(valor)
+            elif letra == 'Y':
+                ny = float(valor)
+            elif letra == 'G':
+                if valor in G_MODOS:
+                    modo = G_MODOS[valor]
+                    continue
+                g = float(valor)
+                if g in (0, 1, 2, 3):
+                    modo = int(g)
+                elif g == 90:
+                    absoluto = True
+                elif g == 91:
+                    absoluto = False
+                elif g in G_ESPECIALES:
+                    especial = True
+            elif letra == 'Z':
+                nz = float(valor)
+            elif letra == 'F':
+                avance = float(valor)
+            elif letra == 'I':
+                i = float(valor)
+            elif letra == 'J':
+                j = float(valor)
+            elif letra == 'R':
+                r = float(valor)
+        if especial:
+            x = y = z = None
+            continue
+        if nx == None and ny == None and nz == None and (modo < 2 or (i == None and j == None)):
+            continue
+        if absoluto:
+            x1 = x if nx == None else nx
+            y1 = y if ny == None else ny
+            z1 = z if nz == None else nz
+        else:
+            x1 = x if nx == None or x == None else x + nx
+            y1 = y if ny == None or y == None else y + ny
+            z1 = z if nz == None or z == None else z + nz
+        if modo >= 2:
+            if r != None and i == None and j == None:
+                i, j = centroArco(x, y, x1, y1, r, modo == 2)
+            elif i != None or j != None:
+                # Las palabras I, J que faltan valen 0
+                i, j = i or 0.0, j or 0.0
+        yield Movimiento(k, modo, x, y, z, x1, y1, z1, avance, i, j, absoluto)
+        x, y, z = x1, y1, z1
+    estado.update(modo=modo, absoluto=absoluto, avance=avance, x=x, y=y, z=z)
+
+'''
+    Calcula el centro, relativo al inicio, de un arco G2/G3 dado por su radio r
+    (r negativo para arcos de más de media vuelta), con el mismo método que GRBL.
+    horario -> True para G2, False para G3
+
+    Devuelve (i, j), o (None, None) si el radio es muy pequeño para unir los
+    extremos o alguno de ellos es desconocido.
+'''
+def centroArco(x0, y0, x1, y1, r, horario):
+    if x0 == None or y0 == None or x1 == None or y1 == None:
+        return None, None
+    dx = x1 - x0
+    dy = y1 - y0
+    h = 4.0 * r * r - dx * dx - dy * dy
+    if h < 0 or (dx == 0 and dy == 0):
+        return None, None
+    h = -np.sqrt(h) / np.hypot(dx, dy)
+    if not horario:
+        h = -h
+    if r < 0:
+        h = -h
+    return 0.5 * (dx - dy * h), 0.5 * (dy + dx * h)
+
+'''
+    Linealiza en lote arcos G2/G3 del plano XY en cuerdas cuyo error (distancia
+    máxima entre la cuerda y el arco) no supera tolerancia y, si se especifica
+    max_seg, de largo máximo max_seg.
+    x0, y0, x1, y1 -> arreglos con los extremos de cada arco
+    i, j -> arreglos con el centro de cada arco relativo a su inicio
+    horario -> arreglo booleano, True para G2 y False para G3
+
+    Devuelve los arreglos (idx, x, y) de los vértices intermedios, ordenados por arco
+    y a lo largo de cada arco, donde idx es el índice del arco al que pertenecen.
+'''
+def linealizarArcos(x0, y0, x1, y1, i, j, horario, tolerancia=ARC_TOLERANCE, max_seg=None):
+    x0 = np.asarray(x0, dtype=float)
+    y0 = np.asarray(y0, dtype=float)
+    horario = np.asarray(horario, dtype=bool)
+    cx = x0 + np.asarray(i, dtype=float)
+    cy = y0 + np.asarray(j, dtype=float)
+    r = np.hypot(x0 - cx, y0 - cy)
+    a0 = np.arctan2(y0 - cy, x0 - cx)
+    da = np.arctan2(np.asarray(y1, dtype=float) - cy, np.asarray(x1, dtype=float) - cx) - a0
+    # Como GRBL: con inicio y fin iguales el arco es un círculo completo
+    da = np.where(horario & (da >= -ARC_EPSILON), da - 2 * np.pi, da)
+    da = np.where(~horario & (da <= ARC_EPSILON), da + 2 * np.pi, da)
+
+    # Ángulo máximo de cada cuerda y número de cuerdas de cada arco
+    rs = np.maximum(r, 1e-12)
+    paso = 2 * np.arccos(np.clip(1 - tolerancia / rs, -1, 1))
+    if max_seg:
+        paso = np.minimum(paso, max_seg / rs)
+    n = np.maximum(np.ceil(np.abs(da) / paso), 1).astype(int)
+
+    # Vértices 1 .. n-1 de cada arco
+    idx = np.repeat(np.arange(len(n)), n - 1)
+    k = np.arange(len(idx)) - np.repeat(np.cumsum(n - 1) - (n - 1), n - 1) + 1
+    a = a0[idx] + da[idx] * k / n[idx]
+    return idx, cx[idx] + r[idx] * np.cos(a), cy[idx] + r[idx] * np.sin(a)
+
+'''
+    Clasifica un movimiento para nivelarlo:
+    'corte' -> G1, G2 o G3 en X, Y a la altura de corte (z <= 0 o desconocida)
+    'bajada' -> G1 solo en Z hacia abajo, hasta la altura de corte
+    None -> movimientos rápidos, sobre la placa, en coordenadas relativas o en una
+            posición desconocida, que no se modifican
+'''
+def clasificarMovimiento(m):
+    k, tipo, x0, y0, z0, x1, y1, z1, avance, i, j, absoluto = m
+    if tipo == 0 or not absoluto or x1 == None or y1 == None:
+        return None
+    if z1 != None and z1 > 0:
+        return None
+    if x1 != x0 or y1 != y0 or tipo != 1:
+        return 'corte'
+    if z1 != None and (z0 == None or z1 < z0):
+        return 'bajada'
+    return None
+
+'''
+    Devuelve la posición donde termina el código de una línea (antes de los comentarios).
+'''
+def finCodigo(linea):
+    if '(' in linea or ';' in linea:
+        return min(i for i in (linea.find('('), linea.find(';'), len(linea)) if i >= 0)
+    return len(linea)
+
+'''
+    Escribe la altura z en una línea de código G: reemplaza su palabra Z o la agrega
+    después de la última palabra X o Y. No modifica los comentarios.
+    z -> texto de la altura, e.g. '-0.120' (ver formatearAlturas)
+    extra -> texto que se agrega después de la palabra Z
+'''
+def escribirZ(linea, z, extra=''):
+    codigo = linea[:finCodigo(linea)]
+    m = Z_RE.search(codigo) if 'Z' in codigo or 'z' in codigo else None
+    if m != None:
+        return linea[:m.start()] + 'Z' + z + extra + linea[m.end():]
+    m = XY_RE.match(codigo)
+    i = m.end() if m != None else len(codigo.rstrip())
+    return linea[:i] + ' Z' + z + extra + linea[i:]
+
+'''
+    Convierte en lote las alturas zs al texto '%-4.3f' de cada una. Pasar el arreglo
+    a una lista de floats de Python antes de formatear evita crear un escalar de
+    NumPy por valor.
+'''
+def formatearAlturas(zs):
+    return ['%-4.3f' % z for z in np.asarray(zs, dtype=float).ravel().tolist()]
+
+'''
+    Escribe el último tramo de un arco linealizado: la misma línea G2/G3 con la
+    altura z y el centro (i, j) relativo al último vértice en lugar de I, J o R.
+    Agrega la letra G del modo si la línea no la tiene, ya que las cuerdas G1 que
+    la preceden cambian el modo de movimiento.
+'''
+def escribirArco(linea, modo, z, i, j):
+    fin = finCodigo(linea)
+    codigo = IJR_RE.sub('', linea[:fin])
+    if MODO_RE.search(codigo) == None:
+        codigo = 'G%d ' % modo + codigo
+    return escribirZ(codigo + linea[fin:], '%-4.3f' % z, ' I%-4.4f J%-4.4f' % (i, j))
+
+'''
+    Subdivide en lote los segmentos rectos (x0,y0)->(x1,y1) en los puntos donde cruzan
+    las líneas de la cuadrícula (múltiplos de dx y dy desde su origen) y, si se
+    especifica max_seg, de forma que ningún tramo sea más largo que max_seg.
+    x0, y0, x1, y1 -> arreglos con los extremos de cada segmento
+    origen -> (x, y) del origen de la cuadrícula (ver BilinearGrid)
+
+    Devuelve los arreglos (idx, x, y) de los puntos intermedios, ordenados por segmento
+    y a lo largo de cada segmento, donde idx es el índice del segmento al que pertenecen.
+'''
+def subdividirSegmentos(x0, y0, x1, y1, dx=DELTA_X, dy=DELTA_Y, max_seg=None, origen=(0.0, 0.0)):
+    x0 = np.asarray(x0, dtype=float)
+    y0 = np.asarray(y0, dtype=float)
+    x1 = np.asarray(x1, dtype=float)
+    y1 = np.asarray(y1, dtype=float)
+    # Extremos en unidades de la cuadrícula
+    u0 = (x0 - origen[0]) / dx
+    u1 = (x1 - origen[0]) / dx
+    v0 = (y0 - origen[1]) / dy
+    v1 = (y1 - origen[1]) / dy
+
+    # Líneas de la cuadrícula cruzadas: enteros k con min(u0,u1) < k < max(u0,u1)
+    kx = np.floor(np.minimum(u0, u1)) + 1
+    nx = np.maximum(np.ceil(np.maximum(u0, u1)) - kx, 0).astype(int)
+    ky = np.floor(np.minimum(v0, v1)) + 1
+    ny = np.maximum(np.ceil(np.maximum(v0, v1)) - ky, 0).astype(int)
+    # Puntos adicionales para limitar el largo de los tramos
+    if max_seg:
+        largo = np.hypot(x1 - x0, y1 - y0)
+        nl = np.maximum(np.ceil(largo / max_seg) - 1, 0).astype(int)
+    else:
+        nl = np.zeros(len(x0), dtype=int)
+
+    # Índice de segmento y posición r de cada punto intermedio dentro de su segmento
+    n = nx + ny + nl
+    idx = np.repeat(np.arange(len(n)), n)
+    r = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    nx = nx[idx]
+    ny = ny[idx]
+    # Parámetro t en (0, 1) de cada punto a lo largo del segmento
+    t = np.empty(len(idx))
+    ex = r < nx
+    t[ex] = (kx[idx][ex] + r[ex] - u0[idx][ex]) / (u1 - u0)[idx][ex]
+    ey = ~ex & (r < nx + ny)
+    t[ey] = (ky[idx][ey] + r[ey] - nx[ey] - v0[idx][ey]) / (v1 - v0)[idx][ey]
+    el = r >= nx + ny
+    t[el] = (r[el] - nx[el] - ny[el] + 1.0) / (nl[idx][el] + 1)
+
+    # Ordenar a lo largo de cada segmento y eliminar puntos repetidos (esquinas de celda)
+    orden = np.lexsort((t, idx))
+    idx = idx[orden]
+    t = t[orden]
+    nuevo = np.ones(len(idx), dtype=bool)
+    nuevo[1:] = (idx[1:] != idx[:-1]) | (t[1:] - t[:-1] > 1e-9)
+    idx = idx[nuevo]
+    t = t[nuevo]
+    return idx, x0[idx] + (x1 - x0)[idx] * t, y0[idx] + (y1 - y0)[idx] * t
+
+'''
+    Nivela un bloque de líneas de código G y devuelve las líneas modificadas.
+    Escribe z = f(x,y) - prof_fresado en cada movimiento de corte y en cada bajada
+    de la herramienta (ver clasificarMovimiento), con la altura en su punto final.
+    Todas las alturas del bloque se obtienen con una sola evaluación de f.
+
+    Si segmentar es True, cada corte G1 se subdivide donde cruza la cuadrícula de f
+    (y cada max_seg mm si se especifica) agregando los puntos intermedios nivelados.
+    Los arcos G2/G3 siempre se linealizan en cuerdas G1 con error menor que tol_arco
+    (y de largo máximo max_seg al segmentar), niveladas en cada vértice; el último
+    tramo queda como arco (ver escribirArco).
+    estado -> estado modal al comenzar el bloque (ver interpretarLineas), se
+              actualiza al terminar el bloque
+    cuadricula -> (dx, dy, x0, y0) de la cuadrícula del probing donde se subdividen los
+                  cortes, por defecto la de f. Se especifica si f no usa esa cuadrícula,
+                  e.g. una tabla de alturas (ver tablaAlturas)
+'''
+def nivelarBloque(lineas, f, prof_fresado, segmentar=False, max_seg=None, estado=None, tol_arco=ARC_TOLERANCE,
+                  cuadricula=None):
+    if cuadricula == None:
+        cuadricula = (getattr(f, 'dx', DELTA_X), getattr(f, 'dy', DELTA_Y), getattr(f, 'x0', 0.0),
+                      getattr(f, 'y0', 0.0))
+    bloque = prepararBloque(lineas, segmentar, max_seg, estado, tol_arco, *cuadricula)
+    return escribirBloque(bloque, f, prof_fresado)
+
+'''
+    Primera parte de nivelarBloque, que no depende del mapa de alturas: interpreta
+    el bloque y obtiene los puntos (x,y) a evaluar, incluyendo los puntos intermedios
+    de los cortes subdivididos en la cuadrícula de dx*dy con origen en (x0, y0) y los
+    vértices de los arcos. Devuelve un BloquePreparado para escribirBloque.
+'''
+def prepararBloque(lineas, segmentar=False, max_seg=None, estado=None, tol_arco=ARC_TOLERANCE,
+                   dx=DELTA_X, dy=DELTA_Y, x0=0.0, y0=0.0):
+    if estado == None:
+        estado = estadoInicial()
+
+    # Primera pasada: buscar los puntos (x,y) a evaluar
+    xs = []
+    ys = []
+    nivelar = [] # indices de las lineas a nivelar, en el orden de xs, ys
+    segs = [] # (indice de linea, x0, y0, x1, y1) de los cortes G1 a subdividir
+    arcos = [] # (indice de linea, x0, y0, x1, y1, i, j, horario) de los arcos a linealizar
+    for m in interpretarLineas(lineas, estado):
+        tipo = clasificarMovimiento(m)
+        if tipo == None:
+            continue
+        if tipo == 'corte' and m.x0 != None and m.y0 != None:
+            if m.tipo == 1 and segmentar:
+                segs.append((m.linea, m.x0, m.y0, m.x1, m.y1))
+            elif m.tipo != 1 and m.i != None:
+                arcos.append((m.linea, m.x0, m.y0, m.x1, m.y1, m.i, m.j, m.tipo == 2))
+        nivelar.append(m.linea)
+        xs.append(m.x1)
+        ys.append(m.y1)
+
+    # Puntos intermedios de los segmentos y vértices de los arcos, se evaluan junto con los demas
+    grupos = []
+    if segs:
+        s = np.array(segs, dtype=float)
+        grupos.append((segs, subdividirSegmentos(s[:, 1], s[:, 2], s[:, 3], s[:, 4], dx, dy, max_seg,
+                                                        (x0, y0))))
+    if arcos:
+        a = np.array(arcos, dtype=float)
+        grupos.append((arcos, linealizarArcos(a[:, 1], a[:, 2], a[:, 3], a[:, 4], a[:, 5], a[:, 6], a[:, 7] > 0,
+                                              tol_arco, max_seg if segmentar else None)))
+    intermedios = {} # indice de linea -> (posicion del primer punto en xs, lista de puntos intermedios)
+    for lista, (idx, xi, yi) in grupos:
+        base = len(xs)
+        for n, (i, p) in enumerate(zip(idx, zip(xi, yi))):
+            k = lista[i][0]
+            if k not in intermedios:
+                intermedios[k] = (base + n, [])
+            intermedios[k][1].append(p)
+        xs.extend(xi)
+        ys.extend(yi)
+    # Centro y modo de cada arco, para escribir su último tramo
+    centros = dict((a[0], (a[1] + a[5], a[2] + a[6], 2 if a[7] else 3)) for a in arcos)
+    return BloquePreparado(lineas, nivelar, np.array(xs), np.array(ys), intermedios, centros)
+
+'''
+    Segunda parte de nivelarBloque: evalúa f en todos los puntos del bloque preparado
+    y devuelve sus líneas con las alturas z = f(x,y) - prof_fresado.
+    alturas -> si se especifica, arreglo con f(x,y) ya evaluada en los puntos del
+               bloque (ver NiveladoIncremental), f no se usa
+'''
+def escribirBloque(bloque, f, prof_fresado, alturas=None):
+    lineas, nivelar, xs, ys, intermedios, centros = bloque
+    if not len(xs):
+        return lineas
+
+    # Evaluar todas las alturas del bloque
+    if alturas is None:
+        alturas = evaluarPuntos(f, xs, ys)
+    zs = alturas - prof_fresado
+    textos = formatearAlturas(zs)
+
+    # Segunda pasada: escribir las alturas de cada línea nivelada
+    salida = list(lineas)
+    if not intermedios:
+        for k, z in zip(nivelar, textos):
+            salida[k] = escribirZ(lineas[k], z)
+        return salida
+    for n, k in enumerate(nivelar):
+        if k not in intermedios:
+            salida[k] = escribirZ(lineas[k], textos[n])
+            continue
+        # Los puntos intermedios van antes del punto final, con el avance de la linea
+        pos, puntos = intermedios[k]
+        avance = F_RE.search(lineas[k][:finCodigo(lineas[k])])
+        avance = ' F%s' % avance.group(1) if avance != None else ''
+        nuevas = ['G1 X%-4.4f Y%-4.4f Z%s%s\n' % (p[0], p[1], textos[pos + i], avance if i == 0 else '')
+                  for i, p in enumerate(puntos)]
+        if k in centros:
+            cx, cy, modo = centros[k]
+            nuevas.append(escribirArco(lineas[k], modo, zs[n], cx - puntos[-1][0], cy - puntos[-1][1]))
+        else:
+            nuevas.append(escribirZ(lineas[k], textos[n]))
+        salida[k] = ''.join(nuevas)
+    return salida
+
+'''
+    Funcion que recibe el nombre original del archivo y el prefijo a agregar.
+    Devuelve el nuevo nombre del archivo
+'''
+def opt_name(s, prefix):
+    assert '.' in s
+    i = -1
+    while s[i] != '.':
+        i = i - 1
+    old_ext = s[i:]
+    return s[-len(s): i] + prefix + old_ext
+
+'''
+    Modifica el archivo de código G con la funcion especificada
+    filename -> str: La ruta hacia el archivo a modificar 
+    f -> Es el objeto de funcion devuelto por interp2d o BilinearGrid para modificar los puntos X y Y
+    prof_fresado -> profunidad de fresado a partir de z=0 (valor positivo)
+
+    segmentar -> subdividir los G1 X# Y# donde cruzan la cuadrícula (ver nivelarBloque)
+    max_seg -> largo máximo de cada tramo al subdividir (mm), None para no limitarlo
+    tol_arco -> error máximo (mm) de las cuerdas que reemplazan a los arcos G2/G3
+
+    indice -> si se especifica, índice por celdas del archivo (ver cargarIndice) donde
+              se guarda la posición de cada línea en el archivo nivelado, para
+              nivelar de nuevo solo una parte (ver renivelarArchivo)
+    cuadricula -> (dx, dy, x0, y0) de la cuadrícula donde se subdividen los cortes (ver nivelarBloque)
+
+    El archivo se lee y se escribe por bloques de BLOCK_LINES líneas, en una sola
+    pasada y con memoria constante. Devuelve el nombre del archivo nivelado (.LEV).
+'''
+def modificarArchivo(filename, f, prof_fresado, segmentar=False, max_seg=None, tol_arco=ARC_TOLERANCE, indice=None,
+                     cuadricula=None):
+    # Nivelar el archivo por bloques y guardar el archivo modificado
+    salida = opt_name(filename, '.LEV')
+    wf = open(salida, 'w', WRITE_BUFFER)
+    estado = estadoInicial()
+    largos = []
+    for bloque in bloquesLineas(leerLineas(filename)):
+        nuevas = nivelarBloque(bloque, f, prof_fresado, segmentar, max_seg, estado, tol_arco, cuadricula)
+        wf.write(''.join(nuevas))
+        if indice != None:
+            largos.extend(len(linea) for linea in nuevas)
+    wf.close()
+    if indice != None:
+        indice.salida = np.concatenate(([0], np.cumsum(largos, dtype=np.int64)))
+    return salida
+
+'''
+    Nivela de nuevo el archivo ya nivelado (.LEV) después de un cambio en una parte
+    del mapa de alturas: solo se vuelven a nivelar las líneas de los movimientos que
+    pasan por las celdas que usan los puntos cambiados (y los arcos que pasan por sus
+    vecinas, ya que se indexan por sus cuerdas), el resto se copia del archivo
+    nivelado anterior. El trabajo
+    de interpretar, evaluar y escribir las líneas es proporcional al área cambiada.
+    El resultado es idéntico byte a byte al de modificarArchivo con el mapa nuevo.
+    f -> función de interpolación con el mapa nuevo
+    Se usa después de revisar las lecturas en probingConcurrente.
+    f -> función de interpolación con el mapa nuevo. Solo con el modelo bilineal
+         (BilinearGrid) un punto cambia únicamente las celdas que lo usan; con otro
+         modelo se nivela el archivo completo
+    nodos -> arreglo booleano de (l+1) x (h+1) con los puntos del mapa cuya altura
+             cambió, por ejemplo malla_anterior.z != malla.z
+    indice -> índice por celdas del archivo (ver cargarIndice) con las posiciones del
+              archivo nivelado anterior. Si no las tiene, o el archivo usa coordenadas
+              relativas (G91), se nivela el archivo completo
+    Los demás parámetros son los de modificarArchivo.
+
+    Devuelve el nombre del archivo nivelado (.LEV) y actualiza las posiciones del índice.
+'''
+def renivelarArchivo(filename, f, prof_fresado, nodos, indice, segmentar=False, max_seg=None,
+                     tol_arco=ARC_TOLERANCE, cuadricula=None):
+    salida = opt_name(filename, '.LEV')
+    if (not isinstance(f, BilinearGrid) or indice.salida is None or not os.path.isfile(salida)
+            or os.path.getsize(salida) != indice.salida[-1] or usaCoordenadasRelativas(filename)):
+        return modificarArchivo(filename, f, prof_fresado, segmentar, max_seg, tol_arco, indice, cuadricula)
+
+    # Celdas que usan los puntos cambiados, y sus vecinas para los arcos
+    nodos = np.asarray(nodos, dtype=bool)
+    l, h = indice.l, indice.h
+    cambiadas = nodos[:l, :h] | nodos[1:l + 1, :h] | nodos[:l, 1:h + 1] | nodos[1:l + 1, 1:h + 1]
+    vecinas = ndimage.binary_dilation(cambiadas, np.ones((3, 3), dtype=bool))
+    lineas = np.union1d(indice.lineasCeldas(cambiadas),
+                        np.intersect1d(indice.lineasCeldas(vecinas), indice.arcos))
+    if not len(lineas):
+        return salida
+
+    # Tramos de líneas a nivelar de nuevo, uniendo los que están cerca
+    cortes = np.flatnonzero(np.diff(lineas) > RELEVEL_GAP) + 1
+    tramos = zip(lineas[np.r_[0, cortes]], lineas[np.r_[cortes - 1, len(lineas) - 1]] + 1)
+    largos = np.diff(indice.salida)
+    temporal = salida + '.tmp'
+    rf = open(salida, 'rb')
+    wf = open(temporal, 'wb', WRITE_BUFFER)
+    copiado = 0 # líneas ya escritas
+    for a, b in tramos:
+        # Copiar las líneas sin cambios
+        rf.seek(indice.salida[copiado])
+        restante = indice.salida[a] - indice.salida[copiado]
+        while restante > 0:
+            datos = rf.read(min(restante, CHUNK_BYTES))
+            wf.write(datos)
+            restante -= len(datos)
+        # Nivelar el tramo desde el estado modal en que comienza
+        estado = estadoAnterior(filename, indice.offsets[a])
+        n = a
+        for bloque in bloquesLineas(leerLineas(filename, indice.offsets[a], indice.offsets[b])):
+            nuevas = nivelarBloque(bloque, f, prof_fresado, segmentar, max_seg, estado, tol_arco, cuadricula)
+            wf.write(''.join(nuevas))
+            largos[n:n + len(nuevas)] = [len(linea) for linea in nuevas]
+            n += len(nuevas)
+        copiado = b
+    rf.seek(indice.salida[copiado])
+    while True:
+        datos = rf.read(CHUNK_BYTES)
+        if not datos:
+            break
+        wf.write(datos)
+    rf.close()
+    wf.close()
+    os.remove(salida)
+    os.rename(temporal, salida)
+    indice.salida = np.concatenate(([0], np.cumsum(largos, dtype=np.int64)))
+    return salida
+
+'''
+    Quita los ceros sobrantes de los números de una línea de código G
+    (X-10.0000 -> X-10, Z-0.120 -> Z-0.12), sin modificar los comentarios.
+'''
+def recortarNumeros(linea):
+    fin = finCodigo(linea)
+    if '.' not in linea[:fin]:
+        return linea
+    def recortar(m):
+        n = m.group(2).rstrip('0').rstrip('.')
+        return m.group(1) + (n if n not in ('', '-', '+') else n + '0')
+    return DECIMAL_RE.sub(recortar, linea[:fin]) + linea[fin:]
+
+'''
+    Devuelve la distancia del punto p al segmento a-b, en 3-D.
+'''
+def distanciaSegmento(p, a, b):
+    d = [b[n] - a[n] for n in range(3)]
+    v = [p[n] - a[n] for n in range(3)]
+    dd = d[0] * d[0] + d[1] * d[1] + d[2] * d[2]
+    t = min(max((v[0] * d[0] + v[1] * d[1] + v[2] * d[2]) / dd, 0.0), 1.0) if dd > 0 else 0.0
+    return np.sqrt(sum((v[n] - t * d[n]) ** 2 for n in range(3)))
+
+'''
+    Compacta un archivo de código G, como pasada final después de modificarArchivo:
+    elimina los movimientos de largo cero, une los G1 consecutivos que son colineales
+    en 3-D (cada punto eliminado queda a menos de tolerancia mm del nuevo movimiento)
+    y quita los ceros sobrantes de los números (ver recortarNumeros).
+    Solo se eliminan líneas con un G0/G1 y coordenadas X, Y, Z, precedidas por un
+    movimiento del mismo tipo y sin líneas de otro tipo entre los puntos unidos, por
+    lo que no cambian el avance, el modo de movimiento ni dónde se ejecutan los demás
+    comandos.
+    salida -> archivo compactado, por defecto reemplaza al archivo original
+
+    Imprime y devuelve la cantidad de líneas y de bytes antes y después.
+'''
+def compactarArchivo(filename, tolerancia=MERGE_TOLERANCE, salida=None):
+    if salida == None:
+        salida = filename
+    temporal = salida + '.tmp'
+    wf = open(temporal, 'w', WRITE_BUFFER)
+    estado = estadoInicial()
+    lineas_antes = lineas_despues = bytes_antes = bytes_despues = 0
+    tramo = [] # (línea, movimiento) de los G1 colineales aún sin escribir, solo queda el último
+    previo = None # tipo del movimiento de la línea anterior, None si no es un movimiento
+    for bloque in bloquesLineas(leerLineas(filename)):
+        movs = dict((m.linea, m) for m in interpretarLineas(bloque, estado))
+        escribir = []
+        for k, linea in enumerate(bloque):
+            lineas_antes += 1
+            bytes_antes += len(linea)
+            m = movs.get(k)
+            simple = (m != None and m.tipo == previo and m.absoluto and SIMPLE_RE.match(linea) != None and
+                      None not in (m.x0, m.y0, m.z0, m.x1, m.y1, m.z1))
+            # Movimiento de largo cero: no cambia nada
+            if simple and (m.x0, m.y0, m.z0) == (m.x1, m.y1, m.z1):
+                continue
+            p = None if m == None else (m.x1, m.y1, m.z1)
+            if tramo:
+                # Los puntos del tramo quedan a menos de tolerancia del nuevo movimiento: se eliminan
+                inicio = tramo[0][1]
+                a = (inicio.x0, inicio.y0, inicio.z0)
+                if (m != None and m.tipo == 1 and previo == 1 and m.avance == tramo[-1][1].avance and
+                        None not in p and MOVIMIENTO_RE.match(linea[:finCodigo(linea)]) != None and
+                        all(distanciaSegmento((t.x1, t.y1, t.z1), a, p) <= tolerancia for l, t in tramo)):
+                    if simple:
+                        tramo.append((linea, m))
+                    else:
+                        escribir.append(linea)
+                        tramo = []
+                    previo = m.tipo
+                    continue
+                escribir.append(tramo[-1][0])
+                tramo = []
+            if simple and m.tipo == 1:
+                tramo = [(linea, m)]
+            else:
+                escribir.append(linea)
+            previo = None if m == None else m.tipo
+        for linea in escribir:
+            linea = recortarNumeros(linea)
+            lineas_despues += 1
+            bytes_despues += len(linea)
+            wf.write(linea)
+    if tramo:
+        linea = recortarNumeros(tramo[-1][0])
+        lineas_despues += 1
+        bytes_despues += len(linea)
+        wf.write(linea)
+    wf.close()
+    if os.path.isfile(salida):
+        os.remove(salida)
+    os.rename(temporal, salida)
+
+    print 'Lineas: %d -> %d (%.1f%% menos)' % (lineas_antes, lineas_despues,
+                                                100.0 * (lineas_antes - lineas_despues) / max(lineas_antes, 1))
+    print 'Bytes: %d -> %d (%.1f%% menos)' % (bytes_antes, bytes_despues,
+                                               100.0 * (bytes_antes - bytes_despues) / max(bytes_antes, 1))
+    return lineas_antes, lineas_despues, bytes_antes, bytes_despues
+
+
+# Función de interpolación y parámetros de cada proceso de nivelarLote
+LOTE = {}
+
+'''
+    Prepara el proceso para nivelar archivos de un lote: carga el mapa una sola vez.
+    mapa -> archivo de mapa de alturas (ver cargarMalla) o función de interpolación
+    segmentar -> ver nivelarBloque, por defecto solo si se especifica max_seg
+    cuadricula -> (dx, dy, x0, y0) de la cuadrícula donde se subdividen los cortes (ver nivelarBloque)
+'''
+def iniciarLote(mapa, prof_fresado, max_seg=None, segmentar=None, tol_arco=ARC_TOLERANCE, cuadricula=None):
+    LOTE['f'] = cargarMalla(mapa) if isinstance(mapa, basestring) else mapa
+    LOTE['prof_fresado'] = prof_fresado
+    LOTE['max_seg'] = max_seg
+    LOTE['segmentar'] = max_seg != None if segmentar == None else segmentar
+    LOTE['tol_arco'] = tol_arco
+    LOTE['cuadricula'] = cuadricula
+
+'''
+    Nivela un archivo del lote con la función cargada por iniciarLote.
+    Devuelve el nombre del archivo nivelado y el tiempo que tomó (s).
+'''
+def nivelarArchivoLote(filename):
+    inicio = time.time()
+    salida = modificarArchivo(filename, LOTE['f'], LOTE['prof_fresado'], LOTE['segmentar'], LOTE['max_seg'],
+                              LOTE['tol_arco'], cuadricula=LOTE['cuadricula'])
+    return salida, time.time() - inicio
+
+'''
+    Nivela varios archivos de código G con un mismo mapa de alturas, cargado y
+    convertido en función de interpolación una sola vez (por proceso).
+    mapa -> archivo de mapa de alturas (ver cargarMalla) o función de interpolación
+    archivos -> lista de archivos o patrones, e.g. ['placa.bot.etch.nc', '*.drill.nc'].
+                Los patrones omiten los archivos ya nivelados (.LEV)
+    procesos -> número de procesos para nivelar archivos en paralelo. Con un archivo
+                de mapa cada proceso lo lee con np.memmap, compartiendo la memoria.
+    resolucion -> si se especifica, nivela con la tabla de alturas del mapa de esta
+                  resolución (mm), por defecto LUT_RESOLUTION (ver nivelarConMapa)
+
+    Devuelve la lista de archivos nivelados.
+'''
+def nivelarLote(mapa, archivos, prof_fresado=MILL_DEPTH, max_seg=None, procesos=1, resolucion=None):
+    if resolucion == None:
+        resolucion = LUT_RESOLUTION
+    cuadricula = None
+    if resolucion != None and isinstance(mapa, basestring):
+        cuadricula = cuadriculaMapa(mapa)
+        mapa = tablaAlturas(mapa, SURFACE_MODEL, resolucion)
+        print 'Usando la tabla de alturas %s...' % mapa
+    lista = []
+    for a in archivos:
+        patron = glob.has_magic(a)
+        for filename in (sorted(glob.glob(a)) if patron else [a]):
+            if patron and '.LEV' in os.path.basename(filename):
+                print 'Omitiendo %s (ya nivelado)' % filename
+            elif filename not in lista:
+                lista.append(filename)
+
+    inicio = time.time()
+    if procesos > 1 and len(lista) > 1:
+        pool = multiprocessing.Pool(min(procesos, len(lista)), iniciarLote,
+                                    (mapa, prof_fresado, max_seg, None, ARC_TOLERANCE, cuadricula))
+        resultados = pool.map(nivelarArchivoLote, lista)
+        pool.close()
+        pool.join()
+    else:
+        iniciarLote(mapa, prof_fresado, max_seg, cuadricula=cuadricula)
+        resultados = [nivelarArchivoLote(filename) for filename in lista]
+
+    for filename, (salida, t) in zip(lista, resultados):
+        print '%s -> %s (%.2f s)' % (filename, salida, t)
+    print 'Se nivelaron %d archivos en %.2f s' % (len(lista), time.time() - inicio)
+    return [salida for salida, t in resultados]
+
+
+'''
+    Divide el archivo en n trozos de tamaño similar para nivelarlos por separado.
+    Cada corte queda al final de una línea completa.
+
+    Devuelve la lista de posiciones (bytes) de los cortes, desde 0 hasta el tamaño
+    del archivo.
+'''
+def dividirArchivo(filename, n):
+    tam = os.path.getsize(filename)
+    cortes = [0]
+    with open(filename, 'rb') as f:
+        for k in range(1, n):
+            f.seek(max(tam * k // n, cortes[-1]))
+            f.readline() # terminar la línea en la que cayó el corte
+            corte = f.tell()
+            if corte >= tam:
+                break
+            if corte > cortes[-1]:
+                cortes.append(corte)
+    cortes.append(tam)
+    return cortes
+
+'''
+    Indica si el archivo usa coordenadas relativas (G91) en alguna línea.
+'''
+def usaCoordenadasRelativas(filename):
+    resto = ''
+    with open(filename, 'rb') as f:
+        while True:
+            datos = f.read(CHUNK_BYTES)
+            if not datos:
+                return False
+            if G91_RE.search(resto + datos) != None:
+                return True
+            resto = datos[-8:]
+
+'''
+    Busca hacia atrás desde la posición pos (inicio de línea) las últimas palabras
+    que fijan el estado modal (G0 a G3, X, Y, Z, F), leyendo solo el final del
+    trozo anterior. Supone coordenadas absolutas (ver usaCoordenadasRelativas).
+
+    Devuelve el estado con el que interpretarLineas comienza en pos, el mismo que
+    tendría al leer el archivo completo desde el principio.
+'''
+def estadoAnterior(filename, pos, ventana=65536):
+    estado = estadoInicial()
+    campos = {'X': 'x', 'Y': 'y', 'Z': 'z', 'F': 'avance'}
+    faltan = set(['modo', 'x', 'y', 'z', 'avance'])
+    with open(filename, 'rb') as f:
+        fin = pos
+        while fin > 0 and faltan:
+            ini = max(0, fin - ventana)
+            f.seek(ini)
+            lineas = f.read(fin - ini).split('\n')
+            # La primera línea puede estar incompleta, se vuelve a leer en la siguiente ventana
+            primera = lineas.pop(0) if ini > 0 else None
+            for linea in reversed(lineas):
+                if '(' in linea or ';' in linea:
+                    linea = COMMENT_RE.sub('', linea)
+                palabras = WORD_RE.findall(linea.upper())
+                especial = any(l == 'G' and float(v) in G_ESPECIALES for l, v in palabras)
+                # La última palabra de la línea es la que vale
+                for letra, valor in reversed(palabras):
+                    if letra == 'G' and 'modo' in faltan and float(valor) in (0, 1, 2, 3):
+                        estado['modo'] = int(float(valor))
+                        faltan.discard('modo')
+                    elif letra in campos and campos[letra] in faltan and (letra == 'F' or not especial):
+                        estado[campos[letra]] = float(valor)
+                        faltan.discard(campos[letra])
+                if especial:
+                    # Antes de un G28, G38.2, etc. la posición no importa: queda desconocida
+                    faltan -= set(['x', 'y', 'z'])
+                if not faltan:
+                    break
+            if primera == None:
+                break
+            fin = ini + len(primera) + 1
+            ventana *= 2
+    return estado
+
+'''
+    Nivela el trozo [inicio, fin) del archivo con la función cargada por iniciarLote,
+    comenzando con el estado modal estado, y lo escribe en el archivo parte.
+'''
+def nivelarTrozo(trozo):
+    filename, inicio, fin, estado, parte = trozo
+    wf = open(parte, 'w', WRITE_BUFFER)
+    for bloque in bloquesLineas(leerLineas(filename, inicio, fin)):
+        wf.write(''.join(nivelarBloque(bloque, LOTE['f'], LOTE['prof_fresado'], LOTE['segmentar'],
+                                    LOTE['max_seg'], estado, LOTE['tol_arco'], LOTE['cuadricula'])))
+    wf.close()
+    return parte
+
+'''
+    Igual que modificarArchivo, pero nivela el archivo por trozos en varios procesos.
+    El archivo se divide en líneas completas (ver dividirArchivo), cada trozo comienza
+    con el estado modal en que termina el anterior (ver estadoAnterior) y las
+    partes niveladas se unen en orden, por lo que el resultado es idéntico byte a
+    byte al de modificarArchivo.
+    f -> función de interpolación o archivo de mapa de alturas (ver cargarMalla).
+         Con un archivo de mapa cada proceso lo lee con np.memmap, compartiendo la memoria.
+    procesos -> número de procesos, por defecto uno por núcleo. Los archivos con
+                coordenadas relativas (G91) se nivelan en un solo proceso
+    cuadricula -> (dx, dy, x0, y0) de la cuadrícula donde se subdividen los cortes (ver nivelarBloque)
+
+    Devuelve el nombre del archivo nivelado (.LEV).
+'''
+def modificarArchivoParalelo(filename, f, prof_fresado, segmentar=False, max_seg=None, procesos=None,
+                             tol_arco=ARC_TOLERANCE, cuadricula=None):
+    if procesos == None:
+        procesos = multiprocessing.cpu_count()
+    # Varios trozos por proceso para repartir mejor la carga
+    n = min(procesos * 4, os.path.getsize(filename) // CHUNK_BYTES)
+    if procesos <= 1 or n <= 1 or usaCoordenadasRelativas(filename):
+        if isinstance(f, basestring):
+            f = cargarMalla(f)
+        return modificarArchivo(filename, f, prof_fresado, segmentar, max_seg, tol_arco, cuadricula=cuadricula)
+
+    salida = opt_name(filename, '.LEV')
+    cortes = dividirArchivo(filename, n)
+    trozos = []
+    for k in range(len(cortes) - 1):
+        estado = estadoAnterior(filename, cortes[k])
+        trozos.append((filename, cortes[k], cortes[k+1], estado, '%s.%d.part' % (salida, k)))
+
+    pool = multiprocessing.Pool(procesos, iniciarLote, (f, prof_fresado, max_seg, segmentar, tol_arco, cuadricula))
+    partes = pool.map(nivelarTrozo, trozos, chunksize=1)
+    pool.close()
+    pool.join()
+
+    # Unir las partes en orden
+    wf = open(salida, 'w', WRITE_BUFFER)
+    for parte in partes:
+        with open(parte, 'r') as rf:
+            while True:
+                datos = rf.read(CHUNK_BYTES)
+                if not datos:
+                    break
+                wf.write(datos)
+        os.remove(parte)
+    wf.close()
+    return salida
+
+
+'''
+    Obtiene los movimientos de corte de un bloque de líneas con los mismos criterios
+    que nivelarBloque (ver clasificarMovimiento): cada corte desde la posición anterior
+    y cada bajada de la herramienta como un movimiento de largo cero. Los arcos
+    G2/G3 se reemplazan por sus cuerdas (ver linealizarArcos), al final del arreglo.
+    estado -> estado modal (ver interpretarLineas), se actualiza al terminar el bloque
+
+    Devuelve un arreglo de n x 4 con (x0, y0, x1, y1) de cada movimiento, un arreglo
+    con el índice en el bloque de la línea de cada movimiento y otro con el de las
+    líneas de los arcos.
+'''
+def movimientosBloque(lineas, estado, tol_arco=ARC_TOLERANCE):
+    movs = []
+    arcos = [] # (x0, y0, x1, y1, i, j, horario)
+    lin_movs = []
+    lin_arcos = []
+    for m in interpretarLineas(lineas, estado):
+        if clasificarMovimiento(m) == None:
+            continue
+        if m.tipo != 1 and m.i != None and m.x0 != None and m.y0 != None:
+            arcos.append((m.x0, m.y0, m.x1, m.y1, m.i, m.j, m.tipo == 2))
+            lin_arcos.append(m.linea)
+        else:
+            movs.append((m.x1 if m.x0 == None else m.x0, m.y1 if m.y0 == None else m.y0, m.x1, m.y1))
+            lin_movs.append(m.linea)
+    movs = np.array(movs, dtype=float).reshape(-1, 4)
+    lin_movs = np.array(lin_movs, dtype=int)
+    lin_arcos = np.array(lin_arcos, dtype=int)
+    if not arcos:
+        return movs, lin_movs, lin_arcos
+
+    # Cuerdas entre el inicio, los vértices y el fin de cada arco
+    a = np.array(arcos, dtype=float)
+    idx, xi, yi = linealizarArcos(a[:, 0], a[:, 1], a[:, 2], a[:, 3], a[:, 4], a[:, 5], a[:, 6] > 0, tol_arco)
+    n = len(a)
+    seg = np.concatenate((np.arange(n), idx, np.arange(n)))
+    orden = np.concatenate((np.zeros(n), np.arange(1, len(idx) + 1), np.ones(n) * np.inf))
+    x = np.concatenate((a[:, 0], xi, a[:, 2]))
+    y = np.concatenate((a[:, 1], yi, a[:, 3]))
+    k = np.lexsort((orden, seg))
+    seg, x, y = seg[k], x[k], y[k]
+    tramo = seg[1:] == seg[:-1]
+    cuerdas = np.column_stack((x[:-1][tramo], y[:-1][tramo], x[1:][tramo], y[1:][tramo]))
+    lin_cuerdas = lin_arcos[seg[:-1][tramo].astype(int)]
+    return np.vstack((movs, cuerdas)), np.concatenate((lin_movs, lin_cuerdas)), lin_arcos
+
+'''
+    Índice de los movimientos de un archivo de código G por celda de la cuadrícula
+    de l x h celdas de dx*dy. Para cada celda guarda las líneas de los movimientos
+    que se nivelan (ver clasificarMovimiento) y pasan por ella, en formato comprimido
+    por filas: las líneas de la celda (i, j) son lineas[inicio[c]:inicio[c+1]] con
+    c = i*h + j. Los movimientos fuera de la placa cuentan en la celda del borde.
+    arcos -> líneas de los arcos G2/G3, que se indexan por sus cuerdas
+    offsets -> posición (bytes) del comienzo de cada línea del archivo, con el largo
+               del archivo al final, para leer solo algunas líneas (ver leerLineas)
+    salida -> posición del comienzo del resultado de cada línea en el archivo nivelado
+              (.LEV), con su largo al final, o None (ver modificarArchivo)
+'''
+class IndiceCeldas(object):
+    def __init__(self, l, h, dx, dy, inicio, lineas, arcos, offsets, salida=None):
+        self.l = l
+        self.h = h
+        self.dx = dx
+        self.dy = dy
+        self.inicio = inicio
+        self.lineas = lineas
+        self.arcos = arcos
+        self.offsets = offsets
+        self.salida = salida
+
+    '''
+        Devuelve las líneas de los movimientos que pasan por la celda (i, j).
+    '''
+    def lineasCelda(self, i, j):
+        c = i * self.h + j
+        return self.lineas[self.inicio[c]:self.inicio[c + 1]]
+
+    '''
+        Devuelve las líneas, ordenadas y sin repetir, de los movimientos que pasan
+        por alguna de las celdas marcadas en el arreglo booleano de l x h.
+    '''
+    def lineasCeldas(self, celdas):
+        c = np.flatnonzero(celdas)
+        if not len(c):
+            return np.zeros(0, dtype=self.lineas.dtype)
+        return np.unique(np.concatenate([self.lineas[self.inicio[k]:self.inicio[k + 1]] for k in c]))
+
+    '''
+        Devuelve un arreglo booleano de l x h con las celdas por las que pasa algún movimiento.
+    '''
+    def ocupadas(self):
+        return (np.diff(self.inicio) > 0).reshape(self.l, self.h)
+
+'''
+    Construye el índice por celdas (IndiceCeldas) del archivo de código G en una sola
+    pasada por bloques. Cada movimiento se divide donde cruza la cuadrícula y cada
+    tramo cuenta en la celda de su punto medio; los arcos se reemplazan por sus
+    cuerdas con error máximo tol_arco (ver movimientosBloque).
+'''
+def indexarArchivo(filename, l, h, dx=DELTA_X, dy=DELTA_Y, tol_arco=ARC_TOLERANCE):
+    estado = estadoInicial()
+    largos = []
+    celdas = []
+    lineas = []
+    arcos = []
+    with open(filename, 'rb') as f:
+        for bloque in bloquesLineas(f):
+            base = len(largos)
+            largos.extend(len(linea) for linea in bloque)
+            m, lin, lin_arcos = movimientosBloque([limpiarLinea(linea) for linea in bloque], estado, tol_arco)
+            arcos.append(base + lin_arcos)
+            n = len(m)
+            if n == 0:
+                continue
+            # Puntos de cada movimiento en orden: inicio, cruces con la cuadrícula y final
+            idx, xi, yi = subdividirSegmentos(m[:, 0], m[:, 1], m[:, 2], m[:, 3], dx, dy)
+            seg = np.concatenate((np.arange(n), idx, np.arange(n)))
+            orden = np.concatenate((np.zeros(n), np.arange(1, len(idx) + 1), np.ones(n) * np.inf))
+            x = np.concatenate((m[:, 0], xi, m[:, 2]))
+            y = np.concatenate((m[:, 1], yi, m[:, 3]))
+            k = np.lexsort((orden, seg))
+            seg, x, y = seg[k], x[k], y[k]
+            # Cada tramo entre dos puntos consecutivos queda en una sola celda: la de su punto medio
+            tramo = seg[1:] == seg[:-1]
+            xm = (x[1:] + x[:-1])[tramo] / 2
+            ym = (y[1:] + y[:-1])[tramo] / 2
+            i = np.clip(np.floor(xm / dx), 0, l - 1).astype(int)
+            j = np.clip(np.floor(ym / dy), 0, h - 1).astype(int)
+            celdas.append(i * h + j)
+            lineas.append(base + lin[seg[:-1][tramo].astype(int)])
+
+    # Pares (celda, línea) sin repetir, ordenados por celda
+    celdas = np.concatenate(celdas) if celdas else np.zeros(0, dtype=int)
+    lineas = np.concatenate(lineas) if lineas else np.zeros(0, dtype=int)
+    pares = np.unique(celdas.astype(np.int64) * (len(largos) + 1) + lineas)
+    celdas, lineas = np.divmod(pares, len(largos) + 1)
+    inicio = np.searchsorted(celdas, np.arange(l * h + 1)).astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(largos, dtype=np.int64)))
+    arcos = np.concatenate(arcos).astype(np.int32) if arcos else np.zeros(0, dtype=np.int32)
+    return IndiceCeldas(l, h, dx, dy, inicio, lineas.astype(np.int32), arcos, offsets)
+
+'''
+    Clave de validez del índice guardado del archivo de código G: el tamaño y la
+    fecha de modificación del archivo y los parámetros de la cuadrícula.
+'''
+def claveIndice(filename, l, h, dx, dy, tol_arco):
+    return json.dumps({'version': INDEX_VERSION, 'tam': os.path.getsize(filename),
+                       'fecha': os.path.getmtime(filename), 'l': l, 'h': h, 'dx': dx, 'dy': dy,
+                       'tol_arco': tol_arco}, sort_keys=True)
+
+'''
+    Guarda el índice por celdas junto al archivo de código G (filename + INDEX_EXT).
+    Si el índice tiene las posiciones del archivo nivelado, guarda también su tamaño
+    y fecha para saber si siguen siendo válidas.
+'''
+def guardarIndice(filename, indice, tol_arco=ARC_TOLERANCE):
+    datos = {'clave': np.array(claveIndice(filename, indice.l, indice.h, indice.dx, indice.dy, tol_arco)),
+             'inicio': indice.inicio, 'lineas': indice.lineas, 'arcos': indice.arcos, 'offsets': indice.offsets}
+    salida = opt_name(filename, '.LEV')
+    if indice.salida is not None and os.path.isfile(salida):
+        datos['salida'] = indice.salida
+        datos['clave_salida'] = np.array([os.path.getsize(salida), os.path.getmtime(salida)])
+    with open(filename + INDEX_EXT, 'wb') as f:
+        np.savez(f, **datos)
+
+'''
+    Devuelve el índice por celdas del archivo de código G: el guardado junto al
+    archivo si corresponde al mismo archivo y cuadrícula, si no lo construye
+    (ver indexarArchivo) y lo guarda para la próxima vez.
+    guardar -> False para no leer ni escribir el índice guardado
+'''
+def cargarIndice(filename, l, h, dx=DELTA_X, dy=DELTA_Y, tol_arco=ARC_TOLERANCE, guardar=True):
+    if guardar and os.path.isfile(filename + INDEX_EXT):
+        try:
+            with np.load(filename + INDEX_EXT) as datos:
+                if str(datos['clave']) == claveIndice(filename, l, h, dx, dy, tol_arco):
+                    salida = None
+                    levfile = opt_name(filename, '.LEV')
+                    if 'salida' in datos.files and os.path.isfile(levfile):
+                        if list(datos['clave_salida']) == [os.path.getsize(levfile), os.path.getmtime(levfile)]:
+                            salida = datos['salida']
+                    return IndiceCeldas(l, h, dx, dy, datos['inicio'], datos['lineas'], datos['arcos'],
+                                        datos['offsets'], salida)
+        except (IOError, ValueError, KeyError):
+            pass
+    indice = indexarArchivo(filename, l, h, dx, dy, tol_arco)
+    if guardar:
+        try:
+            guardarIndice(filename, indice, tol_arco)
+        except IOError:
+            print 'No se pudo guardar el índice de', filename
+    return indice
+
+'''
+    Devuelve un arreglo booleano de l x h con las celdas de dx*dy por las que pasa
+    algún movimiento de corte del archivo de código G, más las celdas a menos de
+    'margen' mm de ellas. Los movimientos fuera de la placa cuentan en la celda del borde.
+    Usa el índice por celdas del archivo (ver cargarIndice).
+'''
+def celdasOcupadas(filename, l, h, dx=DELTA_X, dy=DELTA_Y, margen=0):
+    ocupadas = cargarIndice(filename, l, h, dx, dy).ocupadas()
+
+    # Agregar las celdas dentro del margen
+    if margen > 0:
+        kx = int(np.ceil(margen / abs(float(dx))))
+        ky = int(np.ceil(margen / abs(float(dy))))
+        ocupadas = ndimage.binary_dilation(ocupadas, np.ones((2*kx + 1, 2*ky + 1), dtype=bool))
+    return ocupadas
+
+'''
+    Devuelve la lista de puntos de probing necesarios para nivelar el archivo de
+    código G: las esquinas de las celdas de celdasOcupadas más el punto (0,0) de
+    referencia, ordenados con planearRuta.
+'''
+def puntosTrayectoria(filename, l, h, dx=DELTA_X, dy=DELTA_Y, margen=0):
+    ocupadas = celdasOcupadas(filename, l, h, dx, dy, margen)
+    nodos = np.zeros((l + 1, h + 1), dtype=bool)
+    nodos[:-1, :-1] |= ocupadas
+    nodos[1:, :-1] |= ocupadas
+    nodos[:-1, 1:] |= ocupadas
+    nodos[1:, 1:] |= ocupadas
+    nodos[0, 0] = True
+    # listaPuntos con dx = dy = 1 devuelve los índices (i, j) en el mismo orden
+    puntos = [p for p, (i, j) in zip(listaPuntos(l, h, dx, dy), listaPuntos(l, h, 1, 1)) if nodos[i, j]]
+    return planearRuta(puntos)
+
+
+'''
+    Imprime las instrucciones para iniciar el programa correctamente
+    desde la linea de comandos
+'''
+def imprimeInstrucciones():
+    #print '=- Programa de Probing -=\n'
+    print 'Utilizacion correcta:'
+    print '\tpython probing.py -f <archivo> <x> <y> <dx> <dy> <prof_z> <max_seg>'
+    print '\tpython probing.py -f <archivo> <x> <y> <dx> <dy> <prof_z>'
+    print '\tpython probing.py -f <archivo> <x> <y>'
+    print '\tpython probing.py -t <archivo> <x> <y> <dx> <dy> <prof_z> <margen>'
+    print '\tpython probing.py -m <mapa> <archivo> <prof_z> [<procesos>]'
+    print '\tpython probing.py -b <mapa> <prof_z> <procesos> <archivo> [<archivo> ...]'
+    print '\tpython probing.py -p <x> <y> <dx> <dy>'
+    print '\tpython probing.py -p <x> <y>'
+    print '\tpython probing.py -a <x> <y> <dx> <dy> <tol>'
+    print '\tpython probing.py -c <archivo> [<tol>]'
+    print '\tpython probing.py -s [<sesion>]'
+    print '\tpython probing.py -e <archivo>'
+    print '\tpython probing.py -T <telemetria> <opcion> ...'
+    print '\tpython probing.py -r <opcion> ...'
+    print '\tpython probing.py -v <opcion> ...'
+    print '\tpython probing.py -C -t <archivo> <x> <y> <dx> <dy> <prof_z> <margen>'
+    print '\tpython probing.py -M <modelo> <opcion> ...'
+    print '\tpython probing.py -L <resolucion> -m|-b ...'
+    print '\tpython probing.py -P <mapa> [<modelo>]'
+    print '\tpython probing.py -S <puerto> <opcion> ...\n'
+    print 'x,y\t:\tDimensiones del area a probar'
+    print 'dx, dy\t:\tCambios en ambos ejes, por defecto dx=-10mm, dy=10mm'
+    print 'prof_z\t:\tProfundidad de fresado a partir de la superficie de contacto'
+    print 'mapa\t:\tMapa de alturas guardado (%s o el de texto %s)' % (MAP_FILE, OUTPUT_FILE)
+    print 'procesos:\tNumero de procesos para nivelar los archivos en paralelo (opcion -b)'
+    print 'margen\t:\tSolo hace probing donde corta el archivo y a menos de margen mm (opcion -t)'
+    print 'tol\t:\tProbing adaptativo, divide las celdas con error de interpolacion mayor a tol (mm)'
+    print '\t\tCompactar (opcion -c), une los movimientos colineales con error menor a tol (mm)'
+    print 'max_seg\t:\tSubdivide los G1 donde cruzan la cuadricula y cada max_seg mm (0 = solo la cuadricula)'
+    print 'sesion\t:\tReanuda el probing interrumpido guardado en la sesion (por defecto %s)' % SESSION_FILE
+    print 'telemetria:\tGuarda los tiempos de cada sondeo y etapa en este archivo (.json o .csv)'
+    print '-r\t:\tProbing en dos fases: busqueda rapida, retroceso y lectura lenta, subiendo'
+    print '\t\tsolo %.1f mm sobre el nodo vecino anterior entre puntos' % PROBE_RETRACT
+    print '-v\t:\tRepite las lecturas que difieren mas de %.3f mm de sus vecinos y usa la mediana' % PROBE_OUTLIER_TOLERANCE
+    print '-C\t:\tNivela el archivo por celdas mientras se hace el probing'
+    print 'modelo\t:\tModelo de la superficie: %s (por defecto %s)' % (', '.join(sorted(MODELOS)), SURFACE_MODEL)
+    print 'resolucion:\tNivela con la tabla de alturas del mapa de esta resolucion (mm), ver -P'
+    print 'puerto\t:\tPuerto serial de GRBL (por defecto %s), o sim / sim:<mapa> para el simulador' % SERIAL_PORT
+
+
+'''
+    Realiza la rutina general de probing utilizando el tamaño de la placa.
+    Opcionalmente modifica el archivo de código G especificado.
+    length_x -> tamaño de la placa en el eje X (en mm)
+    length_y -> tamaño de la placa en el eje Y (en mm)
+    prof_z -> profundidad de fresado a partir de la superficie de contacto de la placa
+    filename -> Nombre del archivo para modificar el código G
+    max_seg -> Si se especifica, subdivide los G1 X# Y# donde cruzan la cuadrícula
+               y en tramos de max_seg mm como máximo (0 = solo en la cuadrícula)
+    tolerancia -> Si se especifica, realiza el probing adaptativo con esta tolerancia
+                  de error de interpolación (mm), ver probingAdaptativo
+    margen -> Si se especifica junto con filename, solo hace probing en las celdas
+              donde corta el archivo y a menos de margen mm de ellas
+    telemetria -> Si se especifica, objeto Telemetria donde se registran los tiempos
+                  de cada sondeo y la duración de cada etapa
+    El modelo de la superficie es SURFACE_MODEL (ver ajustarModelo).
+'''
+def rutinaGeneral(length_x, length_y, dx = DELTA_X, dy = DELTA_Y, prof_z = MILL_DEPTH, filename=None, max_seg=None,
+                  tolerancia=None, margen=None, telemetria=None):
+    # Obtener la lista de puntos
+    print 'Generando la lista de puntos...'
+    if telemetria != None:
+        telemetria.iniciarEtapa('ruta')
+    l = abs(length_x / dx)
+    h = abs(length_y / dy)
+    puntos = planearRuta(listaPuntos(l, h, dx, dy))
+    if (filename != None) and (margen != None):
+        print 'Buscando las celdas donde corta el archivo...'
+        puntos = puntosTrayectoria(filename, l, h, dx, dy, margen)
+    print 'La lista de puntos es: ', puntos
+    print 'Tiempo estimado de probing: %.0f s' % tiempoRuta(puntos)
+
+    # Obtener las alturas de los puntos
+    print 'Realizando el mapa de alturas...'
+    if telemetria != None:
+        telemetria.iniciarEtapa('probing')
+    info = {}
+    nivelado = False
+    if (tolerancia != None):
+        probemap = probingAdaptativo(l, h, dx, dy, tolerancia, info=info, telemetria=telemetria)
+    elif (margen != None) and PROBE_CONCURRENT:
+        # El archivo se nivela durante el probing si se usa el modelo bilineal
+        nivelado = SURFACE_MODEL == 'bilineal'
+        probemap, bmatrix = probingConcurrente(puntos, l, h, dx, dy, filename if nivelado else None, prof_z,
+                                               max_seg != None, max_seg, info=info, telemetria=telemetria)
+    elif (margen != None):
+        probemap = realizarProbing(puntos, info=info, telemetria=telemetria, cuadricula=(dx, dy))
+    else:
+        #probemap = realizarProbing(puntos)
+        #print 'Mapa de alturas: ', probemap
+        # Probemap de 60x30 mm
+        probemap = {(-60, 10): -0.057, (-20, 20): -0.168, (0, 20): -0.082, (-30,30): -0.276, (-50, 10): -0.079, (0, 10): -0.057, (-20, 10): -0.098, (-50, 20): -0.184, (-60, 20): -0.181, (-40, 20): -0.181, (-10, 10): -0.076, (-50, 30): -0.298, (-30, 20): -0.178, (-30, 10): -0.092, (-10, 30): -0.181, (-60, 30): -0.273, (-40, 30): -0.289, (0, 0): 0.0, (-20, 0): 0.038, (-30, 0): 0.07, (-50, 0): 0.114, (0, 30): -0.105, (-40, 0): 0.099, (-10, 20): -0.13, (-60, 0): 0.111, (-10, 0): 0.022, (-40, 10): -0.086, (-20, 30): -0.244}
+        # Probemap de 30x30 mm
+        #probemap = {(-10, 20): -0.057, (0, 0): 0.0, (-20, 0): 0.003, (0, 20): -0.012, (-30, 20): -0.139, (-10, 30): -0.095, (-30, 10): -0.082, (-30, 0): -0.012, (-20, 20): -0.101, (0, 10): 0.019, (0, 30): -0.031, (-30, 30): -0.178, (-20, 10): -0.063, (-10, 10): -0.025, (-10, 0): 0.026, (-20, 30): -0.146}
+    print 'Se ha terminado el mapa, generando el modelo...'
+    if telemetria != None:
+        telemetria.iniciarEtapa('modelo')
+
+    # Obtener la funcion de interpolacion con todos los puntos
+    #f = interpolarMapa(probemap)
+
+    # Obtener la función de interpolación por áreas
+    #listaFunciones = interporlarMapa2(probemap, l, h, dx, dy)
+    #bmatrix = BilinearMatrix(listaFunciones, dx, dy)
+    if (tolerancia != None):
+        bmatrix = interpolarAdaptativo(probemap, l, h, dx, dy)
+        if SURFACE_MODEL == 'bicubico':
+            # Sobre la cuadrícula fina, para no perder los puntos de las celdas divididas
+            bmatrix = ajustarModelo(mapaDesdeMalla(bmatrix), SURFACE_MODEL, bmatrix.l, bmatrix.h,
+                                    bmatrix.dx, bmatrix.dy)
+        elif SURFACE_MODEL != 'bilineal':
+            bmatrix = ajustarModelo(probemap, SURFACE_MODEL, l, h, dx, dy)
+    elif SURFACE_MODEL != 'bilineal':
+        bmatrix = ajustarModelo(probemap, SURFACE_MODEL, l, h, dx, dy)
+    elif (margen != None):
+        bmatrix = interpolarMalla(completarMapa(probemap, l, h, dx, dy), l, h, dx, dy)
+    else:
+        bmatrix = interpolarMalla(probemap, l, h, dx, dy)
+
+    # Guardar el mapa binario si se hizo probing, para reutilizarlo con -m
+    if info:
+        malla = bmatrix
+        if not isinstance(bmatrix, BilinearGrid):
+            malla = tabularModelo(bmatrix, bmatrix.l, bmatrix.h, bmatrix.dx, bmatrix.dy, x0=bmatrix.x0, y0=bmatrix.y0)
+        guardarMalla(MAP_FILE, malla, info['ref'], info['avance'], info['fecha'])
 
     # Graficar el mapa de alturas
+    if telemetria != None:
+        telemetria.iniciarEtapa('grafica')
     #graficarMapa(probemap, function=f)
     graficarMapa(probemap)
 
     # Si se especificó, modificar el archivo original con el mapa obtenido.
-    if (filename != None):
+    if (filename != None) and not nivelado:
         print 'Modificando el archivo original...'
-        modificarArchivo(filename, bmatrix, prof_z)
+        if telemetria != None:
+            telemetria.iniciarEtapa('nivelado')
+        modificarArchivo(filename, bmatrix, prof_z, max_seg != None, max_seg)
+    if telemetria != None:
+        telemetria.terminarEtapa()
+
+'''
+    Reanuda el probing interrumpido guardado en el archivo de sesión, guarda el mapa
+    de alturas (texto y binario, para nivelar con -m) y lo grafica.
+'''
+def rutinaReanudar(sesion=SESSION_FILE, telemetria=None):
+    info = {}
+    if telemetria != None:
+        telemetria.iniciarEtapa('probing')
+    probemap = realizarProbing(None, info=info, telemetria=telemetria, sesion=sesion, reanudar=True)
+    if probemap == None:
+        return
+    if telemetria != None:
+        telemetria.iniciarEtapa('modelo')
+    l, h, dx, dy = dimensionesMapa(probemap)
+    malla = interpolarMalla(completarMapa(probemap, l, h, dx, dy), l, h, dx, dy)
+    guardarMalla(MAP_FILE, malla, info['ref'], info['avance'], info['fecha'])
+    print 'Mapa de alturas guardado en %s y %s' % (OUTPUT_FILE, MAP_FILE)
+    if telemetria != None:
+        telemetria.iniciarEtapa('grafica')
+    graficarMapa(probemap)
+    if telemetria != None:
+        telemetria.terminarEtapa()
+
+
+'''
+    Imprime el tamaño y el error de la tabla de alturas del mapa guardado 'mapa' con
+    el modelo 'modelo' en cada resolución de LUT_RESOLUTIONS (ver precisionTabla),
+    para elegir la resolución de -L según la memoria disponible.
+'''
+def rutinaPrecisionTabla(mapa, modelo=SURFACE_MODEL):
+    malla = cargarMalla(mapa, mmap=False)
+    f = malla
+    if modelo != 'bilineal':
+        f = ajustarModelo(mapaDesdeMalla(malla), modelo, malla.l, malla.h, malla.dx, malla.dy,
+                          malla.x0, malla.y0)
+    print 'Modelo %s, placa de %g x %g mm' % (modelo, abs(malla.l * malla.dx), abs(malla.h * malla.dy))
+    print 'Resolucion (mm)\tPuntos\t\tMemoria (MB)\tError max (mm)\tError RMS (mm)'
+    for fila in precisionTabla(f, malla.l, malla.h, malla.dx, malla.dy, x0=malla.x0, y0=malla.y0):
+        print '%-8g\t%-10d\t%-8.2f\t%.6f\t%.6f' % (fila['resolucion'], fila['puntos'], fila['bytes'] / 1048576.0,
+                                                    fila['error_max'], fila['error_rms'])
 
 
 '''
     Programa principal
 '''
-print '\n=- Programa de Probing -=\n'
-args = len(sys.argv)
-
-# Si sólo está el nombre del programa, pedir el tamaño de la placa
-if (args == 1):
-    length_x = int(raw_input('Ingrese largo en X [mm]: '))
-    length_y = int(raw_input('Ingrese alto en Y [mm]: '))
-    # Realizar procedimiento general
-    rutinaGeneral(length_x, length_y)
-
-# Si hay mas argumentos, revisar si es probing o modificacion de archivo
-else:
-    opcion = sys.argv[1]
-    print 'Argumentos: ', args
-
-    # Si la opción es solamente mapeo de alturas
-    if (opcion == '-p') and (args in [4,6]):
-        # Obtener los argumentos
-        length_x = int(sys.argv[2])
-        length_y = int(sys.argv[3])
-        # Si se especifican todos los argumentos
-        if (args == 6):
-            delta_x = int(sys.argv[4])
-            delta_y = int(sys.argv[5])
-            # Realizar el procedimiento general
-            rutinaGeneral(length_x, length_y, delta_x, delta_y)
-        # Sino, tomar los valores especificados por defecto
+if __name__ == '__main__':
+    print '\n=- Programa de Probing -=\n'
+    # Opciones generales antes de la opción principal: telemetría con -T <archivo>,
+    # probing en dos fases con -r, revisión de lecturas con -v, probing concurrente con -C
+    # modelo de la superficie con -M <modelo>, tabla de alturas con -L <resolucion> y
+    # puerto serial (o simulador) con -S <puerto>
+    telemetria = None
+    archivo_telemetria = None
+    while len(sys.argv) > 1 and sys.argv[1] in ['-T', '-r', '-v', '-C', '-M', '-L', '-S']:
+        if sys.argv[1] == '-S' and len(sys.argv) > 2:
+            SERIAL_PORT = sys.argv[2]
+            del sys.argv[1:3]
+        elif sys.argv[1] == '-M' and len(sys.argv) > 2 and sys.argv[2] in MODELOS:
+            SURFACE_MODEL = sys.argv[2]
+            del sys.argv[1:3]
+        elif sys.argv[1] == '-L' and len(sys.argv) > 2:
+            LUT_RESOLUTION = float(sys.argv[2])
+            del sys.argv[1:3]
+        elif sys.argv[1] == '-M':
+            break
+        elif sys.argv[1] == '-C':
+            PROBE_CONCURRENT = True
+            del sys.argv[1]
+        elif sys.argv[1] == '-r':
+            PROBE_TWO_PHASE = True
+            del sys.argv[1]
+        elif sys.argv[1] == '-v':
+            PROBE_RECHECK = True
+            del sys.argv[1]
+        elif len(sys.argv) > 2:
+            archivo_telemetria = sys.argv[2]
+            telemetria = Telemetria()
+            del sys.argv[1:3]
         else:
-            # Realizar el procedimiento general
-            rutinaGeneral(length_x, length_y)
-        
-    # Si la opción es modificación de archivo
-    elif (opcion == '-f') and (args in [5,8]):
-        # Obtener los argumentos
-        filename = sys.argv[2]
-        
-        # Revisar si el archivo existe
-        if (os.path.isfile(filename)):
-            length_x = int(sys.argv[3])
-            length_y = int(sys.argv[4])
+            break
+    args = len(sys.argv)
+
+    # Si sólo está el nombre del programa, pedir el tamaño de la placa
+    if (args == 1):
+        length_x = int(raw_input('Ingrese largo en X [mm]: '))
+        length_y = int(raw_input('Ingrese alto en Y [mm]: '))
+        # Realizar procedimiento general
+        rutinaGeneral(length_x, length_y, telemetria=telemetria)
+
+    # Si hay mas argumentos, revisar si es probing o modificacion de archivo
+    else:
+        opcion = sys.argv[1]
+        print 'Argumentos: ', args
+
+        # Si la opción es solamente mapeo de alturas
+        if (opcion == '-p') and (args in [4,6]):
+            # Obtener los argumentos
+            length_x = int(sys.argv[2])
+            length_y = int(sys.argv[3])
             # Si se especifican todos los argumentos
-            if (args == 8):
+            if (args == 6):
+                delta_x = int(sys.argv[4])
+                delta_y = int(sys.argv[5])
+                # Realizar el procedimiento general
+                rutinaGeneral(length_x, length_y, delta_x, delta_y, telemetria=telemetria)
+            # Sino, tomar los valores especificados por defecto
+            else:
+                # Realizar el procedimiento general
+                rutinaGeneral(length_x, length_y, telemetria=telemetria)
+            
+        # Si la opción es mapeo de alturas adaptativo
+        elif (opcion == '-a') and (args == 7):
+            length_x = int(sys.argv[2])
+            length_y = int(sys.argv[3])
+            delta_x = int(sys.argv[4])
+            delta_y = int(sys.argv[5])
+            tolerancia = float(sys.argv[6])
+            rutinaGeneral(length_x, length_y, delta_x, delta_y, tolerancia=tolerancia, telemetria=telemetria)
+
+        # Si la opción es modificación de archivo
+        elif (opcion == '-f') and (args in [5,8,9]):
+            # Obtener los argumentos
+            filename = sys.argv[2]
+            
+            # Revisar si el archivo existe
+            if (os.path.isfile(filename)):
+                length_x = int(sys.argv[3])
+                length_y = int(sys.argv[4])
+                # Si se especifican todos los argumentos
+                if (args in [8,9]):
+                    dx = int(sys.argv[5])
+                    dy = int(sys.argv[6])
+                    prof_z = float(sys.argv[7])
+                    # Largo maximo de los tramos si se pidio subdividir
+                    max_seg = float(sys.argv[8]) if args == 9 else None
+                    # Realizar la rutina general especificando todos los parametros
+                    rutinaGeneral(length_x, length_y, dx, dy, prof_z, filename, max_seg, telemetria=telemetria)
+                # Sino, tomar los valores especificados por defecto
+                else:
+                    # Realizar la rutina general con valores por defecto
+                    rutinaGeneral(length_x, length_y, filename=filename, telemetria=telemetria)
+                
+            # Si no existe el archivo especificado
+            else:
+                print 'El archivo especificado no existe...'
+                
+        # Si la opción es modificación de archivo con un mapa de alturas guardado
+        elif (opcion == '-m') and (args in [5, 6]):
+            mapa = sys.argv[2]
+            filename = sys.argv[3]
+            if (os.path.isfile(mapa)) and (os.path.isfile(filename)):
+                procesos = int(sys.argv[5]) if args == 6 else 1
+                nivelarConMapa(mapa, filename, float(sys.argv[4]), procesos=procesos, telemetria=telemetria)
+            else:
+                print 'El archivo especificado no existe...'
+
+        # Si la opción es modificación de varios archivos con un mapa guardado
+        elif (opcion == '-b') and (args >= 6):
+            mapa = sys.argv[2]
+            if (os.path.isfile(mapa)):
+                prof_z = float(sys.argv[3])
+                procesos = int(sys.argv[4])
+                nivelarLote(mapa, sys.argv[5:], prof_z, procesos=procesos)
+            else:
+                print 'El archivo especificado no existe...'
+
+        # Si la opción es compactar un archivo ya nivelado
+        elif (opcion == '-c') and (args in [3, 4]):
+            filename = sys.argv[2]
+            if (os.path.isfile(filename)):
+                tolerancia = float(sys.argv[3]) if args == 4 else MERGE_TOLERANCE
+                compactarArchivo(filename, tolerancia)
+            else:
+                print 'El archivo especificado no existe...'
+
+        # Si la opción es reanudar un probing interrumpido
+        elif (opcion == '-s') and (args in [2, 3]):
+            sesion = sys.argv[2] if args == 3 else SESSION_FILE
+            if (os.path.isfile(sesion)):
+                rutinaReanudar(sesion, telemetria)
+            else:
+                print 'El archivo especificado no existe...'
+
+        # Si la opción es enviar un archivo a GRBL
+        elif (opcion == '-e') and (args == 3):
+            filename = sys.argv[2]
+            if (os.path.isfile(filename)):
+                enviarArchivo(filename, telemetria=telemetria)
+            else:
+                print 'El archivo especificado no existe...'
+
+        # Si la opción es el reporte de precisión de la tabla de alturas
+        elif (opcion == '-P') and (args == 3 or (args == 4 and sys.argv[3] in MODELOS)):
+            mapa = sys.argv[2]
+            if (os.path.isfile(mapa)):
+                rutinaPrecisionTabla(mapa, sys.argv[3] if args == 4 else SURFACE_MODEL)
+            else:
+                print 'El archivo especificado no existe...'
+
+        # Si la opción es modificación de archivo haciendo probing solo donde corta
+        elif (opcion == '-t') and (args == 9):
+            filename = sys.argv[2]
+            if (os.path.isfile(filename)):
+                length_x = int(sys.argv[3])
+                length_y = int(sys.argv[4])
                 dx = int(sys.argv[5])
                 dy = int(sys.argv[6])
                 prof_z = float(sys.argv[7])
-                # Realizar la rutina general especificando todos los parametros
-                rutinaGeneral(length_x, length_y, dx, dy, prof_z, filename)
-            # Sino, tomar los valores especificados por defecto
+                margen = float(sys.argv[8])
+                rutinaGeneral(length_x, length_y, dx, dy, prof_z, filename, margen=margen, telemetria=telemetria)
             else:
-                # Realizar la rutina general con valores por defecto
-                rutinaGeneral(length_x, length_y, filename=filename)
-            
-        # Si no existe el archivo especificado
+                print 'El archivo especificado no existe...'
+
+        # Si la opción indicada es incorrecta
         else:
-            print 'El archivo especificado no existe...'
-            
-    # Si la opción indicada es incorrecta
-    else:
-        imprimeInstrucciones()
+            imprimeInstrucciones()
+
+    # Guardar la telemetría
+    if telemetria != None:
+        telemetria.exportar(archivo_telemetria)
+        print 'Telemetria guardada en %s' % archivo_telemetria